@@ -2,30 +2,524 @@ from selenium import webdriver
 from selenium.webdriver.common.by import By
 from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.support import expected_conditions as EC
-from selenium.common.exceptions import StaleElementReferenceException, NoSuchElementException
+from selenium.common.exceptions import StaleElementReferenceException, NoSuchElementException, WebDriverException, TimeoutException
 import time
 import json
 import os
 import requests
+from requests.adapters import HTTPAdapter
 from datetime import datetime
 from pathlib import Path
+from collections import deque
+from contextlib import contextmanager, ExitStack
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed, wait as wait_futures
+from urllib.parse import urlparse
+import threading
+import hashlib
+import shutil
+import multiprocessing
+import queue
 import re
+import unicodedata
+import sqlite3
+import argparse
+import asyncio
+import functools
+import math
+import random
+import gzip
+import io
+import sys
+import mimetypes
+import tempfile
+
+try:
+    from cryptography.fernet import Fernet, InvalidToken
+except ImportError:
+    Fernet = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# プロセス間のファイルロック（Unixはfcntl、Windowsはmsvcrt）
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+try:
+    import msvcrt
+except ImportError:
+    msvcrt = None
+
+# ChatworkのURL（ベンチマーク時はローカルの模擬サーバーに差し替える）
+CHATWORK_URL = "https://www.chatwork.com/"
+
+# バックアップの保存先
+BASE_DOWNLOAD_DIR = "chatwork_backup"
 
 # フィルター対象のキーワード
 TARGET_KEYWORDS = [
     "森田"
 ]
 
-def should_process_room(room_name):
-    """ルーム名が対象キーワードを含むかチェック"""
-    for keyword in TARGET_KEYWORDS:
-        if keyword in room_name:
+# 除外キーワード（対象キーワードに一致しても、これを含むルームは処理しない）
+EXCLUDE_KEYWORDS = []
+
+# ルーム名に関係なく常に処理するルームID
+RID_ALLOWLIST = []
+
+# フィルタールールのファイル（1行1件、#で始まる行はコメント。指定すると上のリストに追加される）
+KEYWORD_FILE = ""
+EXCLUDE_KEYWORD_FILE = ""
+RID_ALLOWLIST_FILE = ""
+
+# 添付ファイルの並列ダウンロード設定
+DOWNLOAD_WORKERS = 8          # ダウンロードスレッド数（1なら従来どおり逐次ダウンロード）
+DOWNLOAD_PER_HOST_LIMIT = 4   # 同一ホストへの同時接続数の上限
+HTTP_POOL_SIZE = 16           # requestsセッションのコネクションプールサイズ
+
+# 添付ファイルの扱い（"download": 抽出しながらダウンロード / "manifest": 一覧だけ記録し、後で fetch-attachments で取得）
+ATTACHMENT_MODE = "download"
+ATTACHMENT_MANIFEST_NAME = "_attachment_manifest.jsonl"
+ATTACHMENT_FETCHED_NAME = "_attachment_fetched.jsonl"
+
+# ダウンロードの再試行（接続が切れた場合は .part ファイルの続きから Range で取得する）
+# 続きを取得するのは .part と一緒に ETag / Last-Modified を記録できた場合だけで、If-Range で同じ内容か確認する
+DOWNLOAD_RETRIES = 5
+DOWNLOAD_BACKOFF_BASE = 1.0       # 再試行の待機時間の基準（秒、試行ごとに倍にしてランダムに散らす）
+DOWNLOAD_BACKOFF_MAX = 30.0
+DOWNLOAD_TIMEOUT = (10, 30)       # (接続, 受信待ち) のタイムアウト秒
+DOWNLOAD_CHUNK_MIN = 64 * 1024    # 読み込みチャンクの最小・最大サイズ（ファイルサイズに応じて調整）
+DOWNLOAD_CHUNK_MAX = 1024 * 1024
+
+# 画像はプレビュー（縮小版）ではなく download_file.php から元のファイルを取得する
+FULL_RESOLUTION_IMAGES = True
+# ダウンロード前にHEADでサイズ・種類・ETagを確認する（拡張子の決定と、同じ内容の保存済みファイルの再利用に使う）
+# エクスポート中は BATCH_CHUNK_SIZE 件ごとの添付ファイルをまとめて並列に確認し、空き容量と比べてからダウンロードする
+PROBE_ATTACHMENTS = True
+REMOTE_INDEX_NAME = "_remote_files.jsonl"   # 重複排除を使わない場合の保存済みファイルのサイズ・ETag
+
+# 添付ファイルの重複排除（file_idとSHA-256で管理し、ルーム・実行をまたいで再ダウンロードしない）
+DEDUP_ATTACHMENTS = True
+BLOB_DIR_NAME = "_blobs"      # バックアップ先直下に作る実体ファイルの保存先
+
+# 差分エクスポート（前回の最新message_idより新しいメッセージのみ取得して既存JSONに追記）
+INCREMENTAL_EXPORT = True
+
+# 期間指定エクスポート（UNIX秒、None なら制限なし。--since / --until で指定する）
+# 開始日時より古いメッセージまで読み込んだ時点でスクロールを止め、期間内のメッセージだけを抽出する
+# 期間指定の出力は差分の基準にならないよう、期間ごとのフォルダ（_window_{開始}-{終了}/）に毎回作り直す
+# （添付ファイルの実体・ETagの記録・添付ファイル一覧は期間に関係なくバックアップ先直下で共有する）
+EXPORT_SINCE = None
+EXPORT_UNTIL = None
+EXPORT_WINDOW_DIR_PREFIX = "_window_"
+
+# 出力形式（"jsonl": ルームごとに1つのJSONL / "segments": N件ごとに圧縮したJSONLと索引 index.json）
+OUTPUT_FORMAT = "jsonl"
+SEGMENT_SIZE = 1000            # 1セグメントあたりのメッセージ数
+SEGMENT_COMPRESSION = "auto"   # "auto"（zstandard があればzstd、無ければgzip）/ "zstd" / "gzip"
+SEGMENT_ZSTD_LEVEL = 10
+SEGMENT_GZIP_LEVEL = 6
+SEGMENT_SUFFIX = ".segments"   # セグメントを置くフォルダ（{room_id}_{ルーム名}.segments/）
+
+# SQLiteアーカイブ（全文検索用。空文字ならSQLiteへは書き込まない）
+SQLITE_ARCHIVE_NAME = "archive.sqlite3"
+SQLITE_BATCH_SIZE = 500   # 1トランザクションでまとめて書き込むメッセージ数
+
+# エクスポート方式（"selenium": 画面をスクレイピング / "api": Chatwork APIで取得）
+EXPORT_BACKEND = "selenium"
+CHATWORK_API_URL = "https://api.chatwork.com/v2/"
+CHATWORK_API_TOKEN = os.environ.get("CHATWORK_API_TOKEN", "")
+API_MESSAGE_LIMIT = 100   # APIが1回に返す最新メッセージの上限（これを超える分は取得できない）
+API_MIN_REMAINING = 5  # レート制限の残り回数がこれ以下になったらリセットまで待つ
+
+# 並列エクスポート（ログイン後のCookieを複数のヘッドレスChromeに配り、ルームを分担して処理）
+PARALLEL_WORKERS = 1   # 同時に動かすブラウザ数（1なら従来どおり1つのブラウザで順番に処理）
+ROOM_INTERVAL = 3      # 各ブラウザがルーム間で空ける秒数（サーバー負荷への配慮）
+
+# エクスポート用ブラウザ（ログインだけ表示ありのChromeで行い、その後は軽量なヘッドレスChromeで処理する）
+HEADLESS_EXPORT = True
+CHROME_PROFILE_DIR = "chrome_profile"   # ログイン状態を保存するuser-data-dir（空文字なら保存しない）
+LIGHTWEIGHT_BROWSER = True              # 画像・動画・フォント・アニメーションを止め、eagerでページを読み込む
+BLOCKED_URL_PATTERNS = [
+    "*.png", "*.jpg", "*.jpeg", "*.gif", "*.webp", "*.svg", "*.ico",
+    "*.mp4", "*.webm", "*.mp3", "*.m4a",
+    "*.woff", "*.woff2", "*.ttf", "*.otf",
+    "*download_file.php*preview=1*"     # タイムラインのプレビュー画像（添付はrequestsで別途取得する）
+]
+DISABLE_ANIMATIONS_SCRIPT = """
+document.addEventListener('DOMContentLoaded', () => {
+    const style = document.createElement('style');
+    style.textContent = '*, *::before, *::after { animation: none !important; transition: none !important; scroll-behavior: auto !important; }';
+    document.head.appendChild(style);
+});
+"""
+
+# ログインセッションの保存（Cookieを暗号化して保存し、有効な間は手動ログインを省略する。要 cryptography）
+SESSION_STORE_FILE = "chatwork_session.enc"   # 空文字なら保存しない
+SESSION_KEY_FILE = "chatwork_session.key"     # 環境変数 CHATWORK_SESSION_KEY が無い場合に使う鍵（初回に自動作成）
+SESSION_KEY_ENV = "CHATWORK_SESSION_KEY"
+
+# ルームカタログ（検出したルームを記録し、次回以降の一覧の読み込みと変化の検出に使う）
+ROOM_CATALOG_NAME = "_room_catalog.json"
+SKIP_UNCHANGED_ROOMS = False    # 一覧の表示内容（未読数・最新メッセージ）が前回のエクスポート時と同じルームを飛ばす
+ROOM_LIST_MAX_SCROLLS = 20      # ルーム一覧をスクロールする回数の上限
+ROOM_LIST_IDLE_ROUNDS = 2       # 新しいルームがこの回数続けて増えなければ読み込み完了とみなす
+ROOM_LIST_LOAD_TIMEOUT = 3.0    # スクロール後、一覧の件数か高さが変わるまで待つ最大秒数（変わらなければその回を増加なしと数える）
+
+# チェックポイント（クラッシュやセッション切れの後に --resume で続きから再開する）
+CHECKPOINT_NAME = "_checkpoint.json"
+CHECKPOINT_EVERY = 25   # ルーム内で何件書き出すごとにチェックポイントを保存するか
+
+# パイプライン実行（ブラウザ操作・ダウンロード・書き出しをasyncioで重ねて進め、ルーム間も待たずに次へ進む）
+EXPORT_PIPELINE = False
+PIPELINE_QUEUE_SIZE = 500   # ブラウザ→書き出し間のキューと、ダウンロード待ちで保留するメッセージ数の上限
+
+# 計測（処理ごとの所要時間・WebDriver呼び出し・転送量を _metrics_*.json / _metrics.prom に出力）
+METRICS_ENABLED = True
+
+class Metrics:
+    """処理ごとの呼び出し回数・所要時間（p50/p95）と、転送バイト数などのカウンタを集計"""
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.timings = {}
+        self.counters = {}
+        self.samples = {}
+    
+    def record(self, name, seconds):
+        with self._lock:
+            self.timings.setdefault(name, []).append(seconds)
+    
+    def observe(self, name, value):
+        """時間以外の値（メモリ使用量など）を記録"""
+        with self._lock:
+            self.samples.setdefault(name, []).append(value)
+    
+    def increment(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+    
+    @contextmanager
+    def span(self, name):
+        """with METRICS.span("phase.xxx"): の範囲の所要時間を記録"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start)
+    
+    def timed(self, name):
+        """関数の所要時間を記録するデコレータ"""
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.span(name):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+    
+    @staticmethod
+    def _percentile(sorted_values, ratio):
+        index = max(0, math.ceil(ratio * len(sorted_values)) - 1)
+        return sorted_values[index]
+    
+    def summary(self):
+        with self._lock:
+            timings = {name: sorted(values) for name, values in self.timings.items()}
+            samples = {name: sorted(values) for name, values in self.samples.items()}
+            counters = dict(self.counters)
+        
+        spans = {}
+        for name, values in sorted(timings.items()):
+            spans[name] = {
+                "count": len(values),
+                "total_sec": sum(values),
+                "p50_sec": self._percentile(values, 0.50),
+                "p95_sec": self._percentile(values, 0.95),
+                "max_sec": values[-1]
+            }
+        observed = {
+            name: {
+                "count": len(values),
+                "p50": self._percentile(values, 0.50),
+                "p95": self._percentile(values, 0.95),
+                "max": values[-1]
+            }
+            for name, values in sorted(samples.items())
+        }
+        return {"generated_at": datetime.now().isoformat(), "spans": spans, "samples": observed, "counters": counters}
+    
+    def to_prometheus(self, summary=None):
+        """Prometheus node_exporter の textfile collector 形式"""
+        summary = summary or self.summary()
+        lines = [
+            "# HELP chatwork_backup_span_seconds Duration of backup phases and WebDriver calls.",
+            "# TYPE chatwork_backup_span_seconds summary"
+        ]
+        for name, stats in summary["spans"].items():
+            lines.append(f'chatwork_backup_span_seconds{{span="{name}",quantile="0.5"}} {stats["p50_sec"]:.6f}')
+            lines.append(f'chatwork_backup_span_seconds{{span="{name}",quantile="0.95"}} {stats["p95_sec"]:.6f}')
+            lines.append(f'chatwork_backup_span_seconds_sum{{span="{name}"}} {stats["total_sec"]:.6f}')
+            lines.append(f'chatwork_backup_span_seconds_count{{span="{name}"}} {stats["count"]}')
+        lines.append("# HELP chatwork_backup_sample Observed values such as browser memory per room.")
+        lines.append("# TYPE chatwork_backup_sample summary")
+        for name, stats in summary["samples"].items():
+            lines.append(f'chatwork_backup_sample{{name="{name}",quantile="0.5"}} {stats["p50"]:.3f}')
+            lines.append(f'chatwork_backup_sample{{name="{name}",quantile="0.95"}} {stats["p95"]:.3f}')
+            lines.append(f'chatwork_backup_sample_count{{name="{name}"}} {stats["count"]}')
+        lines.append("# HELP chatwork_backup_events_total Counters such as bytes downloaded and retries.")
+        lines.append("# TYPE chatwork_backup_events_total counter")
+        for name, value in sorted(summary["counters"].items()):
+            lines.append(f'chatwork_backup_events_total{{name="{name}"}} {value}')
+        return "\n".join(lines) + "\n"
+    
+    def write(self, base_dir, suffix=""):
+        """計測結果をJSONとPrometheus形式で書き出し、JSONのパスを返す"""
+        summary = self.summary()
+        stamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+        json_path = Path(base_dir) / f"_metrics_{stamp}{suffix}.json"
+        write_json_atomic(json_path, summary)
+        
+        prom_path = Path(base_dir) / f"_metrics{suffix}.prom"
+        tmp_path = prom_path.with_name(prom_path.name + ".tmp")
+        tmp_path.write_text(self.to_prometheus(summary), encoding="utf-8")
+        os.replace(tmp_path, prom_path)
+        return json_path
+    
+    def print_summary(self):
+        summary = self.summary()
+        print(f"\n{'='*78}")
+        print("⏱️  処理時間の内訳")
+        print(f"{'='*78}")
+        print(f"{'処理':<34} {'回数':>8} {'合計(秒)':>10} {'p50(ms)':>10} {'p95(ms)':>10}")
+        for name, stats in summary["spans"].items():
+            print(f"{name[:34]:<34} {stats['count']:>8} {stats['total_sec']:>10.1f} "
+                  f"{stats['p50_sec'] * 1000:>10.1f} {stats['p95_sec'] * 1000:>10.1f}")
+        if summary["samples"]:
+            print(f"{'-'*78}")
+            print(f"{'計測値':<34} {'回数':>8} {'p50':>10} {'p95':>10} {'最大':>10}")
+            for name, stats in summary["samples"].items():
+                print(f"{name[:34]:<34} {stats['count']:>8} {stats['p50']:>10.1f} "
+                      f"{stats['p95']:>10.1f} {stats['max']:>10.1f}")
+        if summary["counters"]:
+            print(f"{'-'*78}")
+            for name, value in sorted(summary["counters"].items()):
+                print(f"{name:<34} {value:>8}")
+        print(f"{'='*78}")
+
+METRICS = Metrics()
+
+def instrument_driver(driver):
+    """WebDriverの全コマンド（driver.execute）の回数と所要時間を記録する"""
+    original_execute = driver.execute
+    
+    def execute(driver_command, params=None):
+        with METRICS.span(f"webdriver.{driver_command}"):
+            return original_execute(driver_command, params)
+    
+    driver.execute = execute
+    return driver
+
+def report_metrics(base_dir, suffix=""):
+    """計測結果を書き出して内訳を表示"""
+    if not METRICS_ENABLED:
+        return
+    METRICS.print_summary()
+    try:
+        path = METRICS.write(base_dir, suffix)
+        print(f"📈 計測結果: {path}")
+    except OSError as e:
+        print(f"⚠️ 計測結果を書き出せません: {e}")
+
+def normalize_text(text):
+    """全角・半角カナや英数字の揺れを吸収する正規化（NFKC + 大文字小文字の無視）"""
+    return unicodedata.normalize("NFKC", text or "").casefold()
+
+class KeywordAutomaton:
+    """Aho-Corasick法で多数のキーワードを1回の走査で照合する"""
+    
+    def __init__(self, keywords):
+        self._goto = [{}]
+        self._fail = [0]
+        self._output = [None]
+        
+        for keyword in keywords:
+            normalized = normalize_text(keyword).strip()
+            if not normalized:
+                continue
+            state = 0
+            for char in normalized:
+                if char not in self._goto[state]:
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._output.append(None)
+                    self._goto[state][char] = len(self._goto) - 1
+                state = self._goto[state][char]
+            # 正規化後に同じになるキーワードは最初のものを報告する
+            if self._output[state] is None:
+                self._output[state] = keyword
+        
+        # 失敗遷移を幅優先で構築（一致が無ければ失敗先の出力を引き継ぐ）
+        pending = deque(self._goto[0].values())
+        while pending:
+            state = pending.popleft()
+            for char, next_state in self._goto[state].items():
+                pending.append(next_state)
+                fallback = self._fail[state]
+                while fallback and char not in self._goto[fallback]:
+                    fallback = self._fail[fallback]
+                self._fail[next_state] = self._goto[fallback].get(char, 0)
+                if self._output[next_state] is None:
+                    self._output[next_state] = self._output[self._fail[next_state]]
+    
+    def __bool__(self):
+        return len(self._goto) > 1
+    
+    def search(self, text):
+        """最初に見つかったキーワード（元の表記）を返す。無ければNone"""
+        state = 0
+        for char in normalize_text(text):
+            while state and char not in self._goto[state]:
+                state = self._fail[state]
+            state = self._goto[state].get(char, 0)
+            if self._output[state] is not None:
+                return self._output[state]
+        return None
+
+def load_rule_file(path):
+    """フィルタールールのファイルを読み込む（空行・#コメントは無視）"""
+    if not path:
+        return []
+    with open(path, "r", encoding="utf-8") as f:
+        return [line.strip() for line in f if line.strip() and not line.strip().startswith("#")]
+
+class RoomFilter:
+    """対象・除外キーワードとルームIDの許可リストを一度だけコンパイルしてルームを判定"""
+    
+    def __init__(self, keywords, exclude_keywords=(), rid_allowlist=()):
+        self.keyword_count = len(keywords)
+        self.exclude_count = len(exclude_keywords)
+        self._include = KeywordAutomaton(keywords)
+        self._exclude = KeywordAutomaton(exclude_keywords)
+        self._rid_allowlist = {str(rid).strip() for rid in rid_allowlist}
+    
+    @classmethod
+    def from_settings(cls):
+        return cls(
+            TARGET_KEYWORDS + load_rule_file(KEYWORD_FILE),
+            EXCLUDE_KEYWORDS + load_rule_file(EXCLUDE_KEYWORD_FILE),
+            [str(rid) for rid in RID_ALLOWLIST] + load_rule_file(RID_ALLOWLIST_FILE)
+        )
+    
+    def describe(self):
+        return f"対象キーワード {self.keyword_count}件 / 除外キーワード {self.exclude_count}件 / 許可ルームID {len(self._rid_allowlist)}件"
+    
+    def match(self, room_name, rid=None):
+        """(処理するか, 一致したルール) を返す"""
+        if rid is not None and str(rid) in self._rid_allowlist:
+            return True, f"rid{rid}"
+        
+        excluded = self._exclude.search(room_name) if self._exclude else None
+        if excluded:
+            return False, f"除外:{excluded}"
+        
+        keyword = self._include.search(room_name) if self._include else None
+        if keyword:
             return True, keyword
-    return False, None
+        return False, None
+
+_room_filter = None
+
+def get_room_filter():
+    """設定から作ったRoomFilterを返す（初回のみコンパイル）"""
+    global _room_filter
+    if _room_filter is None:
+        _room_filter = RoomFilter.from_settings()
+    return _room_filter
+
+def should_process_room(room_name, rid=None):
+    """ルーム名が対象キーワードを含むかチェック（除外キーワード・ルームID許可リストも考慮）"""
+    return get_room_filter().match(room_name, rid)
+
+def create_login_driver():
+    """手動ログイン用の表示ありChromeを起動（プロファイルを保存してログイン状態を次回に持ち越す）"""
+    options = webdriver.ChromeOptions()
+    options.add_argument("--disable-blink-features=AutomationControlled")
+    options.add_argument("--start-maximized")
+    if CHROME_PROFILE_DIR:
+        options.add_argument(f"--user-data-dir={Path(CHROME_PROFILE_DIR).resolve()}")
+    
+    driver = webdriver.Chrome(options=options)
+    if METRICS_ENABLED:
+        instrument_driver(driver)
+    return driver
+
+def trim_browser(driver):
+    """画像・動画・フォントの読み込みとアニメーションを止める（メッセージの解析には不要）"""
+    try:
+        driver.execute_cdp_cmd("Network.enable", {})
+        driver.execute_cdp_cmd("Network.setBlockedURLs", {"urls": BLOCKED_URL_PATTERNS})
+        driver.execute_cdp_cmd("Emulation.setEmulatedMedia", {
+            "features": [{"name": "prefers-reduced-motion", "value": "reduce"}]
+        })
+        driver.execute_cdp_cmd("Page.addScriptToEvaluateOnNewDocument", {"source": DISABLE_ANIMATIONS_SCRIPT})
+    except WebDriverException as e:
+        print(f"⚠️ ブラウザの軽量化設定に失敗しました（通常の設定で続行）: {e}")
+
+def create_export_driver(cookies=None, user_data_dir=None):
+    """エクスポート用のヘッドレスChromeを起動（ログイン済みのプロファイル・Cookieを引き継ぐ）"""
+    options = webdriver.ChromeOptions()
+    options.add_argument("--headless=new")
+    options.add_argument("--disable-blink-features=AutomationControlled")
+    options.add_argument("--window-size=1920,1080")
+    if user_data_dir:
+        options.add_argument(f"--user-data-dir={Path(user_data_dir).resolve()}")
+    if LIGHTWEIGHT_BROWSER:
+        # DOMの構築が終われば操作を始める（画像などの読み込み完了を待たない）
+        options.page_load_strategy = "eager"
+        options.add_experimental_option("prefs", {"profile.managed_default_content_settings.images": 2})
+    
+    driver = webdriver.Chrome(options=options)
+    if METRICS_ENABLED:
+        instrument_driver(driver)
+    if LIGHTWEIGHT_BROWSER:
+        trim_browser(driver)
+    
+    # セッションCookieはプロファイルに残らないため改めて設定する
+    if cookies:
+        add_cookies(driver, cookies)
+    
+    return driver
+
+def browser_memory(driver):
+    """ブラウザのJSヒープ使用量（MB）とDOMノード数（取得できなければNone）"""
+    try:
+        driver.execute_cdp_cmd("Performance.enable", {})
+        metrics = driver.execute_cdp_cmd("Performance.getMetrics", {})["metrics"]
+    except (WebDriverException, AttributeError, KeyError):
+        return None
+    
+    values = {metric["name"]: metric["value"] for metric in metrics}
+    return {
+        "js_heap_mb": values.get("JSHeapUsedSize", 0) / 1024 / 1024,
+        "dom_nodes": int(values.get("Nodes", 0))
+    }
+
+def record_browser_memory(driver):
+    """ルーム読み込み後のブラウザのメモリを表示して計測に記録"""
+    memory = browser_memory(driver)
+    if not memory:
+        return
+    METRICS.observe("browser.js_heap_mb", memory["js_heap_mb"])
+    METRICS.observe("browser.dom_nodes", memory["dom_nodes"])
+    print(f"  🧠 ブラウザ: JSヒープ {memory['js_heap_mb']:.0f} MB / DOMノード {memory['dom_nodes']}")
 
 def login_chatwork(driver):
     """Chatworkにログイン（手動）"""
-    driver.get("https://www.chatwork.com/login.php")
+    driver.get(f"{CHATWORK_URL}login.php")
     
     print("\n" + "="*60)
     print("🔐 手動ログインしてください")
@@ -48,115 +542,250 @@ def login_chatwork(driver):
     except:
         print("⚠️  ログインURLを確認できませんが続行します")
 
-def get_all_room_urls(driver):
-    """サイドバーから全ルームURLを自動取得"""
-    print("\n🔍 全ルームを検索中...")
+# ルーム一覧を最下部までスクロールし、表示中のルーム（rid・名前・一覧の表示内容）を返す
+# arguments: ルームリストのセレクタ, ルーム要素のセレクタ, 旧UIのリンクのセレクタ
+ROOM_LIST_SCRIPT = """
+const [listSelectors, itemSelectors, linkSelectors] = arguments;
+let list = null;
+for (const selector of listSelectors) {
+    list = document.querySelector(selector);
+    if (list) break;
+}
+if (list) list.scrollTop = list.scrollHeight;
+
+const rooms = [];
+for (const selector of itemSelectors) {
+    const items = document.querySelectorAll(selector);
+    if (!items.length) continue;
+    for (const item of items) {
+        const rid = item.getAttribute('data-rid');
+        if (!rid) continue;
+        rooms.push({
+            rid: rid,
+            name: item.getAttribute('aria-label') || 'Unknown',
+            // 未読数や最新メッセージの表示が変わればルームが更新されたとみなす
+            indicator: (item.innerText || '').replace(/\\s+/g, ' ').trim()
+        });
+    }
+    break;
+}
+
+// 旧UIにも対応（念のため）
+if (!rooms.length) {
+    for (const selector of linkSelectors) {
+        const links = document.querySelectorAll(selector);
+        if (!links.length) continue;
+        for (const link of links) {
+            const href = link.getAttribute('href') || '';
+            if (!href.includes('rid')) continue;
+            rooms.push({rid: href.split('rid').pop(), name: (link.textContent || '').trim() || 'Unknown', indicator: ''});
+        }
+        break;
+    }
+}
+return {list: list ? list.tagName : null, rooms: rooms, height: list ? list.scrollHeight : 0};
+"""
+
+# スクロール後の遅延読み込みで一覧の件数か高さが変わるまで待つ（execute_async_script用）
+# arguments: [一覧のセレクタ, ルーム要素のセレクタ, リンクのセレクタ, スクロール直後の高さ, 最大待機ミリ秒, コールバック]
+ROOM_LIST_WAIT_SCRIPT = """
+const [listSelectors, itemSelectors, linkSelectors, previousHeight, timeoutMs] = arguments;
+const done = arguments[arguments.length - 1];
+
+let list = null;
+for (const selector of listSelectors) {
+    list = document.querySelector(selector);
+    if (list) break;
+}
+const countItems = () => {
+    for (const selector of itemSelectors.concat(linkSelectors)) {
+        const count = document.querySelectorAll(selector).length;
+        if (count) return count;
+    }
+    return 0;
+};
+const previousCount = countItems();
+const changed = () => countItems() !== previousCount || (list !== null && list.scrollHeight !== previousHeight);
+
+let finished = false;
+let timer = null;
+const observer = new MutationObserver(() => {
+    if (changed()) finish(true);
+});
+const finish = (result) => {
+    if (finished) return;
+    finished = true;
+    observer.disconnect();
+    clearTimeout(timer);
+    done({changed: result, count: countItems()});
+};
+
+if (changed()) {
+    finish(true);
+} else {
+    observer.observe(list || document.body, {childList: true, subtree: true});
+    timer = setTimeout(() => finish(changed()), timeoutMs);
+    // 既に最下部にいる場合はスクロールイベントを明示的に発火させて追加読み込みを促す
+    if (list) list.dispatchEvent(new Event('scroll'));
+}
+"""
+
+ROOM_LIST_SELECTORS = [
+    "[role='tablist']",
+    "[role='list']",
+    "#_roomListItems",
+    ".roomList",
+    "[class*='roomList']"
+]
+ROOM_ITEM_SELECTORS = [
+    "li[data-rid]",
+    "li[role='tab'][data-rid]",
+    "[data-rid]"
+]
+ROOM_LINK_SELECTORS = [
+    "a[href*='#!rid']",
+    "a[href*='rid']",
+    "._roomLink"
+]
+
+class RoomCatalog:
+    """検出したルームの台帳（rid・名前・初回検出日時・最終エクスポート日時・一覧の表示内容）"""
     
-    # チャット画面に移動
-    driver.get("https://www.chatwork.com/")
-    time.sleep(5)
+    def __init__(self, path):
+        self.path = Path(path)
+        self.rooms = {}
+        if self.path.exists():
+            try:
+                with open(self.path, "r", encoding="utf-8") as f:
+                    self.rooms = json.load(f).get("rooms", {})
+            except (OSError, ValueError) as e:
+                print(f"⚠️ ルームカタログを読み込めません ({self.path.name}): {e}")
     
-    # ルームリストをスクロールして全て表示
-    print("  ルームリストをスクロール中...")
-    room_list_selectors = [
-        "[role='tablist']",
-        "[role='list']",
-        "#_roomListItems",
-        ".roomList",
-        "[class*='roomList']"
-    ]
+    def save(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        write_json_atomic(self.path, {"updated_at": datetime.now().isoformat(), "rooms": self.rooms})
     
-    room_list = None
-    for selector in room_list_selectors:
-        try:
-            room_list = driver.find_element(By.CSS_SELECTOR, selector)
-            print(f"  ✓ ルームリスト検出: {selector}")
-            # スクロールして全て読み込み
-            for _ in range(20):
-                driver.execute_script("arguments[0].scrollTop = arguments[0].scrollHeight", room_list)
-                time.sleep(0.5)
-            break
-        except:
-            continue
+    def update(self, rooms):
+        """今回検出したルームを記録し、新規ルームの数を返す"""
+        now = datetime.now().isoformat()
+        new_count = 0
+        for room in rooms:
+            rid = str(room["rid"])
+            entry = self.rooms.get(rid)
+            if entry is None:
+                entry = self.rooms[rid] = {"rid": rid, "first_seen": now, "last_exported": None}
+                new_count += 1
+            entry.update({"name": room["name"], "last_seen": now, "indicator": room.get("indicator", "")})
+        self.save()
+        return new_count
     
-    # data-rid属性を持つli要素を取得（新UI対応）
-    print("\n  ルーム要素を検索中...")
+    def is_unchanged(self, rid):
+        """前回のエクスポート時から一覧の表示内容（最新メッセージの表示）が変わっていないか"""
+        entry = self.rooms.get(str(rid))
+        return bool(
+            entry and entry.get("last_exported") and entry.get("indicator")
+            and entry.get("exported_indicator") == entry["indicator"]
+        )
     
-    room_elements = []
-    element_selectors = [
-        "li[data-rid]",
-        "li[role='tab'][data-rid]",
-        "[data-rid]"
-    ]
+    def mark_exported(self, rid):
+        entry = self.rooms.get(str(rid))
+        if entry is None:
+            return
+        entry["last_exported"] = datetime.now().isoformat()
+        entry["exported_indicator"] = entry.get("indicator")
+        entry.pop("needs_browser_export", None)
+        self.save()
     
-    for selector in element_selectors:
+    def mark_needs_browser_export(self, rid):
+        """APIでは取りきれなかったルームとして記録（ブラウザ版でエクスポートするまで残す）"""
+        entry = self.rooms.get(str(rid))
+        if entry is None:
+            return
+        entry["needs_browser_export"] = True
+        self.save()
+
+_room_catalog = None
+
+def get_room_catalog():
+    global _room_catalog
+    if _room_catalog is None:
+        _room_catalog = RoomCatalog(Path(BASE_DOWNLOAD_DIR) / ROOM_CATALOG_NAME)
+    return _room_catalog
+
+def skip_unchanged_rooms(rooms, rid_of=lambda room: room["rid"]):
+    """前回のエクスポートから更新の無いルームを除く（SKIP_UNCHANGED_ROOMS が有効な場合のみ）"""
+    if not SKIP_UNCHANGED_ROOMS:
+        return rooms
+    catalog = get_room_catalog()
+    changed = [room for room in rooms if not catalog.is_unchanged(rid_of(room))]
+    if len(changed) < len(rooms):
+        print(f"💤 前回のエクスポートから更新の無いルームをスキップ: {len(rooms) - len(changed)}個")
+    return changed
+
+def read_room_list(driver):
+    """ルーム一覧をスクロールしながら読み込み、新しいridが出なくなったら止める
+    
+    スクロールのたびに一覧の件数か高さが変わるまで最大 ROOM_LIST_LOAD_TIMEOUT 秒待ち、
+    変わらないまま新しいルームも無かった回が ROOM_LIST_IDLE_ROUNDS 回続いたら完了とみなす。
+    """
+    rooms = {}
+    idle_rounds = 0
+    list_found = None
+    driver.set_script_timeout(ROOM_LIST_LOAD_TIMEOUT + 30)
+    
+    for _ in range(ROOM_LIST_MAX_SCROLLS):
+        result = driver.execute_script(
+            ROOM_LIST_SCRIPT, ROOM_LIST_SELECTORS, ROOM_ITEM_SELECTORS, ROOM_LINK_SELECTORS
+        ) or {}
+        list_found = list_found or result.get("list")
+        if not list_found:
+            break
+        
+        before = len(rooms)
+        for room in result.get("rooms", []):
+            rooms[room["rid"]] = room
+        
+        # 遅延読み込みが遅い場合に一覧の途中で打ち切らないよう、スクロール後の変化を待ってから判定する
         try:
-            elements = driver.find_elements(By.CSS_SELECTOR, selector)
-            if elements:
-                print(f"    ✓ {selector}: {len(elements)}個検出")
-                room_elements = elements
-                break
-        except:
-            continue
+            state = driver.execute_async_script(
+                ROOM_LIST_WAIT_SCRIPT, ROOM_LIST_SELECTORS, ROOM_ITEM_SELECTORS, ROOM_LINK_SELECTORS,
+                result.get("height", 0), int(ROOM_LIST_LOAD_TIMEOUT * 1000)
+            ) or {}
+        except WebDriverException as e:
+            print(f"  ⚠️ ルーム一覧の読み込み待ちに失敗: {e}")
+            state = {}
+        
+        idle_rounds = 0 if len(rooms) > before or state.get("changed") else idle_rounds + 1
+        if idle_rounds >= ROOM_LIST_IDLE_ROUNDS:
+            break
     
-    # data-rid からURLとルーム名を取得（Stale対策：即座にデータ抽出）
-    room_data = []
+    if list_found:
+        print(f"  ✓ ルームリスト検出: {list_found.lower()}")
+    return list(rooms.values())
+
+@METRICS.timed("phase.discover_rooms")
+def get_all_room_urls(driver):
+    """サイドバーから全ルームURLを自動取得"""
+    print("\n🔍 全ルームを検索中...")
     
-    if room_elements:
-        for elem in room_elements:
-            try:
-                rid = elem.get_attribute("data-rid")
-                if rid:
-                    # ChatworkのURL形式でURLを生成
-                    room_url = f"https://www.chatwork.com/#!rid{rid}"
-                    
-                    # ルーム名を取得
-                    room_name = "Unknown"
-                    try:
-                        label = elem.get_attribute("aria-label")
-                        if label:
-                            room_name = label
-                    except:
-                        pass
-                    
-                    room_data.append({
-                        "url": room_url,
-                        "name": room_name,
-                        "rid": rid
-                    })
-            except StaleElementReferenceException:
-                # 古い要素になった場合はスキップ
-                continue
+    # チャット画面に移動（ルーム一覧が表示されるまで待つ）
+    driver.get(CHATWORK_URL)
+    try:
+        WebDriverWait(driver, 15).until(
+            lambda d: d.find_elements(By.CSS_SELECTOR, ", ".join(ROOM_ITEM_SELECTORS + ROOM_LINK_SELECTORS))
+        )
+    except TimeoutException:
+        print("  ⚠️ ルーム一覧の表示を確認できませんが続行します")
+    probe_layout(driver, ["room_list", "room_item", "room_link"])
     
-    # 旧UIにも対応（念のため）
-    if not room_data:
-        print("\n  旧UI形式も試行中...")
-        old_selectors = [
-            "a[href*='#!rid']",
-            "a[href*='rid']",
-            "._roomLink"
-        ]
-        
-        for selector in old_selectors:
-            try:
-                links = driver.find_elements(By.CSS_SELECTOR, selector)
-                if links:
-                    print(f"    ✓ {selector}: {len(links)}個検出")
-                    for link in links:
-                        try:
-                            href = link.get_attribute("href")
-                            name = link.text.strip() or "Unknown"
-                            if href and "rid" in href:
-                                rid = href.split("rid")[-1]
-                                room_data.append({
-                                    "url": href,
-                                    "name": name,
-                                    "rid": rid
-                                })
-                        except StaleElementReferenceException:
-                            continue
-            except:
-                continue
+    # ルームリストをスクロールして全て表示（新しいルームが出なくなったら止める）
+    print("  ルームリストをスクロール中...")
+    room_data = read_room_list(driver)
+    
+    # 新規ルームの把握と、前回のエクスポートからの変化の検出に使う
+    new_count = get_room_catalog().update(room_data)
+    if room_data:
+        print(f"  🗂️ ルームカタログ: 新規 {new_count}個 / 既知 {len(room_data) - new_count}個")
     
     # 手動入力モードへのフォールバック
     if not room_data:
@@ -166,13 +795,13 @@ def get_all_room_urls(driver):
     # フィルタリング処理
     print(f"\n📊 合計 {len(room_data)}個のルームを検出")
     print(f"\n🔍 対象キーワードでフィルタリング中...")
-    print(f"   キーワード: {', '.join(TARGET_KEYWORDS)}")
+    print(f"   {get_room_filter().describe()}")
     
     filtered_rooms = []
     skipped_rooms = []
     
     for room in room_data:
-        should_process, matched_keyword = should_process_room(room["name"])
+        should_process, matched_keyword = should_process_room(room["name"], room["rid"])
         if should_process:
             filtered_rooms.append(room)
             print(f"  ✓ [{matched_keyword}] {room['name'][:40]} (rid{room['rid']})")
@@ -190,159 +819,998 @@ def get_all_room_urls(driver):
         if len(skipped_rooms) > 20:
             print(f"    ... 他 {len(skipped_rooms) - 20} 件")
     
-    return [room["url"] for room in filtered_rooms]
+    filtered_rooms = skip_unchanged_rooms(filtered_rooms)
+    return [f"{CHATWORK_URL}#!rid{room['rid']}" for room in filtered_rooms]
 
-def get_session_cookies(driver):
-    """SeleniumのCookieをrequestsセッションに転送"""
+def session_from_cookies(cookies):
+    """Cookieのリストからrequestsセッションを作る"""
     session = requests.Session()
-    selenium_cookies = driver.get_cookies()
     
-    for cookie in selenium_cookies:
+    # Keep-Aliveの接続を並列ダウンロードで使い回せるようプールを拡張
+    adapter = HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    
+    for cookie in cookies:
         session.cookies.set(cookie['name'], cookie['value'], domain=cookie.get('domain'))
     
     return session
 
+def get_session_cookies(driver):
+    """SeleniumのCookieをrequestsセッションに転送"""
+    return session_from_cookies(driver.get_cookies())
+
+def add_cookies(driver, cookies):
+    """ブラウザにCookieを設定（Cookieはドメインを開いてからでないと設定できない）"""
+    driver.get(CHATWORK_URL)
+    for cookie in cookies:
+        try:
+            driver.add_cookie(cookie)
+        except WebDriverException:
+            continue
+    return driver
+
+def session_store_key():
+    """セッション保存用の暗号鍵（環境変数が無ければ鍵ファイルを読み込み、無ければ作成する）"""
+    key = os.environ.get(SESSION_KEY_ENV)
+    if key:
+        return key.encode()
+    
+    key_path = Path(SESSION_KEY_FILE)
+    if key_path.exists():
+        return key_path.read_bytes().strip()
+    
+    key = Fernet.generate_key()
+    # 所有者だけが読めるように作成する
+    fd = os.open(key_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(fd, "wb") as f:
+        f.write(key)
+    print(f"🔑 セッション保存用の鍵を作成しました: {key_path}")
+    return key
 
+def save_session(cookies):
+    """ログイン済みのCookieを暗号化して保存"""
+    if not SESSION_STORE_FILE:
+        return
+    if Fernet is None:
+        print("⚠️ cryptography が未インストールのためセッションを保存しません（pip install cryptography）")
+        return
+    
+    payload = json.dumps({"saved_at": datetime.now().isoformat(), "cookies": cookies}).encode("utf-8")
+    token = Fernet(session_store_key()).encrypt(payload)
+    
+    path = Path(SESSION_STORE_FILE)
+    tmp_path = path.with_name(path.name + ".tmp")
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "wb") as f:
+        f.write(token)
+    os.replace(tmp_path, path)
 
-def download_file_from_chatwork(session, file_url, filename, save_dir):
-    """Chatworkからファイルをダウンロード（相対パス対応）"""
+def load_session():
+    """保存済みのCookieを復号して返す（無い・復号できない場合はNone）"""
+    path = Path(SESSION_STORE_FILE) if SESSION_STORE_FILE else None
+    if not path or not path.exists() or Fernet is None:
+        return None
+    
     try:
-        # 相対パスを絶対パスに変換
-        if file_url.startswith('gateway/'):
-            file_url = f"https://www.chatwork.com/{file_url}"
-        
-        # ファイル名をサニタイズ（Windowsで使えない文字を除去）
-        safe_filename = re.sub(r'[<>:"/\\|?*]', '_', filename)
-        
-        save_path = Path(save_dir) / safe_filename
-        save_path.parent.mkdir(parents=True, exist_ok=True)
-        
-        response = session.get(file_url, stream=True, timeout=30)
-        response.raise_for_status()
-        
-        with open(save_path, 'wb') as f:
-            for chunk in response.iter_content(chunk_size=8192):
-                f.write(chunk)
-        
-        # 絶対パスを返す
-        absolute_path = str(save_path.resolve())
-        print(f"    ✓ ダウンロード: {safe_filename}")
-        return absolute_path
-    except Exception as e:
-        print(f"    ✗ ダウンロード失敗 ({filename}): {e}")
+        payload = json.loads(Fernet(session_store_key()).decrypt(path.read_bytes()))
+    except (InvalidToken, ValueError, OSError) as e:
+        print(f"⚠️ 保存済みのセッションを読み込めません: {str(e) or type(e).__name__}")
         return None
+    
+    print(f"🔑 保存済みのセッションを確認中（保存日時: {payload.get('saved_at')}）")
+    return payload.get("cookies") or None
 
-def scroll_to_load_all_messages(driver):
-    """チャット履歴を全て読み込むまでスクロール（遅延ロード対応）"""
-    print("📜 過去のメッセージを読み込み中...")
+def session_is_valid(session):
+    """ログイン済みか軽いリクエストで確認（未ログインならログイン画面にリダイレクトされる）"""
+    try:
+        response = session.get(CHATWORK_URL, timeout=10)
+    except requests.RequestException as e:
+        print(f"⚠️ セッションの確認に失敗しました: {e}")
+        return False
+    return response.ok and "login" not in urlparse(response.url).path
+
+def open_logged_in_browser():
+    """ログイン済みのブラウザとrequestsセッションを用意する
     
-    # チャットエリアを特定
-    chat_area = None
-    selectors = [
-        "div.sc-eBAZHg.kzmpjh",
-        "div[tabindex='1']",
-        "#_chatText",
-        ".cw_chat_body",
-        "[role='log']",
-        ".chatTimeLineContainer",
-        "#_timeLine"
-    ]
+    保存済みのセッションが有効なら手動ログインを省略し、期限切れの場合だけ手動ログインする。
+    """
+    cookies = load_session()
+    if cookies:
+        session = session_from_cookies(cookies)
+        if session_is_valid(session):
+            print("✅ 保存済みのセッションでログインしました（手動ログインを省略）")
+            if HEADLESS_EXPORT:
+                return create_export_driver(cookies, user_data_dir=CHROME_PROFILE_DIR), session
+            return add_cookies(create_login_driver(), cookies), session
+        print("⌛ 保存済みのセッションは期限切れです")
     
-    for selector in selectors:
-        try:
-            chat_area = driver.find_element(By.CSS_SELECTOR, selector)
-            print(f"  ✓ チャットエリア検出: {selector}")
-            break
-        except:
-            continue
+    if not sys.stdin.isatty():
+        raise RuntimeError("有効なセッションが無く、手動ログインもできません（端末から一度実行してログインしてください）")
     
-    if not chat_area:
-        print("  ⚠️ チャットエリアが見つかりません")
-        print("  スクロールなしで続行します（最近のメッセージのみ取得）")
-        time.sleep(3)
-        return
+    driver = create_login_driver()
+    try:
+        login_chatwork(driver)
+        cookies = driver.get_cookies()
+        session = session_from_cookies(cookies)
+        save_session(cookies)
+        
+        if HEADLESS_EXPORT:
+            print("🪶 ヘッドレスのエクスポート用ブラウザに切り替えます")
+            driver.quit()
+            driver = None
+            driver = create_export_driver(cookies, user_data_dir=CHROME_PROFILE_DIR)
+    except BaseException:
+        if driver:
+            driver.quit()
+        raise
+    
+    return driver, session
+
+class AttachmentDownloader:
+    """添付ファイルをスレッドプールでバックグラウンドダウンロード（DOM解析と並行実行）"""
     
-    previous_message_count = 0
-    no_change_count = 0
-    max_attempts = 100
-    wait_time = 2.5
+    def __init__(self, session, max_workers=DOWNLOAD_WORKERS, per_host_limit=DOWNLOAD_PER_HOST_LIMIT):
+        self.session = session
+        self.per_host_limit = per_host_limit
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="download")
+        self._host_slots = {}
+        self._futures = {}
+        self._lock = threading.Lock()
+        self._batch = None
     
-    print(f"  スクロール開始（最大{max_attempts}回試行）...")
+    def __enter__(self):
+        return self
     
-    for i in range(max_attempts):
-        # 現在のメッセージ数を取得（Stale対策：毎回再取得）
-        try:
-            messages = driver.find_elements(By.CSS_SELECTOR, "[data-mid]")
-            current_count = len(messages)
-        except:
-            print(f"    ⚠️ メッセージ取得エラー、再試行...")
-            time.sleep(1)
-            continue
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+    
+    def _host_slot(self, url):
+        """ホストごとの同時接続数を制限するセマフォ"""
+        host = urlparse(url).netloc if url else ""
+        with self._lock:
+            if host not in self._host_slots:
+                self._host_slots[host] = threading.BoundedSemaphore(self.per_host_limit)
+            return self._host_slots[host]
+    
+    def _download(self, attachment, download_dir):
+        url = attachment["chatwork_url"]
+        with self._host_slot(url):
+            local_path = fetch_attachment(self.session, attachment, download_dir)
+        attachment["local_absolute_path"] = local_path
+        return local_path
+    
+    def submit(self, message_id, attachment, download_dir):
+        """ダウンロードをキューに追加（完了時に attachment の local_absolute_path を埋める）
         
-        # チャットエリアを再取得（Stale対策）
+        batch() の中では溜めておき、抜けるときにまとめて開始する（その場合は None を返す）。
+        """
+        if self._batch is not None:
+            self._batch.append((message_id, attachment, download_dir))
+            return None
+        future = self._executor.submit(self._download, attachment, download_dir)
+        with self._lock:
+            self._futures.setdefault(message_id, []).append(future)
+        return future
+    
+    @contextmanager
+    def batch(self):
+        """この間に登録された添付ファイルを、抜けるときにまとめて並列にHEADで確認してからダウンロードする
+        
+        ダウンロードの直前に1件ずつHEADを送る往復を省き、塊ごとに必要な容量を空き容量と比べる。
+        （例外で抜けた場合、溜めた添付ファイルは破棄する）
+        """
+        self._batch = []
         try:
-            for selector in selectors:
+            yield
+        except BaseException:
+            self._batch = None
+            raise
+        items, self._batch = self._batch, None
+        if items:
+            self._start_batch(items)
+    
+    def _start_batch(self, items):
+        checkpoint = get_checkpoint()
+        pending = [
+            (attachment, download_dir) for _, attachment, download_dir in items
+            if not (checkpoint and checkpoint.downloaded_path(download_dir, attachment_cache_key(attachment)))
+        ]
+        if pending:
+            with METRICS.span("download.probe_batch"):
+                probe_attachments(self.session, pending)
+            # 重複排除ストアに登録済みのものはダウンロードしないので見積もりに含めない
+            planned = sum(
+                attachment.get("size") or 0 for attachment, download_dir in pending
+                if not (DEDUP_ATTACHMENTS and attachment_cache_key(attachment)
+                        and blob_store_for(download_dir).lookup(attachment_cache_key(attachment)))
+            )
+            free = shutil.disk_usage(pending[0][1]).free
+            if planned > free:
+                METRICS.increment("download.skipped_no_space", len(items))
+                print(f"    ❌ 空き容量が不足しているため、添付ファイル{len(items)}件をダウンロードしません"
+                      f"（必要 {planned / 1024 / 1024:.1f} MB / 空き {free / 1024 / 1024:.1f} MB）")
+                return
+        
+        for message_id, attachment, download_dir in items:
+            self.submit(message_id, attachment, download_dir)
+    
+    def pop_futures(self, message_id):
+        """指定メッセージのダウンロードFutureを取り出す"""
+        with self._lock:
+            return self._futures.pop(message_id, [])
+    
+    def wait(self):
+        """キュー済みの全ダウンロードの完了を待つ"""
+        with self._lock:
+            futures = [f for fs in self._futures.values() for f in fs]
+            self._futures.clear()
+        wait_futures(futures)
+    
+    def close(self):
+        self.wait()
+        self._executor.shutdown(wait=True)
+
+def in_probe_batches(downloader, messages, size=None):
+    """メッセージを size 件（省略時は BATCH_CHUNK_SIZE）ずつ生成し、その塊の添付ファイルをまとめて確認してからダウンロードに回す
+    
+    messages は生成時に添付ファイルを downloader に登録するジェネレータ。
+    """
+    if not downloader:
+        yield from messages
+        return
+    size = size or BATCH_CHUNK_SIZE
+    messages = iter(messages)
+    while True:
+        with downloader.batch():
+            chunk = [data for _, data in zip(range(size), messages)]
+        if not chunk:
+            return
+        yield from chunk
+
+@contextmanager
+def process_file_lock(path):
+    """ロックファイルで他のプロセス（並列ワーカー）と排他する（プロセスが落ちればOSが解放する）"""
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "a+b") as f:
+        if fcntl:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        elif msvcrt:
+            f.seek(0)
+            while True:
                 try:
-                    chat_area = driver.find_element(By.CSS_SELECTOR, selector)
+                    msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
                     break
-                except:
+                except OSError:
                     continue
-            
-            driver.execute_script("arguments[0].scrollTop = 0", chat_area)
-        except:
-            print(f"    ⚠️ スクロールエラー、続行...")
-        
-        time.sleep(wait_time)
-        
-        # スクロール後のメッセージ数を再取得
         try:
-            messages_after_wait = driver.find_elements(By.CSS_SELECTOR, "[data-mid]")
-            count_after_wait = len(messages_after_wait)
-        except:
-            count_after_wait = current_count
-        
-        if count_after_wait == previous_message_count:
-            no_change_count += 1
-            print(f"    変化なし {no_change_count}/7 ({count_after_wait}件)")
-            if no_change_count >= 7:
-                print(f"  ✅ 全メッセージ読み込み完了 ({count_after_wait}件)")
-                break
-        else:
-            no_change_count = 0
-            print(f"    {count_after_wait}件のメッセージを検出（+{count_after_wait - previous_message_count}件）")
-        
-        previous_message_count = count_after_wait
-        
-        if i > 0 and i % 20 == 0:
-            print(f"    継続中... {i}/{max_attempts}回 ({count_after_wait}件)")
+            yield
+        finally:
+            if fcntl:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+            elif msvcrt:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+class BlobStore:
+    """SHA-256で実体を管理する添付ファイルストア
     
-    if no_change_count < 7:
-        print(f"  ⚠️ 最大試行回数に達しました ({previous_message_count}件取得）")
+    実体は {root}/{sha256[:2]}/{sha256} に1つだけ保存し、各ルームのフォルダへはハードリンク
+    （使えない環境ではコピー）で配置する。file_id などのキーとハッシュの対応は追記型の
+    index.jsonl に記録し、既知のキーはリクエストを発行せずに再利用する。
+    """
     
-    # 最後に一番上にスクロール
-    try:
-        for selector in selectors:
+    def __init__(self, root):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.index_path = self.root / "index.jsonl"
+        self._lock = threading.Lock()
+        self._key_locks = {}
+        self._index = {}
+        self._remote = {}
+        self._by_etag = {}
+        self._index_offset = 0
+        self._reload_index()
+    
+    def _reload_index(self):
+        """他のプロセスが index.jsonl に追記した分を読み込む"""
+        if not self.index_path.exists():
+            return
+        with open(self.index_path, "rb") as f:
+            f.seek(self._index_offset)
+            data = f.read()
+        # 書き込み途中の末尾の行は次回に回す
+        complete = data[:data.rfind(b"\n") + 1]
+        self._index_offset += len(complete)
+        for line in complete.decode("utf-8", errors="replace").splitlines():
             try:
-                chat_area = driver.find_element(By.CSS_SELECTOR, selector)
-                driver.execute_script("arguments[0].scrollTop = 0", chat_area)
-                break
-            except:
+                entry = json.loads(line)
+            except ValueError:
                 continue
-    except:
-        pass
+            if entry.get("key") and entry.get("sha256"):
+                self._remember(entry)
     
-    time.sleep(2)
+    def _remember(self, entry):
+        self._index[entry["key"]] = entry["sha256"]
+        self._remote[entry["key"]] = {k: entry.get(k) for k in ("size", "etag", "content_type")}
+        if entry.get("etag"):
+            self._by_etag[(entry["etag"], entry.get("size"))] = entry["sha256"]
     
-    final_count = len(driver.find_elements(By.CSS_SELECTOR, "[data-mid]"))
-    print(f"  📊 最終取得件数: {final_count}件")
-
-def safe_get_text(element, max_retries=3):
-    """Stale対策：要素からテキストを安全に取得"""
-    for attempt in range(max_retries):
-        try:
-            return element.text.strip()
-        except StaleElementReferenceException:
-            if attempt < max_retries - 1:
+    def blob_path(self, sha256):
+        return self.root / sha256[:2] / sha256
+    
+    def lookup(self, key):
+        """キーに対応する実体があればそのハッシュを返す"""
+        sha256 = self._index.get(key)
+        if sha256 and self.blob_path(sha256).exists():
+            return sha256
+        return None
+    
+    def remote_info(self, key):
+        """キーの登録時に記録したサイズ・ETag・Content-Type"""
+        return self._remote.get(key, {})
+    
+    def find_remote(self, etag, size):
+        """サイズとETagが一致する実体があればそのハッシュを返す（URLが変わっても同じ内容なら再利用する）"""
+        sha256 = self._by_etag.get((etag, size)) if etag else None
+        if sha256 and self.blob_path(sha256).exists():
+            return sha256
+        return None
+    
+    def _key_lock(self, key):
+        with self._lock:
+            return self._key_locks.setdefault(key, threading.Lock())
+    
+    def _record(self, key, sha256, size, remote=None):
+        entry = {"key": key, "sha256": sha256, "size": size}
+        if remote:
+            entry.update({k: remote.get(k) for k in ("etag", "content_type")})
+        with self._lock:
+            self._remember(entry)
+            # 他のプロセスも同じ索引に追記するため、追記は1行を1回の書き込みで行う
+            with open(self.index_path, "ab") as f:
+                f.write((json.dumps(entry) + "\n").encode("utf-8"))
+    
+    def fetch(self, session, file_url, key, save_path, remote=None):
+        """キーが既知なら実体を再利用し、未知ならダウンロードして登録（戻り値: (sha256, 再利用したか)）
+        
+        remote（HEADで取得したサイズ・ETag）が保存済みの実体と一致する場合もダウンロードしない。
+        """
+        # 同じキーを複数スレッド・複数プロセス（並列ワーカー）が同時にダウンロードしないよう直列化
+        # （一時ファイル名はキーごとに固定なので、同時に書き込むと .part が壊れる）
+        key_hash = hashlib.sha256(key.encode()).hexdigest()[:16]
+        with self._key_lock(key), process_file_lock(self.root / ".locks" / key_hash):
+            sha256 = self.lookup(key)
+            if sha256 is None:
+                # ロック待ちの間に他のプロセスが取得済みなら再利用する
+                with self._lock:
+                    self._reload_index()
+                sha256 = self.lookup(key)
+            reused = sha256 is not None
+            
+            if not reused and remote:
+                sha256 = self.find_remote(remote.get("etag"), remote.get("size"))
+                if sha256:
+                    reused = True
+                    self._record(key, sha256, remote.get("size"), remote)
+            
+            if not reused:
+                # キーごとに固定の一時ファイル名にして、中断したダウンロードを次回も続きから取得する
+                tmp_path = self.root / f".tmp_{key_hash}"
+                try:
+                    sha256 = stream_download(session, file_url, tmp_path)
+                    blob_path = self.blob_path(sha256)
+                    blob_path.parent.mkdir(parents=True, exist_ok=True)
+                    size = tmp_path.stat().st_size
+                    if blob_path.exists():
+                        tmp_path.unlink()
+                    else:
+                        os.replace(tmp_path, blob_path)
+                finally:
+                    if tmp_path.exists():
+                        tmp_path.unlink()
+                self._record(key, sha256, size, remote)
+        
+        self.link(sha256, save_path)
+        return sha256, reused
+    
+    def link(self, sha256, save_path):
+        """実体をルームのフォルダへハードリンク（既に同じ実体なら何もしない）"""
+        blob_path = self.blob_path(sha256)
+        save_path = Path(save_path)
+        
+        if save_path.exists() and os.path.samefile(save_path, blob_path):
+            return
+        
+        tmp_link = save_path.with_name(f".{save_path.name}.{threading.get_ident()}.tmp")
+        try:
+            os.link(blob_path, tmp_link)
+        except OSError:
+            shutil.copy2(blob_path, tmp_link)
+        os.replace(tmp_link, save_path)
+
+_blob_stores = {}
+_blob_stores_lock = threading.Lock()
+
+def blob_store_for(save_dir):
+    """ルームのフォルダに対応する（バックアップ先直下の）BlobStoreを返す"""
+    root = (backup_root(Path(save_dir).parent) / BLOB_DIR_NAME).resolve()
+    with _blob_stores_lock:
+        if root not in _blob_stores:
+            _blob_stores[root] = BlobStore(root)
+        return _blob_stores[root]
+
+def attachment_cache_key(attachment):
+    """重複排除に使うキー（file_idがあればそれ、無ければURL）"""
+    file_id = attachment.get("file_id")
+    if file_id and file_id != "unknown":
+        # 元画像はファイルリンクと同じ内容なので同じキーにし、プレビュー画像は中身が違うため分ける
+        if attachment["type"] == "image":
+            return f"file:{file_id}"
+        return f"{attachment['type']}:{file_id}"
+    if attachment.get("chatwork_url"):
+        return f"url:{attachment['chatwork_url']}"
+    return None
+
+class RemoteFileIndex:
+    """重複排除を使わない場合に、保存したファイルのサイズとETagを記録する（追記型JSONL）"""
+    
+    def __init__(self, path):
+        self.path = Path(path)
+        self._lock = threading.Lock()
+        self._files = {}
+        if self.path.exists():
+            for entry in iter_jsonl(self.path):
+                self._files[entry["path"]] = entry
+    
+    def matches(self, save_path, remote):
+        """保存済みのファイルがサイズ・ETagとも一致するか"""
+        entry = self._files.get(str(Path(save_path).resolve()))
+        if not entry or not remote.get("etag") or not Path(save_path).exists():
+            return False
+        size = Path(save_path).stat().st_size
+        return entry.get("etag") == remote["etag"] and size == entry.get("size") and remote.get("size") in (None, size)
+    
+    def record(self, save_path, remote):
+        entry = {"path": str(Path(save_path).resolve()), "size": Path(save_path).stat().st_size, "etag": remote.get("etag")}
+        with self._lock:
+            self._files[entry["path"]] = entry
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+
+_remote_indexes = {}
+
+def remote_index_for(save_dir):
+    path = (backup_root(Path(save_dir).parent) / REMOTE_INDEX_NAME).resolve()
+    with _blob_stores_lock:
+        if path not in _remote_indexes:
+            _remote_indexes[path] = RemoteFileIndex(path)
+        return _remote_indexes[path]
+
+def absolute_chatwork_url(url):
+    if url and url.startswith('gateway/'):
+        return f"{CHATWORK_URL}{url}"
+    return url
+
+def head_remote_file(session, file_url):
+    """HEADでサイズ・Content-Type・ETagを取得（HEADを受け付けないURLはGETしてヘッダーだけ読む）"""
+    headers = {"Accept-Encoding": "identity"}
+    response = session.head(file_url, allow_redirects=True, timeout=DOWNLOAD_TIMEOUT, headers=headers)
+    if response.status_code >= 400:
+        # 署名付きURLはメソッドごとに署名されているためHEADが拒否されることがある
+        response = session.get(file_url, stream=True, timeout=DOWNLOAD_TIMEOUT, headers=headers)
+        response.close()
+    response.raise_for_status()
+    METRICS.increment("download.head_requests")
+    
+    length = response.headers.get("Content-Length", "")
+    content_type = response.headers.get("Content-Type", "").split(";")[0].strip().lower()
+    return {
+        "size": int(length) if length.isdigit() else None,
+        "content_type": content_type or None,
+        "etag": response.headers.get("ETag")
+    }
+
+def extension_for(content_type):
+    """Content-Typeから拡張子を決める（不明ならNone）"""
+    if not content_type:
+        return None
+    if content_type in ("image/jpeg", "image/jpg", "image/pjpeg"):
+        return ".jpg"
+    return mimetypes.guess_extension(content_type)
+
+def apply_remote_info(attachment, remote):
+    """HEADの結果を添付情報に反映し、拡張子の無い画像のファイル名を補う"""
+    for field in ("size", "content_type", "etag"):
+        if remote.get(field) is not None:
+            attachment[field] = remote[field]
+        else:
+            attachment.setdefault(field, None)
+    
+    if attachment["type"] == "image" and not Path(attachment["filename"]).suffix:
+        attachment["filename"] += extension_for(attachment.get("content_type")) or ".jpg"
+
+def probe_attachment(session, attachment, download_dir):
+    """1件の添付ファイルをHEADで確認（重複排除ストアに登録済みならリクエストしない）"""
+    if "etag" in attachment:
+        return attachment
+    
+    key = attachment_cache_key(attachment) if DEDUP_ATTACHMENTS else None
+    if key and blob_store_for(download_dir).lookup(key):
+        remote = blob_store_for(download_dir).remote_info(key)
+    elif PROBE_ATTACHMENTS:
+        try:
+            remote = head_remote_file(session, absolute_chatwork_url(attachment["chatwork_url"]))
+        except requests.RequestException as e:
+            METRICS.increment("download.head_failures")
+            print(f"    ⚠️ サイズ確認に失敗 ({attachment['filename']}): {e}")
+            remote = {}
+    else:
+        remote = {}
+    
+    apply_remote_info(attachment, remote)
+    return attachment
+
+def probe_attachments(session, items, max_workers=DOWNLOAD_WORKERS):
+    """(添付情報, 保存先) のリストをまとめて並列にHEADで確認し、判明した合計サイズを返す"""
+    with ThreadPoolExecutor(max_workers=max(1, max_workers), thread_name_prefix="probe") as executor:
+        list(executor.map(lambda item: probe_attachment(session, *item), items))
+    return sum(attachment.get("size") or 0 for attachment, _ in items)
+
+def fetch_attachment(session, attachment, download_dir):
+    """添付ファイルを取得してローカルの絶対パスを返す（重複排除ストア経由ならsha256も記録）"""
+    checkpoint = get_checkpoint()
+    if checkpoint:
+        # 中断前の実行で取得済みならダウンロードしない
+        local_path = checkpoint.downloaded_path(download_dir, attachment_cache_key(attachment))
+        if local_path:
+            return local_path
+    
+    probe_attachment(session, attachment, download_dir)
+    
+    key = attachment_cache_key(attachment) if DEDUP_ATTACHMENTS else None
+    local_path = download_file_from_chatwork(
+        session, attachment["chatwork_url"], attachment["filename"], download_dir, cache_key=key,
+        remote={"size": attachment.get("size"), "etag": attachment.get("etag"), "content_type": attachment.get("content_type")}
+    )
+    if local_path and key:
+        attachment["sha256"] = blob_store_for(download_dir).lookup(key)
+    if local_path and checkpoint and attachment_cache_key(attachment):
+        checkpoint.record_attachment(download_dir, attachment_cache_key(attachment), local_path)
+    return local_path
+
+class IncompleteDownload(requests.RequestException):
+    """受信したサイズがContent-Lengthと一致しない（再試行で続きから取得する）"""
+
+def is_retryable(error):
+    """接続断・タイムアウト・サイズ不一致・5xx/429なら再試行する"""
+    if isinstance(error, requests.HTTPError):
+        status = error.response.status_code if error.response is not None else 0
+        return status >= 500 or status == 429
+    return isinstance(error, requests.RequestException)
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(DOWNLOAD_CHUNK_MAX), b""):
+            digest.update(block)
+    return digest
+
+def part_validator_path(part_path):
+    return part_path.with_name(part_path.name + ".validator")
+
+def discard_part(part_path):
+    """途中まで受信したファイルと、その取得元の検証子を削除"""
+    for path in (part_path, part_validator_path(part_path)):
+        if path.exists():
+            path.unlink()
+
+def response_validator(response):
+    """If-Range に使える検証子（強いETag、無ければLast-Modified）"""
+    etag = response.headers.get("ETag")
+    if etag and not etag.startswith("W/"):
+        return etag
+    return response.headers.get("Last-Modified")
+
+def download_to_part(session, file_url, part_path, digest):
+    """part_pathの続きから取得し、part_path全体のハッシュを返す
+    
+    取得元が .part を書き始めたときから変わっていなければ（If-Range）続きを受け取り、
+    変わっていた場合やサーバーがRangeに対応していない場合は最初から取得し直す。
+    """
+    offset = part_path.stat().st_size if part_path.exists() else 0
+    validator_path = part_validator_path(part_path)
+    validator = validator_path.read_text(encoding="utf-8").strip() if offset and validator_path.exists() else ""
+    headers = {"Accept-Encoding": "identity"}
+    if offset and validator:
+        headers["Range"] = f"bytes={offset}-"
+        headers["If-Range"] = validator
+    
+    with session.get(file_url, stream=True, timeout=DOWNLOAD_TIMEOUT, headers=headers) as response:
+        if response.status_code == 416 and "Range" in headers:
+            # 前回の実行で最後まで受信済み（リネーム前に止まった）なら完了とみなす
+            total = response.headers.get("Content-Range", "").rpartition("/")[2]
+            if total.isdigit() and int(total) == offset:
+                return digest
+            discard_part(part_path)
+            raise IncompleteDownload(f"再開位置 {offset} バイトを受け付けられませんでした")
+        response.raise_for_status()
+        
+        if "Range" in headers and response.status_code == 206:
+            METRICS.increment("download.resumed")
+            expected = response.headers.get("Content-Range", "").rpartition("/")[2]
+            mode = "ab"
+        else:
+            # 検証子が無い・取得元が変わった（If-Rangeが不一致）・Range非対応の場合は全体が返るため最初から書き直す
+            if offset:
+                METRICS.increment("download.restarted")
+            offset = 0
+            digest = hashlib.sha256()
+            expected = response.headers.get("Content-Length", "")
+            mode = "wb"
+            # 次に続きから取得するときに同じ内容か確かめられるよう、書き始める前に検証子を残す
+            validator = response_validator(response)
+            if validator:
+                validator_path.write_text(validator, encoding="utf-8")
+            elif validator_path.exists():
+                validator_path.unlink()
+        expected = int(expected) if expected.isdigit() else None
+        
+        # ファイルが大きいほど大きなチャンクで読み込む
+        remaining = (expected - offset) if expected else 0
+        chunk_size = min(DOWNLOAD_CHUNK_MAX, max(DOWNLOAD_CHUNK_MIN, remaining // 16))
+        
+        received = 0
+        try:
+            with open(part_path, mode) as f:
+                for chunk in response.iter_content(chunk_size=chunk_size):
+                    f.write(chunk)
+                    digest.update(chunk)
+                    received += len(chunk)
+        finally:
+            METRICS.increment("download.bytes", received)
+    
+    if expected is not None and offset + received != expected:
+        raise IncompleteDownload(f"{offset + received}/{expected} バイトで途切れました")
+    return digest
+
+def stream_download(session, file_url, save_path):
+    """URLの内容を一時ファイル（.part）に書いてから置き換え、SHA-256を返す
+    
+    接続が切れた場合は指数バックオフ（ジッター付き）で再試行し、Range（If-Range付き）で続きから取得する。
+    再試行しても失敗した場合は.partを残し、次回の実行で続きから取得する。
+    """
+    save_path = Path(save_path)
+    part_path = save_path.with_name(save_path.name + ".part")
+    digest = file_sha256(part_path) if part_path.exists() else hashlib.sha256()
+    
+    for attempt in range(DOWNLOAD_RETRIES + 1):
+        try:
+            digest = download_to_part(session, file_url, part_path, digest)
+            break
+        except requests.RequestException as e:
+            if not is_retryable(e):
+                discard_part(part_path)
+                raise
+            if attempt == DOWNLOAD_RETRIES:
+                raise
+            # 同時に失敗したスレッドが一斉に再接続しないよう待機時間をランダムに散らす
+            delay = random.uniform(0, min(DOWNLOAD_BACKOFF_MAX, DOWNLOAD_BACKOFF_BASE * 2 ** attempt))
+            METRICS.increment("download.retries")
+            print(f"    ↻ 再試行 {attempt + 1}/{DOWNLOAD_RETRIES}（{delay:.1f}秒後）: {e}")
+            time.sleep(delay)
+            digest = file_sha256(part_path) if part_path.exists() else hashlib.sha256()
+    
+    os.replace(part_path, save_path)
+    discard_part(part_path)
+    return digest.hexdigest()
+
+@METRICS.timed("download.file")
+def download_file_from_chatwork(session, file_url, filename, save_dir, cache_key=None, remote=None):
+    """Chatworkからファイルをダウンロード（相対パス対応、cache_key指定時は重複排除ストア経由）
+    
+    remote（HEADで取得したサイズ・ETag）が保存済みのファイルと一致すれば再取得しない。
+    """
+    try:
+        # 相対パスを絶対パスに変換
+        file_url = absolute_chatwork_url(file_url)
+        
+        # ファイル名をサニタイズ（Windowsで使えない文字を除去）
+        safe_filename = re.sub(r'[<>:"/\\|?*]', '_', filename)
+        
+        save_path = Path(save_dir) / safe_filename
+        save_path.parent.mkdir(parents=True, exist_ok=True)
+        
+        if cache_key:
+            _, reused = blob_store_for(save_dir).fetch(session, file_url, cache_key, save_path, remote)
+        elif remote and remote_index_for(save_dir).matches(save_path, remote):
+            reused = True
+        else:
+            stream_download(session, file_url, save_path)
+            if remote and remote.get("etag"):
+                remote_index_for(save_dir).record(save_path, remote)
+            reused = False
+        
+        # 絶対パスを返す
+        absolute_path = str(save_path.resolve())
+        if reused:
+            METRICS.increment("download.reused")
+            print(f"    ♻️ 保存済みファイルを再利用: {safe_filename}")
+        else:
+            print(f"    ✓ ダウンロード: {safe_filename}")
+        return absolute_path
+    except Exception as e:
+        METRICS.increment("download.failures")
+        print(f"    ✗ ダウンロード失敗 ({filename}): {e}")
+        return None
+
+# チャットエリアのセレクタ（上から順にフォールバック）
+CHAT_AREA_SELECTORS = [
+    "div.sc-eBAZHg.kzmpjh",
+    "div[tabindex='1']",
+    "#_chatText",
+    ".cw_chat_body",
+    "[role='log']",
+    ".chatTimeLineContainer",
+    "#_timeLine"
+]
+ROOM_NAME_SELECTORS = [
+    ".chatRoomHeader__roomTitle",
+    "span.chatRoomHeader__roomTitle",
+    "._roomName",
+    ".room_name",
+    "[data-test='room-name']",
+    "[data-testid='room-name']",
+    "h1[class*='room']"
+]
+MESSAGE_ITEM_SELECTORS = [
+    "div[data-mid]",
+    "li[data-mid]",
+    "[data-test='message-item']"
+]
+
+# 画面ごとに実際に使えたセレクタの記録（画面のバージョン＝読み込まれたスクリプトのURLごと）
+# 1件ずつWebDriverで探す処理では記録したセレクタを先に試し、一致しなくなった場合だけ残りの候補にフォールバックする
+# （ブラウザ内のスクリプトは全候補を1回で試すため、結果が変わらないよう常に本来の優先順で渡す）
+SELECTOR_CACHE_NAME = "_selector_cache.json"
+SELECTOR_CACHE_VERSIONS = 5    # 保持する画面のバージョン数
+
+# スクロールしながら新しく現れたメッセージをその場で解析する（仮想化されたタイムライン対策）
+HARVEST_WHILE_SCROLLING = False
+HARVEST_PRUNE_NODES = False   # 解析済みの要素をDOMから外してブラウザのメモリを一定に保つ
+HARVEST_KEEP_NODES = 50       # 削除時もスクロール位置の基準として残す古い側の要素数
+
+# スクロール読み込みの待機設定（秒）
+SCROLL_MIN_WAIT = 0.25             # 1回のスクロールで新着を待つ最短時間
+SCROLL_MAX_WAIT = 3.0              # 変化が無い場合に延ばす待機時間の上限
+SCROLL_QUIESCENCE_TIMEOUT = 6.0    # この時間メッセージ数が増えなければ読み込み完了とみなす
+
+# メッセージ要素の送信日時（data-tm または datetime 属性）をUNIX秒で返す関数（不明ならnull）
+MESSAGE_TIME_JS = """
+const messageTime = (node, timeSelectors) => {
+    for (const selector of timeSelectors) {
+        const el = node.matches(selector) ? node : node.querySelector(selector);
+        if (!el) continue;
+        const tm = Number(el.getAttribute('data-tm') || NaN);
+        if (Number.isFinite(tm)) return tm;
+        const parsed = Date.parse(el.getAttribute('datetime') || '');
+        if (Number.isFinite(parsed)) return parsed / 1000;
+    }
+    return null;
+};
+"""
+
+# 最上部へスクロールし、[data-mid] の件数が変わるかタイムアウトするまで待つ（execute_async_script用）
+# arguments: チャットエリアのセレクタ, 前回の件数, タイムアウト(ms), 日時のセレクタ（nullなら日時を調べない）, コールバック
+WAIT_FOR_MORE_MESSAGES_SCRIPT = MESSAGE_TIME_JS + """
+const selectors = arguments[0];
+const previousCount = arguments[1];
+const timeoutMs = arguments[2];
+const timeSelectors = arguments[3];
+const done = arguments[arguments.length - 1];
+
+const countMessages = () => document.querySelectorAll('[data-mid]').length;
+const oldestMid = () => {
+    let oldest = null;
+    for (const node of document.querySelectorAll('[data-mid]')) {
+        const mid = Number(node.getAttribute('data-mid'));
+        if (Number.isFinite(mid) && (oldest === null || mid < oldest)) oldest = mid;
+    }
+    return oldest === null ? null : String(oldest);
+};
+const oldestTime = () => {
+    if (!timeSelectors) return null;
+    let oldest = null;
+    for (const node of document.querySelectorAll('[data-mid]')) {
+        const tm = messageTime(node, timeSelectors);
+        if (tm !== null && (oldest === null || tm < oldest)) oldest = tm;
+    }
+    return oldest;
+};
+
+let area = null;
+for (const s of selectors) {
+    area = document.querySelector(s);
+    if (area) break;
+}
+if (!area) {
+    done({found: false, count: countMessages(), oldest: oldestMid(), oldest_time: oldestTime(), scrollable: false});
+    return;
+}
+
+let finished = false;
+let checkScheduled = false;
+let timer = null;
+const observer = new MutationObserver(() => {
+    if (checkScheduled) return;
+    checkScheduled = true;
+    setTimeout(() => {
+        checkScheduled = false;
+        if (countMessages() !== previousCount) finish();
+    }, 50);
+});
+const finish = () => {
+    if (finished) return;
+    finished = true;
+    observer.disconnect();
+    clearTimeout(timer);
+    done({
+        found: true,
+        count: countMessages(),
+        oldest: oldestMid(),
+        oldest_time: oldestTime(),
+        scrollable: area.scrollHeight > area.clientHeight
+    });
+};
+
+observer.observe(document.body, {childList: true, subtree: true});
+timer = setTimeout(finish, timeoutMs);
+
+// 既に最上部にいる場合はスクロールイベントを明示的に発火させて追加読み込みを促す
+if (area.scrollTop === 0) {
+    area.dispatchEvent(new Event('scroll'));
+} else {
+    area.scrollTop = 0;
+}
+if (countMessages() !== previousCount) finish();
+"""
+
+def mid_key(message_id):
+    """message_idを比較用の数値に変換（数値でなければNone）"""
+    try:
+        return int(message_id)
+    except (TypeError, ValueError):
+        return None
+
+@METRICS.timed("phase.scroll")
+def scroll_to_load_all_messages(driver, stop_at_mid=None, on_new_messages=None, stop_before=None):
+    """チャット履歴を全て読み込むまでスクロール（遅延ロード対応）
+    
+    固定のsleepではなく、ブラウザ内のMutationObserverで [data-mid] の増加を待つ。
+    増えなければ待機時間を倍々に延ばし、SCROLL_QUIESCENCE_TIMEOUT 秒変化が無ければ完了とみなす。
+    stop_at_mid を指定すると、そのメッセージ以前まで読み込んだ時点で停止する（差分エクスポート用）
+    stop_before（UNIX秒）を指定すると、それより古いメッセージまで読み込んだ時点で停止する（期間指定用）
+    on_new_messages を指定すると、スクロールのたびに新しく現れたメッセージを解析して渡す
+    """
+    print("📜 過去のメッセージを読み込み中...")
+    
+    # チャットエリアを特定
+    chat_area = None
+    for selector in selectors_for("chat_area", CHAT_AREA_SELECTORS):
+        try:
+            chat_area = driver.find_element(By.CSS_SELECTOR, selector)
+            print(f"  ✓ チャットエリア検出: {selector}")
+            break
+        except:
+            continue
+    
+    if not chat_area:
+        print("  ⚠️ チャットエリアが見つかりません")
+        print("  スクロールなしで続行します（最近のメッセージのみ取得）")
+        time.sleep(3)
+        return
+    
+    driver.set_script_timeout(SCROLL_MAX_WAIT + 30)
+    stop_key = mid_key(stop_at_mid)
+    
+    start_time = time.time()
+    last_report = start_time
+    previous_count = -1
+    count = 0
+    loaded = 0
+    harvested_total = 0
+    wait_time = SCROLL_MIN_WAIT
+    idle_time = 0.0
+    error_count = 0
+    
+    print(f"  スクロール開始（{SCROLL_QUIESCENCE_TIMEOUT:.0f}秒間増加が無ければ完了）...")
+    
+    while True:
+        step_start = time.time()
+        try:
+            state = driver.execute_async_script(
+                WAIT_FOR_MORE_MESSAGES_SCRIPT,
+                CHAT_AREA_SELECTORS,
+                previous_count,
+                int(wait_time * 1000),
+                TIME_SELECTORS if stop_before is not None else None
+            )
+            error_count = 0
+        except WebDriverException as e:
+            error_count += 1
+            print(f"    ⚠️ スクロールエラー、再試行... ({error_count}/5)")
+            if error_count >= 5:
+                print(f"  ⚠️ スクロールを中断します: {e}")
+                break
+            time.sleep(1)
+            continue
+        
+        count = state["count"]
+        dom_count = count
+        
+        if on_new_messages:
+            try:
+                harvest = driver.execute_script(
+                    HARVEST_MESSAGES_SCRIPT, message_field_selectors(), HARVEST_PRUNE_NODES, HARVEST_KEEP_NODES
+                )
+                harvested_total += len(harvest["records"])
+                METRICS.increment("extract.messages", len(harvest["records"]))
+                on_new_messages(harvest["records"])
+                dom_count = harvest["count"]
+            except WebDriverException as e:
+                print(f"    ⚠️ メッセージ収集エラー: {e}")
+        
+        oldest_key = mid_key(state.get("oldest"))
+        if stop_key is not None and oldest_key is not None and oldest_key <= stop_key:
+            print(f"  ✅ 前回取得済みのメッセージ (mid:{stop_at_mid}) まで読み込み完了 ({count}件)")
+            break
+        
+        oldest_time = state.get("oldest_time")
+        if stop_before is not None and oldest_time is not None and oldest_time < stop_before:
+            print(f"  ✅ 指定期間の開始（{datetime.fromtimestamp(stop_before):%Y-%m-%d %H:%M}）より前まで読み込み完了 ({count}件)")
+            break
+        
+        if not state.get("found"):
+            print("  ⚠️ チャットエリアを見失いました")
+            break
+        
+        if count != previous_count:
+            if previous_count >= 0:
+                loaded += max(0, count - previous_count)
+                print(f"    {count}件のメッセージを検出（+{count - previous_count}件）")
+            wait_time = SCROLL_MIN_WAIT
+            idle_time = 0.0
+            if not state.get("scrollable"):
+                print(f"  ✅ スクロール不要（{count}件）")
+                break
+        else:
+            idle_time += time.time() - step_start
+            if idle_time >= SCROLL_QUIESCENCE_TIMEOUT:
+                print(f"  ✅ 全メッセージ読み込み完了 ({count}件)")
+                break
+            wait_time = min(wait_time * 2, SCROLL_MAX_WAIT)
+        
+        # 解析済みの要素を削除した場合は削除後の件数を基準に次の増加を待つ
+        previous_count = dom_count
+        
+        if time.time() - last_report >= 30:
+            last_report = time.time()
+            elapsed = last_report - start_time
+            print(f"    継続中... {count}件 ({loaded / elapsed:.1f}件/秒)")
+    
+    elapsed = time.time() - start_time
+    rate = loaded / elapsed if elapsed > 0 else 0.0
+    total = harvested_total if on_new_messages else count
+    print(f"  📊 最終取得件数: {total}件（{elapsed:.1f}秒で+{loaded}件、{rate:.1f}件/秒）")
+
+def safe_get_text(element, max_retries=3):
+    """Stale対策：要素からテキストを安全に取得"""
+    for attempt in range(max_retries):
+        try:
+            return element.text.strip()
+        except StaleElementReferenceException:
+            if attempt < max_retries - 1:
                 time.sleep(0.1)
                 continue
             return ""
@@ -360,9 +1828,322 @@ def safe_get_attribute(element, attr_name, max_retries=3):
             return None
     return None
 
-def extract_message_data_by_id(driver, message_id, session, download_dir):
-    """message_idを使って都度要素を再取得しながらデータ抽出（添付ファイル完全対応）"""
-    data = {
+# メッセージ解析用セレクタ（上から順にフォールバック）
+SENDER_SELECTORS = [
+    "[data-testid='timeline_user-name']",
+    "p[data-testid='timeline_user-name']",
+    ".sc-iPahhU",
+    ".chatTimeLineNameBox__name",
+    "[class*='userName']"
+]
+COMPANY_SELECTOR = ".sc-fjhLSj"
+BODY_SELECTORS = [
+    "pre.sc-fbFiXs",
+    "pre span",
+    "pre",
+    ".chatTimeLineTxt",
+    "[class*='message']"
+]
+TIME_SELECTORS = [
+    "._timeStamp",
+    "[data-tm]",
+    "div[data-tm]",
+    "time",
+    "[datetime]"
+]
+IMAGE_PREVIEW_SELECTOR = "img[data-file-id]._filePreview"
+FILE_LINK_SELECTOR = "div[data-cwopen*='download'] a[href*='gateway/download_file.php']"
+STORAGE_LINK_SELECTOR = "a[href*='storage.chatwork.com']"
+TASK_SELECTOR = "[data-test='task-icon'], .taskIcon, [class*='task']"
+
+# 一括抽出モード（1回のexecute_scriptでチャンク内の全メッセージを解析）
+BATCH_EXTRACTION = True
+BATCH_CHUNK_SIZE = 200
+
+# 抽出結果のキャッシュ（(room_id, message_id) とブラウザ内で計算した要素のハッシュで照合し、
+# 変化の無いメッセージは解析し直さない。空文字ならキャッシュしない）
+EXTRACT_CACHE_NAME = "_extract_cache.sqlite3"
+EXTRACT_CACHE_MAX_ENTRIES = 500000   # 超えたら最後に使われたのが古いものから削除する
+
+# ブラウザ内でメッセージ要素1件を解析する関数（一括抽出・スクロール中の収集で共用）
+MESSAGE_RECORD_JS = """
+const textOf = (el) => (el.innerText || el.textContent || '').trim();
+
+const firstText = (root, selectors) => {
+    for (const s of selectors) {
+        const el = root.querySelector(s);
+        if (el) {
+            const t = textOf(el);
+            if (t) return t;
+        }
+    }
+    return '';
+};
+
+const timestampOf = (root, sel) => {
+    for (const s of sel.time) {
+        const el = root.querySelector(s);
+        if (!el) continue;
+        const datetimeAttr = el.getAttribute('datetime');
+        const dataTm = el.getAttribute('data-tm');
+        const text = textOf(el);
+        if (datetimeAttr) return datetimeAttr;
+        if (dataTm) return 'unix:' + dataTm;
+        if (text) return text;
+    }
+    return '';
+};
+
+const extractRecord = (msg, sel) => {
+    const company = msg.querySelector(sel.company);
+    return {
+        message_id: msg.getAttribute('data-mid'),
+        sender: firstText(msg, sel.sender),
+        company: company ? textOf(company) : '',
+        body: firstText(msg, sel.body),
+        timestamp: timestampOf(msg, sel),
+        images: Array.from(msg.querySelectorAll(sel.image)).map((img) => ({
+            file_id: img.getAttribute('data-file-id'),
+            src: img.src || img.getAttribute('src')
+        })),
+        files: Array.from(msg.querySelectorAll(sel.file)).map((a) => ({
+            href: a.href || a.getAttribute('href'),
+            text: textOf(a)
+        })),
+        storage: Array.from(msg.querySelectorAll(sel.storage)).map((a) => ({
+            href: a.href || a.getAttribute('href'),
+            text: textOf(a),
+            title: a.getAttribute('title'),
+            download: a.getAttribute('download')
+        })),
+        is_task: msg.querySelector(sel.task) !== null
+    };
+};
+"""
+
+# ブラウザ内で実行する一括抽出スクリプト
+# arguments[0]: 対象のdata-midリスト, arguments[1]: セレクタ定義
+# メッセージ要素の outerHTML の64bitハッシュ（cyrb53、抽出キャッシュの照合用）
+MESSAGE_FINGERPRINT_JS = """
+const fingerprintOf = (node) => {
+    const str = node.outerHTML;
+    let h1 = 0xdeadbeef ^ str.length, h2 = 0x41c6ce57 ^ str.length;
+    for (let i = 0; i < str.length; i++) {
+        const ch = str.charCodeAt(i);
+        h1 = Math.imul(h1 ^ ch, 2654435761);
+        h2 = Math.imul(h2 ^ ch, 1597334677);
+    }
+    h1 = Math.imul(h1 ^ (h1 >>> 16), 2246822507) ^ Math.imul(h2 ^ (h2 >>> 13), 3266489909);
+    h2 = Math.imul(h2 ^ (h2 >>> 16), 2246822507) ^ Math.imul(h1 ^ (h1 >>> 13), 3266489909);
+    return (h2 >>> 0).toString(16).padStart(8, '0') + (h1 >>> 0).toString(16).padStart(8, '0');
+};
+
+const messageNodes = () => {
+    const nodes = new Map();
+    for (const node of document.querySelectorAll('[data-mid]')) {
+        const mid = node.getAttribute('data-mid');
+        if (!nodes.has(mid)) nodes.set(mid, node);
+    }
+    return nodes;
+};
+"""
+
+# arguments[0]: message_idのリスト, arguments[1]: セレクタ定義, arguments[2]: キャッシュ済みのハッシュ {message_id: hash}
+# ハッシュが一致した要素は解析せず {message_id, fingerprint, unchanged: true} だけを返す
+EXTRACT_MESSAGES_SCRIPT = MESSAGE_RECORD_JS + MESSAGE_FINGERPRINT_JS + """
+const mids = arguments[0];
+const sel = arguments[1];
+const known = arguments[2] || {};
+const nodes = messageNodes();
+
+return mids.map((mid) => {
+    const msg = nodes.get(mid);
+    if (!msg) return null;
+    const fingerprint = fingerprintOf(msg);
+    if (known[mid] === fingerprint) {
+        return {message_id: mid, fingerprint: fingerprint, unchanged: true};
+    }
+    const record = extractRecord(msg, sel);
+    record.fingerprint = fingerprint;
+    return record;
+});
+"""
+
+# 1件ずつ抽出する場合にキャッシュと照合するためのハッシュだけを返す（DOMに無いものはnull）
+MESSAGE_FINGERPRINTS_SCRIPT = MESSAGE_FINGERPRINT_JS + """
+const nodes = messageNodes();
+return arguments[0].map((mid) => nodes.has(mid) ? fingerprintOf(nodes.get(mid)) : null);
+"""
+
+# スクロール中に新しく現れた [data-mid] だけを解析して印を付ける（任意で解析済みの要素を削除）
+# arguments[0]: セレクタ定義, arguments[1]: 解析済み要素を削除するか, arguments[2]: 削除せず残す件数（先頭＝古い側）
+HARVEST_MESSAGES_SCRIPT = MESSAGE_RECORD_JS + """
+const sel = arguments[0];
+const prune = arguments[1];
+const keep = arguments[2];
+
+const records = [];
+for (const node of document.querySelectorAll('[data-mid]:not([data-cw-harvested])')) {
+    records.push(extractRecord(node, sel));
+    node.setAttribute('data-cw-harvested', '1');
+}
+
+if (prune) {
+    // スクロール位置の基準になる古い側の要素は残し、それより新しい解析済みの要素を外す
+    const harvested = document.querySelectorAll('[data-mid][data-cw-harvested]');
+    for (let i = keep; i < harvested.length; i++) harvested[i].remove();
+}
+
+return {records: records, count: document.querySelectorAll('[data-mid]').length};
+"""
+
+def message_field_selectors():
+    """一括抽出スクリプトに渡すセレクタ定義（各項目の候補は本来の優先順のまま）"""
+    return {
+        "sender": SENDER_SELECTORS,
+        "company": COMPANY_SELECTOR,
+        "body": BODY_SELECTORS,
+        "time": TIME_SELECTORS,
+        "image": IMAGE_PREVIEW_SELECTOR,
+        "file": FILE_LINK_SELECTOR,
+        "storage": STORAGE_LINK_SELECTOR,
+        "task": TASK_SELECTOR
+    }
+
+# 全候補セレクタを1回のスクリプトで優先順に試し、項目ごとに最初に一致したセレクタを返す
+# （優先度の高い候補が一致するのに、汎用的な下位の候補が先頭に残ることが無いよう毎回すべて試す）
+# arguments[0]: {項目: {scope: "page"|"message", text: 文字を含む要素に限るか, selectors: [...]}}
+LAYOUT_PROBE_SCRIPT = """
+const candidates = arguments[0];
+const sample = Array.from(document.querySelectorAll('[data-mid]')).slice(0, 20);
+
+const found = (root, selector, needText) => {
+    let el = null;
+    try {
+        el = root.querySelector(selector);
+    } catch (e) {
+        return false;
+    }
+    return el !== null && (!needText || (el.innerText || el.textContent || '').trim() !== '');
+};
+const matches = (spec, selector) =>
+    (spec.scope === 'message' ? sample : [document]).some((root) => found(root, selector, spec.text));
+
+const winners = {};
+for (const [field, spec] of Object.entries(candidates)) {
+    if (spec.scope === 'message' && !sample.length) continue;
+    winners[field] = spec.selectors.find((selector) => matches(spec, selector)) || null;
+}
+
+return {
+    scripts: Array.from(document.scripts).map((script) => script.src).filter(Boolean),
+    winners: winners
+};
+"""
+
+def layout_candidates():
+    """画面の判定に使う項目ごとの候補セレクタ（上から順に優先）"""
+    return {
+        "room_list": {"scope": "page", "text": False, "selectors": ROOM_LIST_SELECTORS},
+        "room_item": {"scope": "page", "text": False, "selectors": ROOM_ITEM_SELECTORS},
+        "room_link": {"scope": "page", "text": False, "selectors": ROOM_LINK_SELECTORS},
+        "room_name": {"scope": "page", "text": True, "selectors": ROOM_NAME_SELECTORS},
+        "chat_area": {"scope": "page", "text": False, "selectors": CHAT_AREA_SELECTORS},
+        "message": {"scope": "page", "text": False, "selectors": MESSAGE_ITEM_SELECTORS},
+        "sender": {"scope": "message", "text": True, "selectors": SENDER_SELECTORS},
+        "body": {"scope": "message", "text": True, "selectors": BODY_SELECTORS},
+        "time": {"scope": "message", "text": False, "selectors": TIME_SELECTORS}
+    }
+
+class SelectorCache:
+    """画面のバージョンごとに、項目ごとの使えたセレクタを記録する"""
+    
+    def __init__(self, path):
+        self.path = Path(path)
+        self.current = None
+        self.versions = {}
+        if self.path.exists():
+            try:
+                with open(self.path, "r", encoding="utf-8") as f:
+                    data = json.load(f)
+                self.current = data.get("current")
+                self.versions = data.get("versions", {})
+            except (OSError, ValueError) as e:
+                print(f"⚠️ セレクタのキャッシュを読み込めません ({self.path.name}): {e}")
+    
+    def save(self):
+        # 古いバージョンから削除して件数を抑える
+        for version in sorted(self.versions, key=lambda v: self.versions[v].get("seen_at", ""))[:-SELECTOR_CACHE_VERSIONS]:
+            del self.versions[version]
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        write_json_atomic(self.path, {"current": self.current, "versions": self.versions})
+    
+    def winners(self):
+        return self.versions.get(self.current, {}).get("selectors", {})
+    
+    def ordered(self, field, candidates):
+        """使えたセレクタを先頭にした候補リスト"""
+        winner = self.winners().get(field)
+        if winner in candidates:
+            return [winner] + [c for c in candidates if c != winner]
+        return list(candidates)
+    
+    def probe(self, driver, fields=None):
+        """ページ読み込み後に1回だけ全候補を試し、結果を記録する"""
+        candidates = layout_candidates()
+        if fields:
+            candidates = {field: candidates[field] for field in fields}
+        
+        try:
+            with METRICS.span("layout.probe"):
+                result = driver.execute_script(LAYOUT_PROBE_SCRIPT, candidates) or {}
+        except WebDriverException as e:
+            print(f"  ⚠️ 画面のセレクタを判定できません: {e}")
+            return
+        
+        version = hashlib.sha256("\n".join(sorted(result.get("scripts", []))).encode()).hexdigest()[:12]
+        changed = version != self.current
+        if changed:
+            if self.current:
+                print(f"  🧭 画面の更新を検出しました（{self.current} → {version}）")
+            self.current = version
+            self.versions.setdefault(version, {"selectors": {}})["seen_at"] = datetime.now().isoformat()
+        
+        selectors = self.versions[version]["selectors"]
+        for field, selector in (result.get("winners") or {}).items():
+            if selector and selectors.get(field) != selector:
+                if field in selectors:
+                    print(f"  🧭 セレクタを切り替え（{field}）: {selectors[field]} → {selector}")
+                selectors[field] = selector
+                changed = True
+            elif not selector and field in candidates:
+                METRICS.increment("layout.unmatched")
+        
+        if changed:
+            try:
+                self.save()
+            except OSError as e:
+                # 記録できなくても判定結果はこの実行中に使えるのでルームの処理は続ける
+                print(f"  ⚠️ セレクタのキャッシュを保存できません: {e}")
+
+_selector_cache = None
+
+def get_selector_cache():
+    global _selector_cache
+    if _selector_cache is None:
+        _selector_cache = SelectorCache(Path(BASE_DOWNLOAD_DIR) / SELECTOR_CACHE_NAME)
+    return _selector_cache
+
+def selectors_for(field, candidates):
+    """記録済みのセレクタを先頭にした候補リスト（1件ずつWebDriverで探す場合用）"""
+    return get_selector_cache().ordered(field, candidates)
+
+def probe_layout(driver, fields=None):
+    get_selector_cache().probe(driver, fields)
+
+def new_message_data(message_id):
+    """メッセージデータの初期値"""
+    return {
         "message_id": message_id,
         "sender": "Unknown",
         "company": "",
@@ -371,6 +2152,117 @@ def extract_message_data_by_id(driver, message_id, session, download_dir):
         "attachments": [],
         "is_task": False
     }
+
+def image_preview_attachment(message_id, file_id, src):
+    """画像プレビューの添付情報を生成（FULL_RESOLUTION_IMAGES なら元画像のダウンロードURLを使う）"""
+    if not file_id:
+        return None
+    
+    print(f"    🖼️ 画像プレビュー検出: file_id={file_id}")
+    
+    src = absolute_chatwork_url(src)
+    
+    if FULL_RESOLUTION_IMAGES:
+        # 拡張子はダウンロード前のHEADで Content-Type から決める
+        return {
+            "type": "image",
+            "file_id": file_id,
+            "filename": f"image_{message_id}_{file_id}",
+            "chatwork_url": f"{CHATWORK_URL}gateway/download_file.php?file_id={file_id}",
+            "preview_url": src
+        }
+    
+    return {
+        "type": "image_preview",
+        "file_id": file_id,
+        "filename": f"image_{message_id}_{file_id}.jpg",
+        "chatwork_url": src
+    }
+
+def file_link_attachment(href, link_text):
+    """ファイルダウンロードリンクの添付情報を生成"""
+    file_id_match = re.search(r'file_id=(\d+)', href) if href else None
+    file_id = file_id_match.group(1) if file_id_match else "unknown"
+    
+    filename_match = re.match(r'(.+?)\s*\(([\d.]+\s*[KMGT]?B)\)', link_text) if link_text else None
+    if filename_match:
+        filename = filename_match.group(1).strip()
+    else:
+        filename = link_text or f"file_{file_id}"
+    
+    if not href:
+        return None
+    
+    print(f"    📎 ファイル検出: {filename} (file_id={file_id})")
+    
+    href = absolute_chatwork_url(href)
+    
+    return {
+        "type": "file",
+        "file_id": file_id,
+        "filename": filename,
+        "chatwork_url": href,
+        "size": parse_size(filename_match.group(2)) if filename_match else None
+    }
+
+def storage_link_attachment(message_id, href, link_text, title, download_attr):
+    """ストレージファイルの添付情報を生成（アバター等は除外）"""
+    if href and ('avatar' in href or 'ico_default' in href):
+        return None
+    
+    filename = download_attr or title or link_text
+    
+    if not filename or filename == "":
+        filename = f"storage_file_{message_id}"
+        if href:
+            if '.png' in href or '.jpg' in href or '.jpeg' in href:
+                filename += '.jpg'
+            elif '.pdf' in href:
+                filename += '.pdf'
+            elif '.xlsx' in href or '.xls' in href:
+                filename += '.xlsx'
+            elif '.docx' in href:
+                filename += '.docx'
+    
+    if not href:
+        return None
+    
+    print(f"    📁 ストレージファイル検出: {filename}")
+    
+    return {
+        "type": "storage_file",
+        "filename": filename,
+        "chatwork_url": href
+    }
+
+def download_attachment(data, attachment, session, download_dir, downloader=None):
+    """添付ファイルをダウンロードし、成功したらメッセージデータに追加"""
+    if not attachment:
+        return
+    
+    # 一覧だけ残すモードではダウンロードしない（書き出し時に添付ファイル一覧へ追記される）
+    if ATTACHMENT_MODE == "manifest":
+        attachment["local_absolute_path"] = None
+        data["attachments"].append(attachment)
+        return
+    
+    # 並列ダウンロード時は先に登録し、パスは完了時に埋める（失敗時は None のまま）
+    if downloader:
+        attachment["local_absolute_path"] = None
+        data["attachments"].append(attachment)
+        downloader.submit(data["message_id"], attachment, download_dir)
+        return
+    
+    local_path = fetch_attachment(session, attachment, download_dir)
+    
+    if local_path:
+        attachment["local_absolute_path"] = local_path
+        data["attachments"].append(attachment)
+
+@METRICS.timed("extract.message")
+def extract_message_data_by_id(driver, message_id, session, download_dir, downloader=None):
+    """message_idを使って都度要素を再取得しながらデータ抽出（添付ファイル完全対応）"""
+    data = new_message_data(message_id)
     
     def get_fresh_message():
         """常に最新のメッセージ要素を取得"""
@@ -381,14 +2273,7 @@ def extract_message_data_by_id(driver, message_id, session, download_dir):
     
     try:
         # 送信者名
-        sender_selectors = [
-            "[data-testid='timeline_user-name']",
-            "p[data-testid='timeline_user-name']",
-            ".sc-iPahhU",
-            ".chatTimeLineNameBox__name",
-            "[class*='userName']"
-        ]
-        for selector in sender_selectors:
+        for selector in selectors_for("sender", SENDER_SELECTORS):
             try:
                 msg = get_fresh_message()
                 if msg:
@@ -404,20 +2289,13 @@ def extract_message_data_by_id(driver, message_id, session, download_dir):
         try:
             msg = get_fresh_message()
             if msg:
-                company_elem = msg.find_element(By.CSS_SELECTOR, ".sc-fjhLSj")
+                company_elem = msg.find_element(By.CSS_SELECTOR, COMPANY_SELECTOR)
                 data["company"] = safe_get_text(company_elem)
         except:
             pass
         
         # メッセージ本文
-        body_selectors = [
-            "pre.sc-fbFiXs",
-            "pre span",
-            "pre",
-            ".chatTimeLineTxt",
-            "[class*='message']"
-        ]
-        for selector in body_selectors:
+        for selector in selectors_for("body", BODY_SELECTORS):
             try:
                 msg = get_fresh_message()
                 if msg:
@@ -430,14 +2308,7 @@ def extract_message_data_by_id(driver, message_id, session, download_dir):
                 continue
         
         # タイムスタンプ
-        time_selectors = [
-            "._timeStamp",
-            "[data-tm]",
-            "div[data-tm]",
-            "time",
-            "[datetime]"
-        ]
-        for selector in time_selectors:
+        for selector in selectors_for("time", TIME_SELECTORS):
             try:
                 msg = get_fresh_message()
                 if msg:
@@ -462,30 +2333,15 @@ def extract_message_data_by_id(driver, message_id, session, download_dir):
         try:
             msg = get_fresh_message()
             if msg:
-                preview_images = msg.find_elements(By.CSS_SELECTOR, "img[data-file-id]._filePreview")
+                preview_images = msg.find_elements(By.CSS_SELECTOR, IMAGE_PREVIEW_SELECTOR)
                 
-                for i, img in enumerate(preview_images):
-                    file_id = safe_get_attribute(img, "data-file-id")
-                    src = safe_get_attribute(img, "src")
-                    
-                    if file_id:
-                        print(f"    🖼️ 画像プレビュー検出: file_id={file_id}")
-                        
-                        filename = f"image_{message_id}_{file_id}.jpg"
-                        
-                        if src and src.startswith('gateway/'):
-                            src = f"https://www.chatwork.com/{src}"
-                        
-                        local_path = download_file_from_chatwork(session, src, filename, download_dir)
-                        
-                        if local_path:
-                            data["attachments"].append({
-                                "type": "image_preview",
-                                "file_id": file_id,
-                                "filename": filename,
-                                "chatwork_url": src,
-                                "local_absolute_path": local_path
-                            })
+                for img in preview_images:
+                    attachment = image_preview_attachment(
+                        message_id,
+                        safe_get_attribute(img, "data-file-id"),
+                        safe_get_attribute(img, "src")
+                    )
+                    download_attachment(data, attachment, session, download_dir, downloader)
         except Exception as e:
             print(f"    ⚠️ 画像プレビュー取得エラー: {e}")
         
@@ -493,37 +2349,14 @@ def extract_message_data_by_id(driver, message_id, session, download_dir):
         try:
             msg = get_fresh_message()
             if msg:
-                file_links = msg.find_elements(By.CSS_SELECTOR, "div[data-cwopen*='download'] a[href*='gateway/download_file.php']")
+                file_links = msg.find_elements(By.CSS_SELECTOR, FILE_LINK_SELECTOR)
                 
                 for link in file_links:
-                    href = safe_get_attribute(link, "href")
-                    link_text = safe_get_text(link)
-                    
-                    file_id_match = re.search(r'file_id=(\d+)', href) if href else None
-                    file_id = file_id_match.group(1) if file_id_match else "unknown"
-                    
-                    filename_match = re.match(r'(.+?)\s*\([\d.]+\s*[KMGT]?B\)', link_text) if link_text else None
-                    if filename_match:
-                        filename = filename_match.group(1).strip()
-                    else:
-                        filename = link_text or f"file_{file_id}"
-                    
-                    if href:
-                        print(f"    📎 ファイル検出: {filename} (file_id={file_id})")
-                        
-                        if href.startswith('gateway/'):
-                            href = f"https://www.chatwork.com/{href}"
-                        
-                        local_path = download_file_from_chatwork(session, href, filename, download_dir)
-                        
-                        if local_path:
-                            data["attachments"].append({
-                                "type": "file",
-                                "file_id": file_id,
-                                "filename": filename,
-                                "chatwork_url": href,
-                                "local_absolute_path": local_path
-                            })
+                    attachment = file_link_attachment(
+                        safe_get_attribute(link, "href"),
+                        safe_get_text(link)
+                    )
+                    download_attachment(data, attachment, session, download_dir, downloader)
         except Exception as e:
             print(f"    ⚠️ ファイルリンク取得エラー: {e}")
         
@@ -531,43 +2364,17 @@ def extract_message_data_by_id(driver, message_id, session, download_dir):
         try:
             msg = get_fresh_message()
             if msg:
-                storage_links = msg.find_elements(By.CSS_SELECTOR, "a[href*='storage.chatwork.com']")
+                storage_links = msg.find_elements(By.CSS_SELECTOR, STORAGE_LINK_SELECTOR)
                 
                 for link in storage_links:
-                    href = safe_get_attribute(link, "href")
-                    link_text = safe_get_text(link)
-                    title = safe_get_attribute(link, "title")
-                    download_attr = safe_get_attribute(link, "download")
-                    
-                    if href and ('avatar' in href or 'ico_default' in href):
-                        continue
-                    
-                    filename = download_attr or title or link_text
-                    
-                    if not filename or filename == "":
-                        filename = f"storage_file_{message_id}"
-                        if href:
-                            if '.png' in href or '.jpg' in href or '.jpeg' in href:
-                                filename += '.jpg'
-                            elif '.pdf' in href:
-                                filename += '.pdf'
-                            elif '.xlsx' in href or '.xls' in href:
-                                filename += '.xlsx'
-                            elif '.docx' in href:
-                                filename += '.docx'
-                    
-                    if href:
-                        print(f"    📁 ストレージファイル検出: {filename}")
-                        
-                        local_path = download_file_from_chatwork(session, href, filename, download_dir)
-                        
-                        if local_path:
-                            data["attachments"].append({
-                                "type": "storage_file",
-                                "filename": filename,
-                                "chatwork_url": href,
-                                "local_absolute_path": local_path
-                            })
+                    attachment = storage_link_attachment(
+                        message_id,
+                        safe_get_attribute(link, "href"),
+                        safe_get_text(link),
+                        safe_get_attribute(link, "title"),
+                        safe_get_attribute(link, "download")
+                    )
+                    download_attachment(data, attachment, session, download_dir, downloader)
         except Exception as e:
             print(f"    ⚠️ ストレージファイル取得エラー: {e}")
         
@@ -575,7 +2382,7 @@ def extract_message_data_by_id(driver, message_id, session, download_dir):
         try:
             msg = get_fresh_message()
             if msg:
-                msg.find_element(By.CSS_SELECTOR, "[data-test='task-icon'], .taskIcon, [class*='task']")
+                msg.find_element(By.CSS_SELECTOR, TASK_SELECTOR)
                 data["is_task"] = True
         except:
             pass
@@ -585,26 +2392,1384 @@ def extract_message_data_by_id(driver, message_id, session, download_dir):
     
     return data
 
-def export_room_messages(driver, room_url, session, base_download_dir):
-    """特定ルームの全メッセージを取得"""
+class ExtractionCache:
+    """メッセージの抽出結果（execute_scriptが返すレコード）をSQLiteに保存するキャッシュ
+    
+    (room_id, message_id) ごとに要素のハッシュとレコードを持ち、ハッシュが一致すれば
+    保存済みのレコードを使う。件数が上限を超えたら最後に使われたのが古いものから削除する（LRU）。
+    セレクタや抽出スクリプトが変わった場合は全件を破棄する。
+    """
+    
+    def __init__(self, path, max_entries=EXTRACT_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(path), timeout=30, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE IF NOT EXISTS records (
+                room_id TEXT NOT NULL,
+                message_id TEXT NOT NULL,
+                fingerprint TEXT NOT NULL,
+                record TEXT NOT NULL,
+                used_at REAL NOT NULL,
+                PRIMARY KEY (room_id, message_id)
+            );
+            CREATE INDEX IF NOT EXISTS records_used_at ON records (used_at);
+        """)
+        
+        version = hashlib.sha256(
+            (json.dumps(message_field_selectors(), sort_keys=True) + EXTRACT_MESSAGES_SCRIPT).encode()
+        ).hexdigest()
+        row = self._conn.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()
+        if not row or row[0] != version:
+            with self._conn:
+                self._conn.execute("DELETE FROM records")
+                self._conn.execute("INSERT OR REPLACE INTO meta VALUES ('version', ?)", (version,))
+    
+    def _select(self, columns, room_id, message_ids):
+        rows = []
+        for start in range(0, len(message_ids), 500):
+            chunk = message_ids[start:start + 500]
+            rows += self._conn.execute(
+                f"SELECT message_id, {columns} FROM records WHERE room_id = ? "
+                f"AND message_id IN ({','.join('?' * len(chunk))})",
+                [str(room_id), *chunk]
+            ).fetchall()
+        return dict(rows)
+    
+    def fingerprints(self, room_id, message_ids):
+        """キャッシュ済みのハッシュ {message_id: hash}"""
+        with self._lock:
+            return self._select("fingerprint", room_id, list(message_ids))
+    
+    def take(self, room_id, message_ids):
+        """キャッシュ済みのレコードを返し、最終使用時刻を更新する"""
+        message_ids = list(message_ids)
+        if not message_ids:
+            return {}
+        with self._lock, self._conn:
+            records = {mid: json.loads(record) for mid, record in self._select("record", room_id, message_ids).items()}
+            self._conn.executemany(
+                "UPDATE records SET used_at = ? WHERE room_id = ? AND message_id = ?",
+                [(time.time(), str(room_id), mid) for mid in records]
+            )
+        return records
+    
+    def put(self, room_id, records):
+        """抽出したレコード（fingerprint付き）を保存し、上限を超えた分を削除する"""
+        rows = [
+            (str(room_id), record["message_id"], record.pop("fingerprint"),
+             json.dumps(record, ensure_ascii=False), time.time())
+            for record in records if record and record.get("fingerprint")
+        ]
+        if not rows:
+            return
+        with self._lock, self._conn:
+            self._conn.executemany("INSERT OR REPLACE INTO records VALUES (?, ?, ?, ?, ?)", rows)
+            excess = self._conn.execute("SELECT COUNT(*) FROM records").fetchone()[0] - self.max_entries
+            if excess > 0:
+                self._conn.execute(
+                    "DELETE FROM records WHERE rowid IN (SELECT rowid FROM records ORDER BY used_at LIMIT ?)",
+                    (excess,)
+                )
+                METRICS.increment("extract_cache.evictions", excess)
+    
+    def count(self, hits, misses):
+        with self._lock:
+            self.hits += hits
+            self.misses += misses
+        METRICS.increment("extract_cache.hits", hits)
+        METRICS.increment("extract_cache.misses", misses)
+    
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+    
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+_extraction_cache = None
+
+def get_extraction_cache():
+    """抽出キャッシュ（EXTRACT_CACHE_NAME が空なら None）"""
+    global _extraction_cache
+    if _extraction_cache is None and EXTRACT_CACHE_NAME:
+        _extraction_cache = ExtractionCache(Path(BASE_DOWNLOAD_DIR) / EXTRACT_CACHE_NAME)
+    return _extraction_cache
+
+def close_extraction_cache():
+    """ヒット率を表示してキャッシュを閉じる"""
+    global _extraction_cache
+    if _extraction_cache is None:
+        return
+    cache, _extraction_cache = _extraction_cache, None
+    if cache.hits or cache.misses:
+        print(f"🗃️ 抽出キャッシュ: {cache.hits}/{cache.hits + cache.misses}件ヒット（ヒット率 {cache.hit_rate():.0%}）")
+    cache.close()
+
+def iter_message_records(driver, message_ids, chunk_size=BATCH_CHUNK_SIZE, room_id=None):
+    """チャンクごとに1回のexecute_scriptでメッセージを一括抽出（DOMに無いものはNone）
+    
+    room_id を指定すると抽出キャッシュと照合し、要素が変わっていないメッセージは
+    ブラウザ内で解析せずにキャッシュ済みのレコードを返す。
+    """
+    selectors = message_field_selectors()
+    cache = get_extraction_cache() if room_id else None
+    
+    for start in range(0, len(message_ids), chunk_size):
+        chunk = message_ids[start:start + chunk_size]
+        known = cache.fingerprints(room_id, chunk) if cache else {}
+        with METRICS.span("extract.batch_chunk"):
+            records = driver.execute_script(EXTRACT_MESSAGES_SCRIPT, chunk, selectors, known) or []
+        METRICS.increment("extract.messages", len(chunk))
+        
+        if cache:
+            unchanged = [record["message_id"] for record in records if record and record.get("unchanged")]
+            cached = cache.take(room_id, unchanged)
+            
+            # 照合後に他のワーカーが削除した行は空のメッセージにせず、ブラウザで解析し直す
+            missing = [mid for mid in unchanged if mid not in cached]
+            if missing:
+                reparsed = driver.execute_script(EXTRACT_MESSAGES_SCRIPT, missing, selectors, {}) or []
+                cached.update((record["message_id"], record) for record in reparsed if record)
+            
+            fresh = [record for record in records if record and not record.get("unchanged")]
+            fresh += [cached[mid] for mid in missing if mid in cached]
+            cache.put(room_id, fresh)
+            cache.count(len(unchanged) - len(missing), len(fresh))
+            records = [
+                cached.get(record["message_id"]) if record and record.get("unchanged") else record
+                for record in records
+            ]
+        
+        for message_id, record in zip(chunk, records):
+            yield message_id, record
+
+def cached_message_records(driver, room_id, message_ids):
+    """要素のハッシュがキャッシュと一致するメッセージのレコード（1件ずつ抽出する場合用）"""
+    cache = get_extraction_cache() if room_id else None
+    if not cache:
+        return {}
+    known = cache.fingerprints(room_id, message_ids)
+    if not known:
+        cache.count(0, len(message_ids))
+        return {}
+    try:
+        fingerprints = driver.execute_script(MESSAGE_FINGERPRINTS_SCRIPT, message_ids) or []
+    except WebDriverException:
+        return {}
+    unchanged = [mid for mid, fp in zip(message_ids, fingerprints) if fp and known.get(mid) == fp]
+    cache.count(len(unchanged), len(message_ids) - len(unchanged))
+    return cache.take(room_id, unchanged)
+
+def message_data_from_record(message_id, record, session, download_dir, downloader=None):
+    """一括抽出の結果から extract_message_data_by_id と同じ形式のデータを生成"""
+    data = new_message_data(message_id)
+    
+    if not record:
+        print(f"  ⚠️  メッセージ要素が見つかりません (mid:{message_id})")
+        return data
+    
+    try:
+        data["sender"] = record.get("sender") or data["sender"]
+        data["company"] = record.get("company") or ""
+        data["body"] = record.get("body") or ""
+        data["timestamp"] = record.get("timestamp") or ""
+        data["is_task"] = bool(record.get("is_task"))
+        
+        for img in record.get("images") or []:
+            attachment = image_preview_attachment(message_id, img.get("file_id"), img.get("src"))
+            download_attachment(data, attachment, session, download_dir, downloader)
+        
+        for link in record.get("files") or []:
+            attachment = file_link_attachment(link.get("href"), link.get("text"))
+            download_attachment(data, attachment, session, download_dir, downloader)
+        
+        for link in record.get("storage") or []:
+            attachment = storage_link_attachment(
+                message_id,
+                link.get("href"),
+                link.get("text"),
+                link.get("title"),
+                link.get("download")
+            )
+            download_attachment(data, attachment, session, download_dir, downloader)
+    except Exception as e:
+        print(f"  ⚠️  メッセージ解析エラー (mid:{message_id}): {e}")
+    
+    return data
+
+def extract_room_messages(driver, message_ids, session, download_dir, downloader=None, room_id=None):
+    """メッセージIDリストを順に解析（一括抽出が使えない場合は1件ずつ抽出）"""
+    if BATCH_EXTRACTION:
+        done = 0
+        try:
+            for message_id, record in iter_message_records(driver, message_ids, room_id=room_id):
+                yield message_data_from_record(message_id, record, session, download_dir, downloader)
+                done += 1
+            return
+        except WebDriverException as e:
+            print(f"  ⚠️ 一括抽出に失敗、1件ずつの抽出に切り替えます: {e}")
+        message_ids = message_ids[done:]
+    
+    # IDベースで処理（Stale問題を根本解決）
+    for start in range(0, len(message_ids), BATCH_CHUNK_SIZE):
+        chunk = message_ids[start:start + BATCH_CHUNK_SIZE]
+        # 前回から変わっていないメッセージはキャッシュから生成し、要素ごとのWebDriver呼び出しを省く
+        cached = cached_message_records(driver, room_id, chunk)
+        for message_id in chunk:
+            if message_id in cached:
+                yield message_data_from_record(message_id, cached[message_id], session, download_dir, downloader)
+            else:
+                # 各メッセージごとに新鮮な要素を取得して処理
+                yield extract_message_data_by_id(driver, message_id, session, download_dir, downloader)
+
+def safe_file_stem(room_id, room_name):
+    """ルームの保存先に使うファイル名（{room_id}_{サニタイズ済みルーム名}）"""
+    safe_room_name = "".join(c if c.isalnum() or c in (' ', '-', '_') else '_' for c in room_name)
+    safe_room_name = safe_room_name.strip()[:50]
+    return f"{room_id}_{safe_room_name}"
+
+def write_json_atomic(path, data):
+    """一時ファイルに書いてからリネーム（途中でクラッシュしても壊れたJSONを残さない）"""
+    path = Path(path)
+    # 並列ワーカーが同じファイルを同時に書いても一時ファイルが衝突しないよう名前は毎回変える
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, indent=2)
+        # mkstemp は 0600 で作るため、従来どおりの権限（既存ファイルがあればその権限）に揃える
+        os.chmod(tmp_path, path.stat().st_mode & 0o777 if path.exists() else 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+
+def iter_jsonl(path):
+    """JSONLファイルを1行ずつ読み込む（壊れた行はスキップ）"""
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield json.loads(line)
+            except ValueError:
+                continue
+
+def truncate_partial_line(path):
+    """クラッシュで途中まで書かれた末尾の行を切り詰める（追記が壊れた行に繋がらないように）"""
+    with open(path, "rb+") as f:
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        if size == 0:
+            return
+        f.seek(size - 1)
+        if f.read(1) == b"\n":
+            return
+        
+        position = size
+        while position > 0:
+            step = min(8192, position)
+            position -= step
+            f.seek(position)
+            newline = f.read(step).rfind(b"\n")
+            if newline != -1:
+                f.truncate(position + newline + 1)
+                return
+        f.truncate(0)
+
+def parse_time_arg(text, end_of_day=False):
+    """コマンドラインの日時（"2024-01-01"・ISO形式・"90d"＝90日前）をUNIX秒に変換
+    
+    end_of_day なら日付だけの指定をその日の終わりとして扱う（--until 用）。
+    """
+    text = text.strip()
+    days = re.fullmatch(r'(\d+)d', text)
+    if days:
+        return time.time() - int(days.group(1)) * 86400
+    try:
+        value = datetime.fromisoformat(text)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"日時を解釈できません: {text}（例: 2024-01-01, 2024-01-01T09:00, 90d）")
+    if end_of_day and re.fullmatch(r'\d{4}-\d{2}-\d{2}', text):
+        return value.timestamp() + 86400 - 0.001
+    return value.timestamp()
+
+def parse_until_arg(text):
+    return parse_time_arg(text, end_of_day=True)
+
+def set_export_window(since=None, until=None):
+    global EXPORT_SINCE, EXPORT_UNTIL
+    EXPORT_SINCE, EXPORT_UNTIL = since, until
+
+def in_export_window(epoch):
+    """指定期間内か（日時が不明なメッセージは期間内として扱う）"""
+    if epoch is None:
+        return True
+    return (EXPORT_SINCE is None or epoch >= EXPORT_SINCE) and (EXPORT_UNTIL is None or epoch <= EXPORT_UNTIL)
+
+def export_window_active():
+    return EXPORT_SINCE is not None or EXPORT_UNTIL is not None
+
+def export_output_dir(base_download_dir):
+    """今回の出力先（期間指定なら期間ごとのフォルダ、それ以外はバックアップ先そのもの）"""
+    if not export_window_active():
+        return Path(base_download_dir)
+    def fmt(epoch, default):
+        return datetime.fromtimestamp(epoch).strftime("%Y%m%d") if epoch is not None else default
+    return Path(base_download_dir) / f"{EXPORT_WINDOW_DIR_PREFIX}{fmt(EXPORT_SINCE, 'start')}-{fmt(EXPORT_UNTIL, 'now')}"
+
+def backup_root(output_dir):
+    """出力先のフォルダが期間指定のフォルダなら、その親（バックアップ先）を返す"""
+    path = Path(output_dir)
+    return path.parent if path.name.startswith(EXPORT_WINDOW_DIR_PREFIX) else path
+
+def mark_room_exported(room_id):
+    """ルームカタログにエクスポート済みと記録（期間指定の実行はルーム全体を取得していないため記録しない）"""
+    if not export_window_active():
+        get_room_catalog().mark_exported(room_id)
+
+def describe_export_window():
+    def fmt(epoch):
+        return datetime.fromtimestamp(epoch).strftime("%Y-%m-%d %H:%M") if epoch is not None else ""
+    return f"{fmt(EXPORT_SINCE)} 〜 {fmt(EXPORT_UNTIL)}"
+
+def message_epoch(data):
+    """メッセージのtimestamp（"unix:秒" またはISO形式）をUNIX秒に変換（解釈できなければNone）"""
+    timestamp = (data.get("timestamp") or "").strip()
+    if timestamp.startswith("unix:"):
+        try:
+            return float(timestamp[5:])
+        except ValueError:
+            return None
+    try:
+        return datetime.fromisoformat(timestamp.replace("Z", "+00:00")).timestamp()
+    except ValueError:
+        return None
+
+class JsonlOutput:
+    """ルームのメッセージを1つのJSONLに書き出す（従来の出力形式）"""
+    
+    def __init__(self, path, append=False):
+        self.path = Path(path)
+        if append and self.path.exists():
+            truncate_partial_line(self.path)
+        self._file = open(self.path, "a" if append else "w", encoding="utf-8")
+    
+    def write(self, data):
+        self._file.write(json.dumps(data, ensure_ascii=False) + "\n")
+    
+    def sync(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+    
+    def close(self):
+        self.sync()
+        self._file.close()
+
+def segment_codec():
+    """新しく書くセグメントの圧縮方式"""
+    if SEGMENT_COMPRESSION in ("auto", "zstd") and zstandard is not None:
+        return "zstd"
+    if SEGMENT_COMPRESSION == "zstd":
+        print("⚠️ zstandard が未インストールのためgzipで圧縮します（pip install zstandard）")
+    return "gzip"
+
+def open_segment_writer(path):
+    """拡張子に応じた圧縮ストリーム（バイナリ書き込み）を開く"""
+    if path.suffix == ".zst":
+        return zstandard.ZstdCompressor(level=SEGMENT_ZSTD_LEVEL).stream_writer(open(path, "wb"))
+    return gzip.open(path, "wb", compresslevel=SEGMENT_GZIP_LEVEL)
+
+def iter_segment_lines(path):
+    """セグメントを展開しながら1行ずつ返す"""
+    if path.suffix == ".zst":
+        if zstandard is None:
+            raise RuntimeError(f"{path.name} の展開には zstandard が必要です（pip install zstandard）")
+        with open(path, "rb") as f:
+            yield from io.TextIOWrapper(zstandard.ZstdDecompressor().stream_reader(f), encoding="utf-8")
+    else:
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            yield from f
+
+def load_segment_index(path):
+    index_path = Path(path) / "index.json"
+    if not index_path.exists():
+        return None
+    with open(index_path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+class SegmentWriter:
+    """メッセージをSEGMENT_SIZE件ごとの圧縮JSONL（セグメント）に書き出し、index.json に範囲を記録する
+    
+    索引には各セグメントのmessage_idと日時の範囲が載るため、読み出し側は必要なセグメントだけを展開できる。
+    セグメントは書き終えてから索引に載せるので、索引にあるセグメントは常に完全。
+    書きかけのセグメントはクラッシュ時には失われ、次回の追記時に削除される。
+    """
+    
+    def __init__(self, path, append=False):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.index = (load_segment_index(self.path) if append else None) or {
+            "format": "jsonl-segments",
+            "segment_size": SEGMENT_SIZE,
+            "segments": []
+        }
+        self.codec = segment_codec()
+        self.raw_bytes = 0
+        self.compressed_bytes = 0
+        self.write_seconds = 0.0
+        self._stream = None
+        self._current = None
+        
+        # 索引に無いセグメント（新規作成時は全て、追記時は書きかけ）を削除
+        indexed = {segment["file"] for segment in self.index["segments"]}
+        for stale in self.path.glob("seg_*"):
+            if stale.name not in indexed:
+                stale.unlink()
+        write_json_atomic(self.path / "index.json", self.index)
+    
+    def _open_segment(self):
+        number = len(self.index["segments"]) + 1
+        name = f"seg_{number:06d}.jsonl.{'zst' if self.codec == 'zstd' else 'gz'}"
+        self._stream = open_segment_writer(self.path / name)
+        self._current = {
+            "file": name, "count": 0, "raw_bytes": 0,
+            "first_message_id": None, "last_message_id": None,
+            "min_message_id": None, "max_message_id": None,
+            "start_time": None, "end_time": None
+        }
+    
+    def write(self, data):
+        if self._stream is None:
+            self._open_segment()
+        
+        encoded = (json.dumps(data, ensure_ascii=False) + "\n").encode("utf-8")
+        start = time.perf_counter()
+        self._stream.write(encoded)
+        self.write_seconds += time.perf_counter() - start
+        
+        segment = self._current
+        message_id = data.get("message_id")
+        key = mid_key(message_id)
+        segment["count"] += 1
+        segment["raw_bytes"] += len(encoded)
+        segment["first_message_id"] = segment["first_message_id"] or message_id
+        segment["last_message_id"] = message_id
+        if key is not None:
+            if segment["min_message_id"] is None or key < mid_key(segment["min_message_id"]):
+                segment["min_message_id"] = message_id
+            if segment["max_message_id"] is None or key > mid_key(segment["max_message_id"]):
+                segment["max_message_id"] = message_id
+        epoch = message_epoch(data)
+        if epoch is not None:
+            segment["start_time"] = min(epoch, segment["start_time"] if segment["start_time"] is not None else epoch)
+            segment["end_time"] = max(epoch, segment["end_time"] if segment["end_time"] is not None else epoch)
+        
+        if segment["count"] >= SEGMENT_SIZE:
+            self._close_segment()
+    
+    def _close_segment(self):
+        start = time.perf_counter()
+        self._stream.close()
+        self.write_seconds += time.perf_counter() - start
+        
+        segment = self._current
+        segment["compressed_bytes"] = (self.path / segment["file"]).stat().st_size
+        self.raw_bytes += segment["raw_bytes"]
+        self.compressed_bytes += segment["compressed_bytes"]
+        self.index["segments"].append(segment)
+        write_json_atomic(self.path / "index.json", self.index)
+        self._stream = None
+        self._current = None
+    
+    def sync(self):
+        # 圧縮ストリームの途中は読み出せないため、セグメント単位でのみ確定する
+        pass
+    
+    def close(self):
+        if self._stream is not None:
+            self._close_segment()
+        if self.raw_bytes:
+            METRICS.increment("output.raw_bytes", self.raw_bytes)
+            METRICS.increment("output.compressed_bytes", self.compressed_bytes)
+            throughput = self.raw_bytes / 1024 / 1024 / self.write_seconds if self.write_seconds else 0.0
+            print(f"  🗜️ 圧縮 {self.raw_bytes / 1024:.0f} KB → {self.compressed_bytes / 1024:.0f} KB"
+                  f"（{self.compressed_bytes / self.raw_bytes:.1%}、{self.codec}、{throughput:.1f} MB/秒）")
+
+def open_message_output(path, append=False):
+    """出力先のパスに応じてJSONLまたはセグメントの書き出し先を開く"""
+    if Path(path).suffix == SEGMENT_SUFFIX:
+        return SegmentWriter(path, append=append)
+    return JsonlOutput(path, append=append)
+
+def message_output_path(base_download_dir, file_stem):
+    suffix = SEGMENT_SUFFIX if OUTPUT_FORMAT == "segments" else ".jsonl"
+    return Path(base_download_dir) / f"{file_stem}{suffix}"
+
+def iter_room_messages(path, since=None, until=None):
+    """ルームの出力（JSONLまたはセグメント）からメッセージを順に読み込む
+    
+    since / until（UNIX秒）を指定すると、セグメントは索引で範囲外と分かるものを展開せずに飛ばす。
+    """
+    path = Path(path)
+    if path.is_dir():
+        index = load_segment_index(path) or {"segments": []}
+        segments = [
+            segment for segment in index["segments"]
+            if not (since is not None and segment.get("end_time") is not None and segment["end_time"] < since)
+            and not (until is not None and segment.get("start_time") is not None and segment["start_time"] > until)
+        ]
+        messages = (
+            json.loads(line)
+            for segment in segments
+            for line in iter_segment_lines(path / segment["file"])
+            if line.strip()
+        )
+    else:
+        messages = iter_jsonl(path)
+    
+    for message in messages:
+        if since is not None or until is not None:
+            epoch = message_epoch(message)
+            if epoch is not None and ((since is not None and epoch < since) or (until is not None and epoch > until)):
+                continue
+        yield message
+
+class RoomMessageWriter:
+    """抽出したメッセージを順にJSONL（またはセグメント）へ追記（添付ファイルのダウンロード完了を待ってから書き出す）"""
+    
+    def __init__(self, path, downloader=None, append=False, archive=None, room_id=None, checkpoint=None):
+        self.path = Path(path)
+        self.downloader = downloader
+        self.archive = archive
+        self.room_id = room_id
+        self.checkpoint = checkpoint
+        self.count = 0
+        self._pending = deque()
+        self._output = open_message_output(self.path, append=append)
+        self._closed = False
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+    
+    def write(self, data):
+        futures = self.downloader.pop_futures(data["message_id"]) if self.downloader else []
+        self._pending.append((data, futures))
+        self._drain()
+    
+    @property
+    def backlog(self):
+        """ダウンロード完了待ちで書き出せていないメッセージ数"""
+        return len(self._pending)
+    
+    def head_futures(self):
+        return self._pending[0][1] if self._pending else []
+    
+    def drain(self):
+        """ダウンロードが終わった先頭のメッセージを書き出す"""
+        self._drain()
+    
+    def _drain(self, block=False):
+        # 抽出順を保つため、先頭のメッセージのダウンロードが終わるまで後続も待たせる
+        while self._pending:
+            data, futures = self._pending[0]
+            if block:
+                wait_futures(futures)
+            elif not all(f.done() for f in futures):
+                break
+            self._pending.popleft()
+            self._output.write(data)
+            if ATTACHMENT_MODE == "manifest" and data.get("attachments"):
+                manifest_for(backup_root(self.path.parent)).record(self.room_id, self.path, data)
+            if self.archive:
+                self.archive.add_message(self.room_id, data)
+            self.count += 1
+            if self.checkpoint and self.checkpoint.record_message(self.room_id, data["message_id"]):
+                # チェックポイントより先に出力をディスクへ確定させる
+                self._output.sync()
+                self.checkpoint.save()
+    
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._drain(block=True)
+        self._output.close()
+        if self.archive:
+            self.archive.flush()
+
+ARCHIVE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS rooms (
+    room_id TEXT PRIMARY KEY,
+    room_name TEXT,
+    room_url TEXT,
+    updated_at TEXT
+);
+CREATE TABLE IF NOT EXISTS messages (
+    message_id TEXT PRIMARY KEY,
+    room_id TEXT NOT NULL,
+    sender TEXT,
+    company TEXT,
+    body TEXT,
+    timestamp TEXT,
+    is_task INTEGER
+);
+CREATE INDEX IF NOT EXISTS messages_room_id ON messages(room_id);
+CREATE TABLE IF NOT EXISTS attachments (
+    message_id TEXT NOT NULL,
+    type TEXT,
+    file_id TEXT,
+    filename TEXT,
+    chatwork_url TEXT,
+    local_absolute_path TEXT,
+    sha256 TEXT
+);
+CREATE INDEX IF NOT EXISTS attachments_message_id ON attachments(message_id);
+CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+    body, content='messages', content_rowid='rowid', tokenize='{tokenizer}'
+);
+CREATE TRIGGER IF NOT EXISTS messages_ai AFTER INSERT ON messages BEGIN
+    INSERT INTO messages_fts(rowid, body) VALUES (new.rowid, new.body);
+END;
+CREATE TRIGGER IF NOT EXISTS messages_ad AFTER DELETE ON messages BEGIN
+    INSERT INTO messages_fts(messages_fts, rowid, body) VALUES ('delete', old.rowid, old.body);
+END;
+CREATE TRIGGER IF NOT EXISTS messages_au AFTER UPDATE ON messages BEGIN
+    INSERT INTO messages_fts(messages_fts, rowid, body) VALUES ('delete', old.rowid, old.body);
+    INSERT INTO messages_fts(rowid, body) VALUES (new.rowid, new.body);
+END;
+"""
+
+class SqliteArchive:
+    """エクスポートしたメッセージをSQLiteに保存し、本文をFTS5で全文検索できるようにする
+    
+    日本語は単語区切りが無いため trigram トークナイザ（SQLite 3.34以降）を使う。
+    trigram は3文字未満の検索語に使えないので、その場合は LIKE で検索する。
+    """
+    
+    def __init__(self, path, batch_size=SQLITE_BATCH_SIZE):
+        self.path = Path(path)
+        self.batch_size = batch_size
+        # パイプラインでは書き込みと後始末が別スレッドになる（同時には使わない）
+        self.conn = sqlite3.connect(str(self.path), timeout=30, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.trigram = sqlite3.sqlite_version_info >= (3, 34, 0)
+        self.conn.executescript(ARCHIVE_SCHEMA.format(tokenizer="trigram" if self.trigram else "unicode61"))
+        self._batch = []
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+    
+    def upsert_room(self, room_id, room_name, room_url):
+        with self.conn:
+            self.conn.execute(
+                """INSERT INTO rooms (room_id, room_name, room_url, updated_at) VALUES (?, ?, ?, ?)
+                   ON CONFLICT(room_id) DO UPDATE SET
+                       room_name = excluded.room_name, room_url = excluded.room_url, updated_at = excluded.updated_at""",
+                (str(room_id), room_name, room_url, datetime.now().isoformat())
+            )
+    
+    def add_message(self, room_id, data):
+        """メッセージをバッファに追加（batch_size件ごとに1トランザクションで書き込む）"""
+        self._batch.append((str(room_id), data))
+        if len(self._batch) >= self.batch_size:
+            self.flush()
+    
+    def flush(self):
+        if not self._batch:
+            return
+        
+        batch, self._batch = self._batch, []
+        with self.conn:
+            self.conn.executemany(
+                """INSERT INTO messages (message_id, room_id, sender, company, body, timestamp, is_task)
+                   VALUES (?, ?, ?, ?, ?, ?, ?)
+                   ON CONFLICT(message_id) DO UPDATE SET
+                       room_id = excluded.room_id, sender = excluded.sender, company = excluded.company,
+                       body = excluded.body, timestamp = excluded.timestamp, is_task = excluded.is_task""",
+                [
+                    (str(d["message_id"]), room_id, d.get("sender"), d.get("company"), d.get("body"),
+                     d.get("timestamp"), int(bool(d.get("is_task"))))
+                    for room_id, d in batch
+                ]
+            )
+            self.conn.executemany(
+                "DELETE FROM attachments WHERE message_id = ?",
+                [(str(d["message_id"]),) for _, d in batch]
+            )
+            self.conn.executemany(
+                """INSERT INTO attachments (message_id, type, file_id, filename, chatwork_url, local_absolute_path, sha256)
+                   VALUES (?, ?, ?, ?, ?, ?, ?)""",
+                [
+                    (str(d["message_id"]), a.get("type"), a.get("file_id"), a.get("filename"),
+                     a.get("chatwork_url"), a.get("local_absolute_path"), a.get("sha256"))
+                    for _, d in batch for a in d.get("attachments", [])
+                ]
+            )
+    
+    def search(self, query, room_id=None, limit=20):
+        """本文を全文検索（戻り値: room_name, room_id, message_id, timestamp, sender, body の辞書リスト）"""
+        columns = "r.room_name, m.room_id, m.message_id, m.timestamp, m.sender, m.body"
+        room_clause = " AND m.room_id = ?" if room_id else ""
+        room_args = [str(room_id)] if room_id else []
+        
+        if self.trigram and len(query) >= 3:
+            phrase = '"' + query.replace('"', '""') + '"'
+            sql = (f"SELECT {columns} FROM messages_fts f JOIN messages m ON m.rowid = f.rowid "
+                   f"LEFT JOIN rooms r ON r.room_id = m.room_id "
+                   f"WHERE messages_fts MATCH ?{room_clause} ORDER BY f.rank LIMIT ?")
+            args = [phrase] + room_args + [limit]
+        else:
+            escaped = query.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+            sql = (f"SELECT {columns} FROM messages m LEFT JOIN rooms r ON r.room_id = m.room_id "
+                   f"WHERE m.body LIKE ? ESCAPE '\\'{room_clause} ORDER BY m.rowid DESC LIMIT ?")
+            args = [f"%{escaped}%"] + room_args + [limit]
+        
+        cursor = self.conn.execute(sql, args)
+        names = [c[0] for c in cursor.description]
+        return [dict(zip(names, row)) for row in cursor.fetchall()]
+    
+    def close(self):
+        self.flush()
+        self.conn.close()
+
+def open_archive(base_download_dir):
+    """設定が有効ならバックアップ先のSQLiteアーカイブを開く"""
+    if not SQLITE_ARCHIVE_NAME:
+        return None
+    return SqliteArchive(Path(base_download_dir) / SQLITE_ARCHIVE_NAME)
+
+def room_output_paths(base_download_dir):
+    """ルームごとの出力（{room_id}_{ルーム名}.jsonl / .segments）の一覧
+    
+    添付ファイル一覧など "_" で始まる管理用のファイルはルームの出力ではないため含めない。
+    """
+    base = Path(base_download_dir)
+    return sorted(
+        list(base.glob("[0-9]*_*.jsonl")) + list(base.glob(f"[0-9]*_*{SEGMENT_SUFFIX}"))
+    )
+
+def index_exports(base_download_dir):
+    """既存のJSONL（・セグメント）エクスポートをSQLiteアーカイブに取り込む"""
+    base = Path(base_download_dir)
+    with SqliteArchive(base / (SQLITE_ARCHIVE_NAME or "archive.sqlite3")) as archive:
+        for path in room_output_paths(base):
+            room_id, _, room_name = path.stem.partition("_")
+            archive.upsert_room(room_id, room_name, f"{CHATWORK_URL}#!rid{room_id}")
+            count = 0
+            for data in iter_room_messages(path):
+                if "message_id" in data:
+                    archive.add_message(room_id, data)
+                    count += 1
+            archive.flush()
+            print(f"  ✓ {path.name}: {count}件")
+
+def search_archive(base_download_dir, query, room_id=None, limit=20):
+    """SQLiteアーカイブを検索して結果を表示"""
+    path = Path(base_download_dir) / (SQLITE_ARCHIVE_NAME or "archive.sqlite3")
+    if not path.exists():
+        print(f"❌ アーカイブがありません: {path}")
+        return []
+    
+    with SqliteArchive(path) as archive:
+        start = time.time()
+        rows = archive.search(query, room_id=room_id, limit=limit)
+        elapsed = (time.time() - start) * 1000
+    
+    for row in rows:
+        body = " ".join((row["body"] or "").split())
+        print(f"[{row['room_name'] or row['room_id']}] {row['timestamp']} {row['sender']} (mid:{row['message_id']})")
+        print(f"    {body[:120]}")
+    print(f"\n🔎 {len(rows)}件（{elapsed:.1f}ms）")
+    return rows
+
+def parse_size(text):
+    """"1.2 MB" や "10MB"・"2048" のようなサイズ表記をバイト数に変換（解釈できなければNone）"""
+    match = re.fullmatch(r'\s*([\d.]+)\s*([KMGT]?)i?B?\s*', text or "", re.IGNORECASE)
+    if not match:
+        return None
+    try:
+        value = float(match.group(1))
+    except ValueError:
+        return None
+    return int(value * 1024 ** " KMGT".index(match.group(2).upper() or " "))
+
+def manifest_key(entry):
+    return f"{entry['room_id']}:{entry['message_id']}:{entry['type']}:{entry.get('file_id') or entry.get('url')}"
+
+class AttachmentManifest:
+    """後でまとめて取得する添付ファイルの一覧（追記型JSONL）と、取得済みの記録"""
+    
+    def __init__(self, base_download_dir):
+        self.base = Path(base_download_dir)
+        self.path = self.base / ATTACHMENT_MANIFEST_NAME
+        self.fetched_path = self.base / ATTACHMENT_FETCHED_NAME
+        self._lock = threading.Lock()
+    
+    def record(self, room_id, messages_path, data):
+        """メッセージの未取得の添付ファイルを一覧に追記"""
+        lines = []
+        for attachment in data.get("attachments", []):
+            if attachment.get("local_absolute_path"):
+                continue
+            entry = {
+                "room_id": str(room_id),
+                "message_id": data["message_id"],
+                "timestamp": data.get("timestamp", ""),
+                "type": attachment.get("type"),
+                "file_id": attachment.get("file_id"),
+                "filename": attachment.get("filename"),
+                "url": attachment.get("chatwork_url"),
+                "size": attachment.get("size"),
+                "source": attachment.get("source", "web"),
+                # 期間指定の出力なら "_window_…/{ルームのフォルダ}" のようにバックアップ先からの相対パスで記録する
+                "download_dir": os.path.relpath(Path(messages_path).parent / Path(messages_path).stem, self.base)
+            }
+            lines.append(json.dumps(entry, ensure_ascii=False) + "\n")
+        
+        if lines:
+            with self._lock, open(self.path, "a", encoding="utf-8") as f:
+                f.writelines(lines)
+    
+    def entries(self):
+        """一覧の添付ファイル（同じ添付ファイルの重複は後のものを採用）"""
+        if not self.path.exists():
+            return []
+        return list({manifest_key(entry): entry for entry in iter_jsonl(self.path)}.values())
+    
+    def fetched(self):
+        """取得済みの添付ファイル（キー → ローカルパス、ファイルが残っているもののみ）"""
+        if not self.fetched_path.exists():
+            return {}
+        return {
+            entry["key"]: entry["local_path"] for entry in iter_jsonl(self.fetched_path)
+            if entry.get("local_path") and Path(entry["local_path"]).exists()
+        }
+    
+    def mark_fetched(self, key, local_path):
+        line = json.dumps({"key": key, "local_path": local_path, "fetched_at": datetime.now().isoformat()}, ensure_ascii=False)
+        with self._lock, open(self.fetched_path, "a", encoding="utf-8") as f:
+            f.write(line + "\n")
+
+_manifests = {}
+_manifests_lock = threading.Lock()
+
+def manifest_for(base_download_dir):
+    root = Path(base_download_dir).resolve()
+    with _manifests_lock:
+        if root not in _manifests:
+            _manifests[root] = AttachmentManifest(root)
+        return _manifests[root]
+
+def select_manifest_entries(entries, rooms=None, since=None, until=None, types=None, min_size=None, max_size=None):
+    """ルーム・日時（UNIX秒）・種別・サイズで絞り込む（サイズ不明のものはサイズ条件では除外しない）"""
+    selected = []
+    for entry in entries:
+        if rooms and entry["room_id"] not in rooms:
+            continue
+        if types and entry["type"] not in types:
+            continue
+        epoch = message_epoch(entry)
+        if since is not None and epoch is not None and epoch < since:
+            continue
+        if until is not None and epoch is not None and epoch > until:
+            continue
+        size = entry.get("size")
+        if size is not None and ((min_size is not None and size < min_size) or (max_size is not None and size > max_size)):
+            continue
+        selected.append(entry)
+    return selected
+
+def login_session():
+    """ブラウザを使わずにrequestsセッションを用意（保存済みセッションが無効なら一度だけログインする）"""
+    cookies = load_session()
+    session = session_from_cookies(cookies) if cookies else None
+    if session and session_is_valid(session):
+        return session
+    
+    driver, session = open_logged_in_browser()
+    driver.quit()
+    return session
+
+def fetch_attachments(base_download_dir, rooms=None, since=None, until=None, types=None,
+                      min_size=None, max_size=None, dry_run=False):
+    """添付ファイル一覧からまとめてダウンロード（取得済みのものは飛ばす）"""
+    manifest = manifest_for(base_download_dir)
+    fetched = manifest.fetched()
+    entries = [
+        entry for entry in select_manifest_entries(
+            manifest.entries(), rooms, since, until, types, min_size, max_size
+        )
+        if manifest_key(entry) not in fetched
+    ]
+    known_size = sum(entry.get("size") or 0 for entry in entries)
+    print(f"📎 取得対象: {len(entries)}件（サイズ判明分 {known_size / 1024 / 1024:.1f} MB、取得済み {len(fetched)}件は除外）")
+    if dry_run or not entries:
+        return 0
+    
+    session = login_session()
+    client = None
+    if any(entry["source"] == "api" for entry in entries):
+        client = ChatworkApiClient(CHATWORK_API_TOKEN, session=session)
+    
+    planned = []
+    for entry in entries:
+        attachment = {
+            "type": entry["type"],
+            "file_id": entry.get("file_id"),
+            "filename": entry.get("filename") or f"file_{entry.get('file_id')}",
+            "chatwork_url": entry.get("url")
+        }
+        if entry["source"] == "api":
+            # APIのダウンロードURLは期限付きのため取得時に発行する
+            try:
+                attachment["chatwork_url"] = client.file_download_url(entry["room_id"], entry["file_id"])
+            except requests.RequestException as e:
+                print(f"    ✗ ダウンロードURL取得失敗 (file_id={entry['file_id']}): {e}")
+                continue
+        
+        # ルーム名が変わっていれば現在の出力先のフォルダに保存する
+        current = find_previous_export(base_download_dir, entry["room_id"])
+        download_dir = Path(base_download_dir) / (current.stem if current else entry["download_dir"])
+        planned.append((entry, attachment, download_dir))
+    
+    # 転送前にまとめてHEADで確認し、必要な容量を見積もる
+    total = probe_attachments(session, [(attachment, download_dir) for _, attachment, download_dir in planned])
+    free = shutil.disk_usage(base_download_dir).free
+    print(f"📏 ダウンロード予定: {total / 1024 / 1024:.1f} MB（空き容量 {free / 1024 / 1024:.1f} MB）")
+    if total > free:
+        print("❌ 空き容量が不足しています。--room や --max-size で対象を絞り込んでください")
+        return 0
+    
+    pending = []
+    with AttachmentDownloader(session) as downloader:
+        for entry, attachment, download_dir in planned:
+            future = downloader.submit(entry["message_id"], attachment, download_dir)
+            pending.append((manifest_key(entry), attachment, future))
+        
+        done = 0
+        for key, attachment, future in pending:
+            if future.result():
+                manifest.mark_fetched(key, attachment["local_absolute_path"])
+                done += 1
+    
+    print(f"✅ {done}/{len(pending)}件の添付ファイルを取得しました")
+    return done
+
+def find_previous_export(base_download_dir, room_id):
+    """前回エクスポートしたルームのJSONL（またはセグメント）を探す（ルーム名変更に備えてroom_idで検索）"""
+    candidates = sorted(
+        list(Path(base_download_dir).glob(f"{room_id}_*.jsonl"))
+        + list(Path(base_download_dir).glob(f"{room_id}_*{SEGMENT_SUFFIX}")),
+        key=lambda p: p.stat().st_mtime,
+        reverse=True
+    )
+    if candidates:
+        return candidates[0]
+    
+    # 旧形式（全メッセージを1つのJSONに保存していた頃）のエクスポートをJSONLへ移行
+    legacy = sorted(
+        Path(base_download_dir).glob(f"{room_id}_*.json"),
+        key=lambda p: p.stat().st_mtime,
+        reverse=True
+    )
+    if not legacy:
+        return None
+    
+    try:
+        with open(legacy[0], "r", encoding="utf-8") as f:
+            previous = json.load(f)
+        messages = previous.get("messages", []) if isinstance(previous, dict) else []
+    except (OSError, ValueError) as e:
+        print(f"  ⚠️ 前回のエクスポートを読み込めません ({legacy[0].name}): {e}")
+        return None
+    
+    path = legacy[0].with_suffix(".jsonl")
+    with open(path, "w", encoding="utf-8") as f:
+        for message in messages:
+            f.write(json.dumps(message, ensure_ascii=False) + "\n")
+    print(f"  🔄 旧形式のエクスポートをJSONLに変換: {legacy[0].name} → {path.name}")
+    return path
+
+def convert_export(source, destination):
+    """出力形式を変えた場合に、前回の出力を新しい形式へ書き直す"""
+    output = open_message_output(destination)
+    count = 0
+    for message in iter_room_messages(source):
+        output.write(message)
+        count += 1
+    output.close()
+    
+    if Path(source).is_dir():
+        shutil.rmtree(source)
+    else:
+        Path(source).unlink()
+    print(f"  🔄 出力形式を変換: {Path(source).name} → {Path(destination).name}（{count}件）")
+
+def scan_previous_export(path):
+    """前回の出力を1件ずつ走査し、件数と最新（数値が最大）のmessage_idを返す"""
+    count = 0
+    latest_key = None
+    latest_mid = None
+    
+    for message in iter_room_messages(path):
+        count += 1
+        key = mid_key(message.get("message_id"))
+        if key is not None and (latest_key is None or key > latest_key):
+            latest_key = key
+            latest_mid = message.get("message_id")
+    
+    print(f"  📂 前回のエクスポート: {path.name} ({count}件)")
+    return count, latest_mid
+
+def prepare_room_output(base_download_dir, room_id, room_name):
+    """ルームの保存先フォルダとJSONLを用意（戻り値: フォルダ, JSONL, 前回の件数, 前回の最新message_id）"""
+    file_stem = safe_file_stem(room_id, room_name)
+    
+    download_dir = Path(base_download_dir) / file_stem
+    download_dir.mkdir(parents=True, exist_ok=True)
+    messages_path = message_output_path(base_download_dir, file_stem)
+    
+    previous_count, last_mid = 0, None
+    # 期間指定の実行は期間外のメッセージを含まないため、前回の出力を差分の基準にしない
+    previous_path = (
+        find_previous_export(base_download_dir, room_id)
+        if INCREMENTAL_EXPORT and not export_window_active() else None
+    )
+    if previous_path:
+        if previous_path.suffix != messages_path.suffix:
+            convert_export(previous_path, messages_path)
+        elif previous_path != messages_path:
+            # ルーム名が変わった場合は新しい名前に付け替えて追記する
+            previous_path.replace(messages_path)
+        previous_count, last_mid = scan_previous_export(messages_path)
+    if last_mid:
+        print(f"  🔁 差分モード: 前回の最新メッセージ mid:{last_mid} より新しいものを取得")
+    
+    return download_dir, messages_path, previous_count, last_mid
+
+@contextmanager
+def open_room_writer(messages_path, append, session, room_id=None, room_name=None, downloader=None):
+    """ルームの書き出し先（JSONL・SQLiteアーカイブ）と添付ファイルのダウンローダーを用意する（閉じるまで面倒を見る）"""
+    archive = open_archive(Path(messages_path).parent)
+    if archive:
+        archive.upsert_room(room_id, room_name, f"{CHATWORK_URL}#!rid{room_id}")
+    
+    if downloader is None and DOWNLOAD_WORKERS > 1:
+        downloader = AttachmentDownloader(session)
+    writer = RoomMessageWriter(
+        messages_path, downloader, append=append, archive=archive, room_id=room_id, checkpoint=get_checkpoint()
+    )
+    
+    try:
+        yield writer, downloader
+    finally:
+        if downloader:
+            print("  ⏳ 添付ファイルのダウンロード完了を待機中...")
+        writer.close()
+        if downloader:
+            downloader.close()
+        if archive:
+            archive.close()
+
+def write_room_messages(messages_path, append, session, produce_messages, total=None, room_id=None, room_name=None):
+    """produce_messages(downloader) が返すメッセージを順にJSONL（とSQLiteアーカイブ）へ書き出し、書き出した件数を返す"""
+    with open_room_writer(messages_path, append, session, room_id, room_name) as (writer, downloader):
+        for i, data in enumerate(in_probe_batches(downloader, produce_messages(downloader)), 1):
+            if i % 50 == 0:
+                print(f"  {i}/{total or '?'} 件処理完了...")
+            
+            writer.write(data)
+    
+    return writer.count
+
+def room_summary(room_name, room_id, room_url, download_dir, messages_path, previous_count, new_count):
+    """統合マニフェストに載せるルームの概要"""
+    return {
+        "room_name": room_name,
+        "room_id": room_id,
+        "room_url": room_url,
+        "export_date": datetime.now().isoformat(),
+        "total_messages": previous_count + new_count,
+        "new_messages": new_count,
+        "download_directory": str(download_dir),
+        "messages_file": str(messages_path)
+    }
+
+class Checkpoint:
+    """実行の進捗を記録するジャーナル（完了したルーム・途中のルームの書き出し位置・取得済みの添付ファイル）
+    
+    クラッシュやセッション切れの後に --resume で実行すると、完了済みのルームを飛ばし、
+    途中だったルームは書き出し済みのメッセージの続きから再開する。
+    """
+    
+    def __init__(self, base_download_dir, data=None, suffix=""):
+        self.path = Path(base_download_dir) / f"{Path(CHECKPOINT_NAME).stem}{suffix}.json"
+        self._lock = threading.Lock()
+        self._unsaved = 0
+        self.data = data or {
+            "started_at": datetime.now().isoformat(),
+            "master_file": None,
+            "rooms": {},
+            "downloaded_attachments": {}
+        }
+    
+    @staticmethod
+    def paths(base_download_dir):
+        """本体と並列ワーカーが書いたチェックポイントの一覧"""
+        return sorted(Path(base_download_dir).glob(f"{Path(CHECKPOINT_NAME).stem}*.json"))
+    
+    @classmethod
+    def load(cls, base_download_dir):
+        """全てのチェックポイントを読み込んで統合する（無ければNone）"""
+        merged = None
+        for path in cls.paths(base_download_dir):
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    data = json.load(f)
+            except (OSError, ValueError) as e:
+                print(f"⚠️ チェックポイントを読み込めません ({path.name}): {e}")
+                continue
+            
+            # 旧形式（ルームを区別しない {キー: パス}）の取得記録は引き継がない（実体は重複排除ストアから再利用される）
+            data["downloaded_attachments"] = {
+                folder: attachments for folder, attachments in data.get("downloaded_attachments", {}).items()
+                if isinstance(attachments, dict)
+            }
+            if merged is None:
+                merged = data
+                continue
+            for folder, attachments in data.get("downloaded_attachments", {}).items():
+                merged["downloaded_attachments"].setdefault(folder, {}).update(attachments)
+            for room_id, state in data.get("rooms", {}).items():
+                current = merged["rooms"].get(room_id)
+                if current is None or (current["status"] != "done" and (
+                        state["status"] == "done" or state.get("written", 0) > current.get("written", 0))):
+                    merged["rooms"][room_id] = state
+        return merged
+    
+    @classmethod
+    def discard(cls, base_download_dir):
+        for path in cls.paths(base_download_dir):
+            path.unlink()
+    
+    def save(self):
+        with self._lock:
+            write_json_atomic(self.path, self.data)
+            self._unsaved = 0
+    
+    def is_done(self, room_id):
+        state = self.data["rooms"].get(str(room_id))
+        return bool(state) and state["status"] == "done"
+    
+    def completed_summaries(self):
+        return [
+            state["summary"] for state in self.data["rooms"].values()
+            if state["status"] == "done" and state.get("summary")
+        ]
+    
+    def resume_room(self, room_id, messages_path, last_mid):
+        """途中で止まったルームなら、書き出し済みのmessage_idと開始時点の差分基準を返す
+        
+        戻り値: (スクロールを止めるmessage_id, 書き出し済みのmessage_idの集合)
+        """
+        state = self.data["rooms"].get(str(room_id))
+        if not state or state["status"] != "in_progress" or not Path(messages_path).exists():
+            return last_mid, set()
+        
+        baseline_mid = state.get("baseline_mid")
+        baseline_key = mid_key(baseline_mid)
+        written_ids = {
+            message.get("message_id") for message in iter_room_messages(messages_path)
+            if baseline_key is None or (mid_key(message.get("message_id")) or 0) > baseline_key
+        }
+        written_ids.discard(None)
+        print(f"  ⏯️ 中断したルームを再開: 書き出し済み {len(written_ids)}件をスキップ")
+        return baseline_mid, written_ids
+    
+    def start_room(self, room_id, room_name, messages_path, baseline_mid):
+        with self._lock:
+            state = self.data["rooms"].get(str(room_id))
+            if not state or state["status"] != "in_progress":
+                state = {"status": "in_progress", "baseline_mid": baseline_mid, "written": 0}
+                self.data["rooms"][str(room_id)] = state
+            state.update({
+                "room_name": room_name,
+                "messages_file": str(messages_path),
+                "updated_at": datetime.now().isoformat()
+            })
+        self.save()
+    
+    def record_message(self, room_id, message_id):
+        """メッセージを1件書き出したことを記録（CHECKPOINT_EVERY件ごとに保存が必要になる）"""
+        with self._lock:
+            state = self.data["rooms"].get(str(room_id))
+            if state:
+                state["written"] = state.get("written", 0) + 1
+                state["last_message_id"] = message_id
+                state["updated_at"] = datetime.now().isoformat()
+            self._unsaved += 1
+            return self._unsaved >= CHECKPOINT_EVERY
+    
+    def record_attachment(self, download_dir, key, local_path):
+        """取得した添付ファイルをルームのフォルダ（{room_id}_{ルーム名}）ごとに記録"""
+        with self._lock:
+            self.data["downloaded_attachments"].setdefault(Path(download_dir).name, {})[key] = local_path
+    
+    def downloaded_path(self, download_dir, key):
+        """前回の実行で取得済みの添付ファイルのパス（ファイルが残っている場合のみ）"""
+        if not key:
+            return None
+        with self._lock:
+            local_path = self.data["downloaded_attachments"].get(Path(download_dir).name, {}).get(key)
+        return local_path if local_path and Path(local_path).exists() else None
+    
+    def finish_room(self, room_id, summary):
+        with self._lock:
+            state = self.data["rooms"].get(str(room_id)) or {}
+            self.data["rooms"][str(room_id)] = {
+                "status": "done",
+                "summary": summary,
+                "updated_at": datetime.now().isoformat()
+            }
+            # 完了したルームの添付ファイルは書き出し済みのJSONLに記録されている
+            # （パイプラインでは次のルームのダウンロードが始まっているため、そのルームの記録だけを消す）
+            if state.get("messages_file"):
+                self.data["downloaded_attachments"].pop(Path(state["messages_file"]).with_suffix("").name, None)
+        self.save()
+
+_checkpoint = None
+
+def get_checkpoint():
+    return _checkpoint
+
+def set_checkpoint(checkpoint):
+    global _checkpoint
+    _checkpoint = checkpoint
+
+def start_checkpoint(base_download_dir, master_filename, resume=False):
+    """チェックポイントを用意する（resume=Trueなら前回の中断地点を読み込む）"""
+    data = Checkpoint.load(base_download_dir) if resume else None
+    if resume and data is None:
+        print("⚠️ 再開できるチェックポイントがありません。最初から実行します")
+    elif data:
+        done = sum(1 for state in data["rooms"].values() if state["status"] == "done")
+        print(f"⏯️ 前回の続きから再開します（完了済み {done}ルーム、開始 {data['started_at']}）")
+    
+    carried = {}
+    if not data and Checkpoint.paths(base_download_dir):
+        # 途中で止まったルームのJSONLには古い側が欠けている場合がある（ハーベストは新しい塊から書く）ため、
+        # 最大のmessage_idを差分の基準にしないよう、開始時点の基準だけは --resume 無しでも引き継ぐ
+        previous = Checkpoint.load(base_download_dir) or {}
+        carried = {
+            room_id: state for room_id, state in previous.get("rooms", {}).items()
+            if state["status"] == "in_progress"
+        }
+        print("🗑️ 前回のチェックポイントを破棄します（続きから実行するには --resume）")
+        if carried:
+            print(f"  ⏯️ 途中で止まっていた{len(carried)}ルームは開始時点の差分基準を引き継ぎます")
+    Checkpoint.discard(base_download_dir)
+    
+    checkpoint = Checkpoint(base_download_dir, data)
+    checkpoint.data["rooms"].update(carried)
+    checkpoint.data["master_file"] = checkpoint.data.get("master_file") or str(master_filename)
+    checkpoint.save()
+    set_checkpoint(checkpoint)
+    return checkpoint
+
+def resume_room_output(room_id, room_name, messages_path, last_mid):
+    """チェックポイントにルームの開始を記録し、途中で止まっていたなら再開位置を返す
+    
+    戻り値: (スクロールを止めるmessage_id, 書き出し済みのmessage_idの集合)
+    """
+    checkpoint = get_checkpoint()
+    if not checkpoint:
+        return last_mid, set()
+    
+    last_mid, written_ids = checkpoint.resume_room(room_id, messages_path, last_mid)
+    checkpoint.start_room(room_id, room_name, messages_path, last_mid)
+    return last_mid, written_ids
+
+def room_id_from_url(room_url):
+    return room_url.split("rid")[-1]
+
+def unseen_records(last_mid, written_ids=()):
+    """ハーベストした記録から、重複・差分の基準以前・書き出し済みのものを除く関数を返す
+    
+    戻り値: (records を受け取り (message_id, record) のリストを返す関数, 一度でも見たmessage_idの集合)
+    """
+    last_key = mid_key(last_mid)
+    seen = set()
+    
+    def select(records):
+        selected = []
+        for record in records:
+            message_id = record.get("message_id") if record else None
+            if not message_id or message_id in seen:
+                continue
+            seen.add(message_id)
+            if last_key is not None and (mid_key(message_id) or 0) <= last_key:
+                continue
+            if message_id in written_ids:
+                continue
+            if not in_export_window(message_epoch(record)):
+                continue
+            selected.append((message_id, record))
+        return selected
+    
+    return select, seen
+
+def harvest_room_messages(driver, room, session):
+    """スクロールしながら新しく現れたメッセージを解析・書き出す（message_idで重複排除）
+    
+    仮想化されたタイムラインで古い要素がDOMから消えても取りこぼさない。
+    書き出し順は読み込まれた塊ごと（新しい塊→古い塊）になる。
+    """
+    select, seen = unseen_records(room["last_mid"], room["written_ids"])
+    
+    print("🌾 スクロールしながらメッセージを収集します")
+    
+    with open_room_writer(room["messages_path"], room["append"], session, room["room_id"], room["room_name"]) as (writer, downloader):
+        def on_new_messages(records):
+            for data in in_probe_batches(downloader, (
+                message_data_from_record(message_id, record, session, room["download_dir"], downloader)
+                for message_id, record in select(records)
+            )):
+                writer.write(data)
+        
+        scroll_to_load_all_messages(
+            driver, stop_at_mid=room["last_mid"], on_new_messages=on_new_messages, stop_before=EXPORT_SINCE
+        )
+    
+    return finish_room_export(room, bool(seen), writer.count)
+
+def open_room(driver, room_url, base_download_dir):
+    """ルームを開いてルーム名を取得し、出力先と差分・再開の基準を用意する"""
     driver.get(room_url)
     time.sleep(4)
     
-    room_id = room_url.split("rid")[-1]
+    room_id = room_id_from_url(room_url)
     
-    room_name_selectors = [
-        ".chatRoomHeader__roomTitle",
-        "span.chatRoomHeader__roomTitle",
-        "._roomName",
-        ".room_name",
-        "[data-test='room-name']",
-        "[data-testid='room-name']",
-        "h1[class*='room']"
-    ]
+    # ページ読み込みごとに1回、ルーム画面の全項目のセレクタを判定する
+    probe_layout(driver, ["room_name", "chat_area", "message", "sender", "body", "time"])
     
     room_name = f"Room_{room_id}"
     try:
-        for selector in room_name_selectors:
+        for selector in selectors_for("room_name", ROOM_NAME_SELECTORS):
             try:
                 room_name_elem = WebDriverWait(driver, 8).until(
                     EC.presence_of_element_located((By.CSS_SELECTOR, selector))
@@ -620,129 +3785,711 @@ def export_room_messages(driver, room_url, session, base_download_dir):
     
     print(f"\n📁 ルーム: {room_name} (ID: {room_id})")
     
-    safe_room_name = "".join(c if c.isalnum() or c in (' ', '-', '_') else '_' for c in room_name)
-    safe_room_name = safe_room_name.strip()[:50]
+    # 差分エクスポート：前回の最新message_idまで読み込めばスクロールを止める
+    download_dir, messages_path, previous_count, last_mid = prepare_room_output(base_download_dir, room_id, room_name)
+    last_mid, written_ids = resume_room_output(room_id, room_name, messages_path, last_mid)
+    previous_count = previous_count or len(written_ids)
     
-    download_dir = Path(base_download_dir) / f"{room_id}_{safe_room_name}"
-    download_dir.mkdir(parents=True, exist_ok=True)
+    return {
+        "room_id": room_id,
+        "room_name": room_name,
+        "room_url": room_url,
+        "download_dir": download_dir,
+        "messages_path": messages_path,
+        "previous_count": previous_count,
+        "last_mid": last_mid,
+        "written_ids": written_ids,
+        "append": previous_count > 0 or bool(written_ids)
+    }
+
+# 最初に要素が見つかったセレクタで、メッセージIDだけを一括取得する（期間外のものは除く）
+# arguments: メッセージのセレクタ, 日時のセレクタ, 開始・終了（UNIX秒、nullなら制限なし）
+COLLECT_MESSAGE_IDS_SCRIPT = MESSAGE_TIME_JS + """
+const [selectors, timeSelectors, since, until] = arguments;
+for (const selector of selectors) {
+    const nodes = document.querySelectorAll(selector);
+    if (!nodes.length) continue;
+    const ids = [];
+    let outside = 0;
+    for (const node of nodes) {
+        const mid = node.getAttribute('data-mid');
+        if (!mid) continue;
+        const tm = since === null && until === null ? null : messageTime(node, timeSelectors);
+        if (tm !== null && ((since !== null && tm < since) || (until !== null && tm > until))) {
+            outside++;
+            continue;
+        }
+        ids.push(mid);
+    }
+    return {count: nodes.length, ids: ids, outside: outside};
+}
+return {count: 0, ids: [], outside: 0};
+"""
+
+def collect_message_ids(driver, since=None, until=None):
+    """読み込み済みのメッセージIDを取得（Stale対策の核心：要素参照は保持しない）
+    
+    since / until（UNIX秒）を指定すると、その期間外のメッセージを除く。
+    """
+    print("  📋 メッセージIDリストを取得中...")
+    
+    # IDだけを1回のスクリプトで抽出（要素ごとの get_attribute の往復をしない）
+    try:
+        result = driver.execute_script(
+            COLLECT_MESSAGE_IDS_SCRIPT, MESSAGE_ITEM_SELECTORS, TIME_SELECTORS, since, until
+        ) or {}
+    except WebDriverException as e:
+        print(f"  ⚠️ メッセージIDを取得できません: {e}")
+        return []
+    
+    if result.get("count"):
+        print(f"  {result['count']}件のメッセージを検出")
+    if result.get("outside"):
+        print(f"  ⏳ 指定期間外のメッセージを除外: {result['outside']}件")
+    return result.get("ids", [])
+
+def new_message_ids(message_ids, room):
+    """差分の基準より新しく、まだ書き出していないメッセージIDに絞り込む"""
+    if room["last_mid"]:
+        last_key = mid_key(room["last_mid"])
+        message_ids = [mid for mid in message_ids if (mid_key(mid) or 0) > last_key]
+        print(f"  🆕 新着メッセージ: {len(message_ids)}件")
+    if room["written_ids"]:
+        message_ids = [mid for mid in message_ids if mid not in room["written_ids"]]
+    return message_ids
+
+def finish_room_export(room, found, new_count):
+    """ルームの書き出し完了後の概要（メッセージが1件も無ければNone）"""
+    if not found and not room["previous_count"]:
+        print("❌ メッセージが見つかりません")
+        return None
     
-    scroll_to_load_all_messages(driver)
+    print(f"  🆕 新着メッセージ: {new_count}件")
+    return room_summary(
+        room["room_name"], room["room_id"], room["room_url"], room["download_dir"],
+        room["messages_path"], room["previous_count"], new_count
+    )
+
+@METRICS.timed("phase.room")
+def export_room_messages(driver, room_url, session, base_download_dir):
+    """特定ルームの全メッセージを取得し、{room_id}_{ルーム名}.jsonl へ逐次書き出す（戻り値はルームの概要）"""
+    room = open_room(driver, room_url, base_download_dir)
+    
+    if HARVEST_WHILE_SCROLLING:
+        # スクロール中からダウンロードを始めるため、先にセッションを用意
+        summary = harvest_room_messages(driver, room, get_session_cookies(driver))
+        record_browser_memory(driver)
+        return summary
+    
+    scroll_to_load_all_messages(driver, stop_at_mid=room["last_mid"], stop_before=EXPORT_SINCE)
+    record_browser_memory(driver)
     
     # データ取得用のセッションを準備
     session = get_session_cookies(driver)
     
-    # メッセージIDのリストを最初に取得（Stale対策の核心）
-    print("  📋 メッセージIDリストを取得中...")
-    message_ids = []
+    message_ids = collect_message_ids(driver, EXPORT_SINCE, EXPORT_UNTIL)
+    if not message_ids and not room["previous_count"]:
+        print("❌ メッセージが見つかりません")
+        return None
     
-    message_selectors = [
-        "div[data-mid]",
-        "li[data-mid]",
-        "[data-test='message-item']"
-    ]
+    message_ids = new_message_ids(message_ids, room)
+    print(f"📥 {len(message_ids)}件のメッセージとファイルを処理中...")
+    
+    new_count = write_room_messages(
+        room["messages_path"], room["append"], session,
+        lambda downloader: extract_room_messages(
+            driver, message_ids, session, room["download_dir"], downloader, room_id=room["room_id"]
+        ),
+        len(message_ids), room_id=room["room_id"], room_name=room["room_name"]
+    )
+    
+    return room_summary(
+        room["room_name"], room["room_id"], room_url, room["download_dir"],
+        room["messages_path"], room["previous_count"], new_count
+    )
+
+async def export_rooms_pipeline(driver, session, room_urls, base_download_dir, on_room_done=None):
+    """ブラウザ操作と書き出し・ダウンロードを重ねて進めるパイプライン（戻り値: ルームの概要のリスト）
     
-    for selector in message_selectors:
+    ブラウザ（スクロール読み込みとDOMからの抽出）は専用スレッドで順に処理し、抽出したメッセージを
+    上限付きのキューで書き出し側へ渡す。添付ファイルはダウンローダーのスレッドで並行して取得し、
+    書き出し側はダウンロード完了を待ちながら順番どおりに書き出す。ルームの後始末（残りの
+    ダウンロード待ち・fsync）は別スレッドで行うため、その間にブラウザは次のルームへ進める。
+    キューやダウンロード待ちが上限に達すると上流を待たせる（バックプレッシャー）。
+    JSONL・SQLiteへの書き出しとチェックポイントの保存は専用の書き出しスレッドで順に行い、
+    イベントループ（キューの受け渡しとダウンロード待ち）を止めない。
+    """
+    loop = asyncio.get_running_loop()
+    messages = asyncio.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+    stop = threading.Event()
+    browser = ThreadPoolExecutor(max_workers=1, thread_name_prefix="browser")
+    storage = ThreadPoolExecutor(max_workers=1, thread_name_prefix="writer")
+    summaries = []
+    
+    def put(item):
+        if stop.is_set():
+            raise RuntimeError("書き出し側が停止したためブラウザ側も停止します")
+        future = asyncio.run_coroutine_threadsafe(messages.put(item), loop)
+        if messages.full():
+            with METRICS.span("pipeline.backpressure"):
+                future.result()
+        else:
+            future.result()
+    
+    def produce_room(room_url):
+        with METRICS.span("phase.room"):
+            try:
+                room = open_room(driver, room_url, base_download_dir)
+            except Exception as e:
+                print(f"❌ ルーム処理エラー ({room_url}): {e}")
+                return
+            downloader = AttachmentDownloader(session) if DOWNLOAD_WORKERS > 1 else None
+            put(("room", room, downloader))
+            
+            try:
+                if HARVEST_WHILE_SCROLLING:
+                    select, seen = unseen_records(room["last_mid"], room["written_ids"])
+                    
+                    def on_new_messages(records):
+                        for data in in_probe_batches(downloader, (
+                            message_data_from_record(message_id, record, session, room["download_dir"], downloader)
+                            for message_id, record in select(records)
+                        )):
+                            put(("message", data))
+                    
+                    scroll_to_load_all_messages(
+                        driver, stop_at_mid=room["last_mid"], on_new_messages=on_new_messages, stop_before=EXPORT_SINCE
+                    )
+                    found = bool(seen)
+                else:
+                    scroll_to_load_all_messages(driver, stop_at_mid=room["last_mid"], stop_before=EXPORT_SINCE)
+                    message_ids = collect_message_ids(driver, EXPORT_SINCE, EXPORT_UNTIL)
+                    found = bool(message_ids)
+                    message_ids = new_message_ids(message_ids, room)
+                    for data in in_probe_batches(downloader, extract_room_messages(
+                        driver, message_ids, session, room["download_dir"], downloader, room_id=room["room_id"]
+                    )):
+                        put(("message", data))
+                record_browser_memory(driver)
+            except Exception as e:
+                print(f"❌ ルーム処理エラー ({room_url}): {e}")
+                put(("abort", room))
+                return
+            put(("end", room, found))
+    
+    def produce():
         try:
-            messages = driver.find_elements(By.CSS_SELECTOR, selector)
-            if messages:
-                print(f"  {len(messages)}件のメッセージを検出")
-                # IDだけ先に全て抽出（要素参照は保持しない）
-                for msg in messages:
-                    try:
-                        mid = safe_get_attribute(msg, "data-mid")
-                        if mid:
-                            message_ids.append(mid)
-                    except:
-                        continue
-                break
-        except:
+            for i, room_url in enumerate(room_urls, 1):
+                print(f"\n{'='*60}")
+                print(f"ルーム {i}/{len(room_urls)} を処理中")
+                print(f"{'='*60}")
+                produce_room(room_url)
+                time.sleep(ROOM_INTERVAL)
+        finally:
+            if not stop.is_set():
+                put(None)
+    
+    async def finish(room, stack, writer, found):
+        # ダウンロード完了待ちとfsyncはイベントループの外で行う
+        await loop.run_in_executor(None, stack.close)
+        if found is None:
+            return
+        summary = finish_room_export(room, found, writer.count)
+        if summary:
+            summaries.append(summary)
+        if on_room_done:
+            # チェックポイントと統合ファイルの保存も書き出しスレッドで順に行う
+            await loop.run_in_executor(storage, on_room_done, room["room_url"], summary)
+    
+    async def consume():
+        finishing = []
+        writer = stack = None
+        try:
+            while True:
+                item = await messages.get()
+                if item is None:
+                    break
+                
+                kind = item[0]
+                if kind == "room":
+                    _, room, downloader = item
+                    stack = ExitStack()
+                    writer, _ = await loop.run_in_executor(storage, stack.enter_context, open_room_writer(
+                        room["messages_path"], room["append"], session, room["room_id"], room["room_name"], downloader
+                    ))
+                elif kind == "message":
+                    await loop.run_in_executor(storage, writer.write, item[1])
+                    # ダウンロード待ちのメッセージが溜まりすぎたら先頭の完了を待つ
+                    while writer.backlog > PIPELINE_QUEUE_SIZE:
+                        head = [f for f in writer.head_futures() if not f.done()]
+                        if head:
+                            with METRICS.span("pipeline.download_wait"):
+                                await asyncio.wait([asyncio.wrap_future(f) for f in head])
+                        await loop.run_in_executor(storage, writer.drain)
+                else:
+                    # "end" は完了、"abort" はエラー（概要を残さず、再開時に続きから処理する）
+                    found = item[2] if kind == "end" else None
+                    finishing.append(asyncio.create_task(finish(item[1], stack, writer, found)))
+                    writer = stack = None
+        except BaseException:
+            stop.set()
+            while not messages.empty():
+                messages.get_nowait()
+            if stack:
+                await loop.run_in_executor(None, stack.close)
+            raise
+        finally:
+            await asyncio.gather(*finishing)
+    
+    try:
+        results = await asyncio.gather(loop.run_in_executor(browser, produce), consume(), return_exceptions=True)
+    finally:
+        browser.shutdown(wait=True)
+        storage.shutdown(wait=True)
+    
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+    return summaries
+
+class ChatworkApiClient:
+    """Chatwork API v2 クライアント（X-RateLimit-* ヘッダーを見て自動で間隔を調整）
+    
+    注意: API v2 のメッセージ取得は最新100件まで（force=1）しか返さないため、
+    全履歴の初回バックアップにはSelenium版を使い、APIは差分エクスポートで新着を追う用途に向く。
+    """
+    
+    def __init__(self, token, session=None, base_url=None):
+        self.base_url = base_url or CHATWORK_API_URL
+        self.session = session or requests.Session()
+        self.session.headers["X-ChatWorkToken"] = token
+        self._lock = threading.Lock()
+        self._resume_at = 0.0
+    
+    def _pace(self, response):
+        """残りリクエスト数が少なくなったらリセット時刻まで待つ"""
+        remaining = response.headers.get("X-RateLimit-Remaining")
+        reset = response.headers.get("X-RateLimit-Reset")
+        if remaining is None or reset is None:
+            return
+        
+        try:
+            remaining, reset = int(remaining), float(reset)
+        except ValueError:
+            return
+        
+        if response.status_code == 429 or remaining <= API_MIN_REMAINING:
+            with self._lock:
+                self._resume_at = max(self._resume_at, reset + 1)
+    
+    def request(self, path, params=None, max_retries=3):
+        for attempt in range(max_retries + 1):
+            wait_sec = self._resume_at - time.time()
+            if wait_sec > 0:
+                print(f"    ⏳ APIレート制限のため {wait_sec:.0f}秒待機...")
+                time.sleep(wait_sec)
+            
+            response = self.session.get(f"{self.base_url}{path}", params=params, timeout=30)
+            self._pace(response)
+            
+            METRICS.increment("api.requests")
+            if response.status_code == 429 and attempt < max_retries:
+                METRICS.increment("api.retries")
+                if self._resume_at <= time.time():
+                    self._resume_at = time.time() + 2 ** attempt
+                continue
+            
+            response.raise_for_status()
+            
+            # 新着が無い場合などは 204 No Content が返る
+            if response.status_code == 204 or not response.content:
+                return []
+            return response.json()
+    
+    def rooms(self):
+        return self.request("rooms")
+    
+    def room(self, room_id):
+        return self.request(f"rooms/{room_id}")
+    
+    def messages(self, room_id):
+        return self.request(f"rooms/{room_id}/messages", params={"force": 1})
+    
+    def files(self, room_id):
+        return self.request(f"rooms/{room_id}/files")
+    
+    def file_download_url(self, room_id, file_id):
+        return self.request(f"rooms/{room_id}/files/{file_id}", params={"create_download_url": 1}).get("download_url")
+    
+    def tasks(self, room_id):
+        return self.request(f"rooms/{room_id}/tasks")
+
+def message_data_from_api(client, room_id, message, files, task_message_ids, session, download_dir, downloader=None):
+    """APIのメッセージを extract_message_data_by_id と同じ形式に変換"""
+    data = new_message_data(str(message["message_id"]))
+    data["sender"] = (message.get("account") or {}).get("name") or data["sender"]
+    data["body"] = message.get("body", "")
+    data["timestamp"] = f"unix:{message['send_time']}" if message.get("send_time") else ""
+    data["is_task"] = data["message_id"] in task_message_ids
+    
+    for file_info in files:
+        file_id = str(file_info["file_id"])
+        print(f"    📎 ファイル検出: {file_info.get('filename')} (file_id={file_id})")
+        if ATTACHMENT_MODE == "manifest":
+            # ダウンロードURLは期限付きのため、fetch-attachments の実行時に発行する
+            download_attachment(data, {
+                "type": "file",
+                "file_id": file_id,
+                "filename": file_info.get("filename") or f"file_{file_id}",
+                "chatwork_url": None,
+                "size": file_info.get("filesize"),
+                "source": "api"
+            }, session, download_dir, downloader)
             continue
+        try:
+            download_url = client.file_download_url(room_id, file_id)
+        except requests.RequestException as e:
+            print(f"    ✗ ダウンロードURL取得失敗 (file_id={file_id}): {e}")
+            continue
+        
+        attachment = {
+            "type": "file",
+            "file_id": file_id,
+            "filename": file_info.get("filename") or f"file_{file_id}",
+            "chatwork_url": download_url,
+            "size": file_info.get("filesize")
+        }
+        download_attachment(data, attachment, session, download_dir, downloader)
     
-    if not message_ids:
-        print("❌ メッセージが見つかりません")
+    return data
+
+def api_messages_truncated(messages, last_mid):
+    """APIの上限件数が返り、その最古のメッセージが差分の基準（期間指定なら開始日時）より新しいか"""
+    if len(messages) < API_MESSAGE_LIMIT:
+        return False
+    oldest = messages[0]
+    if last_mid and int(oldest["message_id"]) <= mid_key(last_mid):
+        return False
+    if EXPORT_SINCE is not None and (oldest.get("send_time") or 0) < EXPORT_SINCE:
+        return False
+    return True
+
+@METRICS.timed("phase.room")
+def export_room_messages_api(client, room_id, base_download_dir):
+    """Chatwork APIでルームのメッセージとファイルをエクスポート（出力はSelenium版と同じJSONL）
+    
+    APIは最新100件しか返さないため、前回から100件以上増えたルームは書き出さずに None を返す。
+    """
+    room = client.room(room_id)
+    room_name = room.get("name") or f"Room_{room_id}"
+    print(f"\n📁 ルーム: {room_name} (ID: {room_id})")
+    
+    download_dir, messages_path, previous_count, last_mid = prepare_room_output(base_download_dir, room_id, room_name)
+    last_mid, written_ids = resume_room_output(room_id, room_name, messages_path, last_mid)
+    previous_count = previous_count or len(written_ids)
+    
+    messages = sorted(client.messages(room_id) or [], key=lambda m: int(m["message_id"]))
+    if api_messages_truncated(messages, last_mid):
+        # 取得できなかった間のメッセージを残したまま差分の基準を進めないよう、何も書き出さない
+        print(f"  ⚠️ APIで取得できる最新{API_MESSAGE_LIMIT}件より前に未取得のメッセージがあります")
+        print("     このルームは書き出さずにスキップします（ブラウザ版でエクスポートしてください）")
+        get_room_catalog().mark_needs_browser_export(room_id)
         return None
+    if last_mid:
+        messages = [m for m in messages if int(m["message_id"]) > mid_key(last_mid)]
+        print(f"  🆕 新着メッセージ: {len(messages)}件")
+    if written_ids:
+        messages = [m for m in messages if str(m["message_id"]) not in written_ids]
+    if EXPORT_SINCE is not None or EXPORT_UNTIL is not None:
+        messages = [m for m in messages if in_export_window(m.get("send_time"))]
     
-    print(f"📥 {len(message_ids)}件のメッセージとファイルを処理中...")
+    files_by_message = {}
+    for file_info in client.files(room_id) if messages else []:
+        files_by_message.setdefault(str(file_info.get("message_id")), []).append(file_info)
+    task_message_ids = {str(task.get("message_id")) for task in client.tasks(room_id)} if messages else set()
     
-    extracted_messages = []
+    print(f"📥 {len(messages)}件のメッセージとファイルを処理中...")
     
-    # IDベースで処理（Stale問題を根本解決）
-    for i, message_id in enumerate(message_ids, 1):
-        if i % 50 == 0:
-            print(f"  {i}/{len(message_ids)} 件処理完了...")
+    session = client.session
+    new_count = write_room_messages(
+        messages_path, previous_count > 0 or bool(written_ids), session,
+        lambda downloader: (
+            message_data_from_api(
+                client, room_id, message, files_by_message.get(str(message["message_id"]), []),
+                task_message_ids, session, download_dir, downloader
+            )
+            for message in messages
+        ),
+        len(messages), room_id=room_id, room_name=room_name
+    )
+    
+    return room_summary(room_name, room_id, f"{CHATWORK_URL}#!rid{room_id}", download_dir, messages_path, previous_count, new_count)
+
+def export_rooms_api(base_download_dir, master_filename, token=None):
+    """APIでルーム一覧を取得し、対象キーワードに一致するルームをエクスポート"""
+    client = ChatworkApiClient(token or CHATWORK_API_TOKEN)
+    
+    # 署名付きURLからのファイル取得でも接続を使い回す
+    adapter = HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE)
+    client.session.mount("https://", adapter)
+    client.session.mount("http://", adapter)
+    
+    print("\n🔍 APIでルーム一覧を取得中...")
+    all_rooms = client.rooms()
+    catalog = get_room_catalog()
+    catalog.update([
+        {"rid": room.get("room_id"), "name": room.get("name", ""), "indicator": str(room.get("last_update_time", ""))}
+        for room in all_rooms
+    ])
+    
+    rooms = []
+    for room in all_rooms:
+        should_process, matched_keyword = should_process_room(room.get("name", ""), room.get("room_id"))
+        if should_process:
+            rooms.append(room)
+            print(f"  ✓ [{matched_keyword}] {room['name'][:40]} (rid{room['room_id']})")
+    
+    print(f"\n✅ 対象ルーム: {len(rooms)}個")
+    rooms = skip_unchanged_rooms(rooms, rid_of=lambda room: room["room_id"])
+    
+    all_exports = []
+    checkpoint = get_checkpoint()
+    if checkpoint:
+        all_exports = checkpoint.completed_summaries()
+        rooms = [room for room in rooms if not checkpoint.is_done(room["room_id"])]
+    
+    needs_browser = []
+    for i, room in enumerate(rooms, 1):
+        print(f"\n{'='*60}")
+        print(f"ルーム {i}/{len(rooms)} を処理中")
+        print(f"{'='*60}")
         
-        # 各メッセージごとに新鮮な要素を取得して処理
-        data = extract_message_data_by_id(driver, message_id, session, download_dir)
-        extracted_messages.append(data)
+        try:
+            room_data = export_room_messages_api(client, room["room_id"], base_download_dir)
+        except requests.RequestException as e:
+            print(f"❌ ルーム処理エラー (rid{room['room_id']}): {e}")
+            continue
+        if room_data is None:
+            needs_browser.append(room)
+            continue
+        
+        if checkpoint:
+            checkpoint.finish_room(room["room_id"], room_data)
+        mark_room_exported(room["room_id"])
+        all_exports.append(room_data)
+        write_json_atomic(master_filename, all_exports)
+        print(f"✅ {Path(room_data['messages_file']).name} に保存しました（新着 {room_data['new_messages']}件 / 計 {room_data['total_messages']}件）")
     
-    return {
-        "room_name": room_name,
-        "room_id": room_id,
-        "room_url": room_url,
-        "export_date": datetime.now().isoformat(),
-        "total_messages": len(extracted_messages),
-        "download_directory": str(download_dir),
-        "messages": extracted_messages
-    }
+    if needs_browser:
+        print(f"\n⚠️ APIでは取りきれないルームが{len(needs_browser)}個あります（EXPORT_BACKEND = \"selenium\" でエクスポートしてください）:")
+        for room in needs_browser:
+            print(f"   - {room.get('name', '')[:40]} (rid{room['room_id']})")
+    
+    return all_exports
 
-def main():
-    BASE_DOWNLOAD_DIR = "chatwork_backup"
+def export_rooms_worker(worker_id, cookies, room_queue, base_download_dir, checkpoint_data=None, window=(None, None)):
+    """ワーカープロセス：共有キューからルームを取り出して順にエクスポート"""
+    # spawnしたプロセスには親のコマンドライン指定が引き継がれないため受け取った期間を設定する
+    set_export_window(*window)
+    
+    if checkpoint_data is not None:
+        # 進捗はワーカーごとのチェックポイントに書き、再開時にまとめて読み込む
+        set_checkpoint(Checkpoint(base_download_dir, checkpoint_data, suffix=f"_worker{worker_id}"))
+    
+    driver = create_export_driver(cookies)
+    results = []
+    
+    try:
+        session = get_session_cookies(driver)
+        
+        while True:
+            try:
+                room_url = room_queue.get_nowait()
+            except queue.Empty:
+                break
+            
+            print(f"\n[worker {worker_id}] {room_url} を処理中")
+            try:
+                room_data = export_room_messages(driver, room_url, session, base_download_dir)
+                if get_checkpoint():
+                    get_checkpoint().finish_room(room_id_from_url(room_url), room_data)
+                if room_data:
+                    results.append(room_data)
+            except Exception as e:
+                print(f"[worker {worker_id}] ❌ ルーム処理エラー ({room_url}): {e}")
+            
+            time.sleep(ROOM_INTERVAL)
+    finally:
+        driver.quit()
+        close_extraction_cache()
+        report_metrics(base_download_dir, suffix=f"_worker{worker_id}")
+    
+    return results
+
+def export_rooms_parallel(cookies, room_urls, base_download_dir, master_filename, workers=PARALLEL_WORKERS, checkpoint=None):
+    """複数のヘッドレスChromeでルームを分担してエクスポート（各ルームの出力はワーカーが個別に書き出す）"""
+    workers = max(1, min(workers, len(room_urls)))
+    print(f"\n🚀 {workers}個のブラウザで{len(room_urls)}ルームを並列エクスポート")
+    
+    all_exports = checkpoint.completed_summaries() if checkpoint else []
+    checkpoint_data = checkpoint.data if checkpoint else None
+    context = multiprocessing.get_context("spawn")
+    
+    with context.Manager() as manager:
+        room_queue = manager.Queue()
+        for room_url in room_urls:
+            room_queue.put(room_url)
+        
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context) as executor:
+            futures = [
+                executor.submit(
+                    export_rooms_worker, worker_id, cookies, room_queue, base_download_dir, checkpoint_data,
+                    (EXPORT_SINCE, EXPORT_UNTIL)
+                )
+                for worker_id in range(1, workers + 1)
+            ]
+            for future in as_completed(futures):
+                try:
+                    all_exports.extend(future.result())
+                except Exception as e:
+                    print(f"❌ ワーカーが異常終了しました: {e}")
+                write_json_atomic(master_filename, all_exports)
+    
+    return all_exports
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Chatwork 特定ルームバックアップツール")
+    parser.add_argument("--resume", action="store_true", help="前回中断した実行の続きから再開する")
+    parser.add_argument("--since", type=parse_time_arg, help="この日時以降のメッセージだけをエクスポート（例: 2024-01-01, 90d）")
+    parser.add_argument("--until", type=parse_until_arg, help="この日時以前のメッセージだけをエクスポート（例: 2024-12-31）")
+    subparsers = parser.add_subparsers(dest="command")
+    
+    search_parser = subparsers.add_parser("search", help="SQLiteアーカイブを全文検索")
+    search_parser.add_argument("query", help="検索語")
+    search_parser.add_argument("--room", help="ルームIDで絞り込む")
+    search_parser.add_argument("--limit", type=int, default=20, help="表示件数")
+    
+    subparsers.add_parser("index", help="既存のJSONLエクスポートをSQLiteアーカイブに取り込む")
+    
+    fetch_parser = subparsers.add_parser("fetch-attachments", help="添付ファイル一覧（manifestモード）からまとめてダウンロード")
+    fetch_parser.add_argument("--room", action="append", help="ルームIDで絞り込む（複数指定可）")
+    fetch_parser.add_argument("--since", type=parse_time_arg, help="この日時以降のメッセージ（例: 2024-01-01, 90d）")
+    fetch_parser.add_argument("--until", type=parse_until_arg, help="この日時以前のメッセージ（例: 2024-12-31）")
+    fetch_parser.add_argument("--type", action="append", choices=["file", "image", "image_preview", "storage_file"], help="種別で絞り込む")
+    fetch_parser.add_argument("--min-size", type=parse_size, help="最小サイズ（例: 100KB）")
+    fetch_parser.add_argument("--max-size", type=parse_size, help="最大サイズ（例: 10MB）")
+    fetch_parser.add_argument("--dry-run", action="store_true", help="件数とサイズの表示のみ")
+    
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    
+    if args.command == "search":
+        search_archive(BASE_DOWNLOAD_DIR, args.query, room_id=args.room, limit=args.limit)
+        return
+    if args.command == "index":
+        print("📚 JSONLエクスポートをSQLiteアーカイブに取り込み中...")
+        index_exports(BASE_DOWNLOAD_DIR)
+        return
+    if args.command == "fetch-attachments":
+        fetch_attachments(
+            BASE_DOWNLOAD_DIR,
+            rooms=set(args.room) if args.room else None,
+            since=args.since,
+            until=args.until,
+            types=set(args.type) if args.type else None,
+            min_size=args.min_size,
+            max_size=args.max_size,
+            dry_run=args.dry_run
+        )
+        report_metrics(BASE_DOWNLOAD_DIR)
+        return
+    
     Path(BASE_DOWNLOAD_DIR).mkdir(exist_ok=True)
     
     print("\n" + "="*60)
     print("Chatwork 特定ルームバックアップツール")
     print("="*60)
-    print(f"対象キーワード: {', '.join(TARGET_KEYWORDS)}")
+    print(f"フィルター: {get_room_filter().describe()}")
+    set_export_window(args.since, args.until)
+    export_dir = export_output_dir(BASE_DOWNLOAD_DIR)
+    if export_window_active():
+        print(f"期間: {describe_export_window()}（出力先: {export_dir}/）")
+        export_dir.mkdir(exist_ok=True)
     print("="*60 + "\n")
     
-    options = webdriver.ChromeOptions()
-    options.add_argument("--disable-blink-features=AutomationControlled")
-    options.add_argument("--start-maximized")
+    master_filename = export_dir / f"_all_rooms_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
     
-    driver = webdriver.Chrome(options=options)
+    # 再開時は前回の統合ファイルを引き継ぐ
+    checkpoint = start_checkpoint(export_dir, master_filename, resume=args.resume)
+    master_filename = Path(checkpoint.data["master_file"])
+    
+    # API版はブラウザを使わない
+    if EXPORT_BACKEND == "api":
+        if not CHATWORK_API_TOKEN:
+            print("❌ 環境変数 CHATWORK_API_TOKEN にAPIトークンを設定してください")
+            return
+        all_exports = export_rooms_api(export_dir, master_filename)
+        write_json_atomic(master_filename, all_exports)
+        Checkpoint.discard(export_dir)
+        print(f"\n✅ 全ルームのエクスポート完了（統合ファイル: {master_filename}、処理ルーム数: {len(all_exports)}）")
+        report_metrics(BASE_DOWNLOAD_DIR)
+        return
+    
+    driver = None
     
     try:
-        login_chatwork(driver)
-        session = get_session_cookies(driver)
+        driver, session = open_logged_in_browser()
         room_urls = get_all_room_urls(driver)
         
         if not room_urls:
             print("❌ 対象ルームが見つかりませんでした")
             return
         
-        all_exports = []
-        processed_count = 0
+        # 統合ファイルは各ルームの概要とJSONLのパスを並べたマニフェスト（メッセージ本体は保持しない）
+        all_exports = checkpoint.completed_summaries()
+        room_urls = [url for url in room_urls if not checkpoint.is_done(room_id_from_url(url))]
+        
+        def record_room(room_url, room_data):
+            checkpoint.finish_room(room_id_from_url(room_url), room_data)
+            if room_data:
+                mark_room_exported(room_data["room_id"])
+                all_exports.append(room_data)
+                write_json_atomic(master_filename, all_exports)
+                
+                print(f"✅ {Path(room_data['messages_file']).name} に保存しました（新着 {room_data['new_messages']}件 / 計 {room_data['total_messages']}件）")
+        
+        if PARALLEL_WORKERS > 1:
+            all_exports = export_rooms_parallel(
+                driver.get_cookies(), room_urls, export_dir, master_filename, checkpoint=checkpoint
+            )
+            for room_data in all_exports:
+                mark_room_exported(room_data["room_id"])
+            room_urls = []
+        elif EXPORT_PIPELINE:
+            asyncio.run(export_rooms_pipeline(driver, session, room_urls, export_dir, on_room_done=record_room))
+            room_urls = []
         
         for i, room_url in enumerate(room_urls, 1):
             print(f"\n{'='*60}")
             print(f"ルーム {i}/{len(room_urls)} を処理中")
             print(f"{'='*60}")
             
-            room_data = export_room_messages(driver, room_url, session, BASE_DOWNLOAD_DIR)
+            record_room(room_url, export_room_messages(driver, room_url, session, export_dir))
             
-            if room_data:
-                all_exports.append(room_data)
-                processed_count += 1
-                
-                safe_name = "".join(c if c.isalnum() or c in (' ', '-', '_') else '_' for c in room_data['room_name'])
-                safe_name = safe_name.strip()[:50]
-                
-                filename = Path(BASE_DOWNLOAD_DIR) / f"{room_data['room_id']}_{safe_name}.json"
-                with open(filename, "w", encoding="utf-8") as f:
-                    json.dump(room_data, f, ensure_ascii=False, indent=2)
-                
-                print(f"✅ {filename.name} に保存しました")
-            
-            time.sleep(3)
+            time.sleep(ROOM_INTERVAL)
+        
+        write_json_atomic(master_filename, all_exports)
+        Checkpoint.discard(export_dir)
         
-        master_filename = Path(BASE_DOWNLOAD_DIR) / f"_all_rooms_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
-        with open(master_filename, "w", encoding="utf-8") as f:
-            json.dump(all_exports, f, ensure_ascii=False, indent=2)
+        # 実行中に更新されたCookieを次回のために保存し直す
+        save_session(driver.get_cookies())
         
         print(f"\n{'='*60}")
         print(f"✅ 全ルームのエクスポート完了")
         print(f"   統合ファイル: {master_filename}")
-        print(f"   ダウンロード先: {BASE_DOWNLOAD_DIR}/")
+        print(f"   ダウンロード先: {export_dir}/")
         print(f"   処理ルーム数: {len(all_exports)}")
         print(f"{'='*60}")
         
@@ -752,7 +4499,10 @@ def main():
         traceback.print_exc()
     finally:
         print("\nブラウザを閉じます...")
-        driver.quit()
+        if driver:
+            driver.quit()
+        close_extraction_cache()
+        report_metrics(BASE_DOWNLOAD_DIR)
 
 if __name__ == "__main__":
     main()
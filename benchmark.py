@@ -0,0 +1,659 @@
+"""Chatworkバックアップツールのオフラインベンチマーク
+
+ローカルに模擬Chatworkサーバー（ルーム一覧・遅延ロードするタイムライン・添付ファイル）を立て、
+app.py の実際の関数で読み込み・解析・ダウンロードの速度を計測する。
+
+    python benchmark.py                     # 1k / 10k / 100k 件のルームで計測
+    python benchmark.py --sizes 1000 5000   # ルームサイズを指定
+    python benchmark.py --compare-profiles  # 従来のChromeと軽量化したChromeのメモリ・時間を比較
+"""
+import argparse
+import html
+import json
+import resource
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from pathlib import Path
+from urllib.parse import urlparse, parse_qs
+
+from selenium import webdriver
+from selenium.webdriver.common.by import By
+from selenium.webdriver.support.ui import WebDriverWait
+
+import app
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+MID_BASE = 1_000_000     # 模擬メッセージのdata-midの開始値
+PAGE_SIZE = 100          # 1回の遅延ロードで追加するメッセージ数
+FILE_EVERY = 25          # 何件ごとにファイル添付を付けるか
+IMAGE_EVERY = 40         # 何件ごとに画像プレビューを付けるか
+FILE_SIZE = 256 * 1024   # 添付ファイルのサイズ（バイト）
+PREVIEW_SIZE = 16 * 1024 # プレビュー画像のサイズ（バイト）
+API_PAGE_LIMIT = 100     # 模擬APIがメッセージ取得で返す最大件数（本物のAPI v2と同じ）
+
+# 模擬Chatworkのページ（ルーム一覧 + ハッシュ #!rid{rid} で開くタイムライン）
+PAGE_TEMPLATE = """<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>Chatwork stand-in</title>
+<style>
+body { margin: 0; display: flex; font-family: sans-serif; }
+ul[role='list'] { width: 240px; height: 100vh; overflow-y: auto; margin: 0; padding: 0; }
+#main { flex: 1; }
+[role='log'] { height: 600px; overflow-y: auto; overflow-anchor: none; }
+[data-mid] { padding: 8px; border-bottom: 1px solid #eee; }
+</style></head>
+<body>
+<ul role="list">__ROOMS__</ul>
+<div id="main"></div>
+<script>
+const ROOMS = __ROOM_JSON__;
+let state = null;
+
+function renderMessage(m) {
+    let html = '<div data-mid="' + m.mid + '">'
+        + '<p data-testid="timeline_user-name">' + m.sender + '</p>'
+        + '<p class="sc-fjhLSj">' + m.company + '</p>'
+        + '<div class="_timeStamp" data-tm="' + m.tm + '">' + m.time_text + '</div>'
+        + '<pre class="sc-fbFiXs">' + m.body + '</pre>';
+    if (m.file) {
+        html += '<div data-cwopen="[download]"><a href="gateway/download_file.php?file_id=' + m.file.file_id + '">'
+            + m.file.name + ' (' + m.file.size_text + ')</a></div>';
+    }
+    if (m.image) {
+        html += '<img class="_filePreview" data-file-id="' + m.image.file_id
+            + '" src="gateway/download_file.php?bin=1&preview=1&file_id=' + m.image.file_id + '">';
+    }
+    return html + '</div>';
+}
+
+async function fetchPage(rid, before) {
+    const res = await fetch('/api/rooms/' + rid + '/messages?before=' + before + '&limit=__PAGE_SIZE__');
+    return res.json();
+}
+
+async function loadOlder() {
+    if (!state || state.loading || state.done) return;
+    state.loading = true;
+    const log = state.log;
+    const page = await fetchPage(state.rid, state.oldest);
+    if (page.messages.length) {
+        const previousHeight = log.scrollHeight;
+        log.insertAdjacentHTML('afterbegin', page.messages.map(renderMessage).join(''));
+        state.oldest = page.messages[0].mid;
+        log.scrollTop += log.scrollHeight - previousHeight;
+    }
+    state.done = !page.has_more;
+    state.loading = false;
+}
+
+async function openRoom() {
+    const match = location.hash.match(/rid(\\d+)/);
+    const main = document.getElementById('main');
+    if (!match) { main.innerHTML = ''; state = null; return; }
+    const rid = match[1];
+    main.innerHTML = '<span class="chatRoomHeader__roomTitle">' + (ROOMS[rid] || rid) + '</span><div role="log"></div>';
+    const log = main.querySelector("[role='log']");
+    state = {rid: rid, log: log, oldest: '', loading: false, done: false};
+    const page = await fetchPage(rid, '');
+    log.innerHTML = page.messages.map(renderMessage).join('');
+    state.oldest = page.messages.length ? page.messages[0].mid : '';
+    state.done = !page.has_more;
+    log.scrollTop = log.scrollHeight;
+    log.addEventListener('scroll', () => { if (log.scrollTop < 200) loadOlder(); });
+}
+
+window.addEventListener('hashchange', openRoom);
+openRoom();
+</script>
+</body></html>
+"""
+
+def make_message(rid, index):
+    """ルーム内のindex番目（0が最古）の模擬メッセージ"""
+    mid = MID_BASE + index
+    tm = 1_600_000_000 + index * 60
+    message = {
+        "mid": str(mid),
+        "sender": f"森田 {index % 17}",
+        "company": f"株式会社サンプル{index % 5}",
+        "tm": tm,
+        "time_text": time.strftime("%Y/%m/%d %H:%M", time.localtime(tm)),
+        "body": html.escape(f"ルーム{rid}のメッセージ{index}です。" + "本文" * (index % 30)),
+        "file": None,
+        "image": None
+    }
+    if index % FILE_EVERY == 0:
+        message["file"] = {
+            "file_id": f"{rid}{index:07d}",
+            "name": f"資料_{index}.pdf",
+            "size_text": f"{FILE_SIZE / 1024:.1f} KB"
+        }
+    if index % IMAGE_EVERY == 0:
+        message["image"] = {"file_id": f"9{rid}{index:07d}"}
+    return message
+
+class StandInServer:
+    """模擬Chatworkサーバー（別スレッドで起動）"""
+
+    def __init__(self, rooms, latency=0.1, api_rate_limit=300, api_rate_window=300):
+        self.rooms = rooms   # {rid: (ルーム名, メッセージ数)}
+        self.latency = latency
+        self.bytes_served = 0
+        self.browser_bytes = 0
+        self.api_requests = 0
+        self.api_rate_limit = api_rate_limit
+        self.api_rate_window = api_rate_window
+        self._api_window_start = time.time()
+        self._api_window_count = 0
+        self._lock = threading.Lock()
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), self._handler_class())
+        self.url = f"http://127.0.0.1:{self.httpd.server_address[1]}/"
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def count_bytes(self, size):
+        with self._lock:
+            self.bytes_served += size
+
+    def count_browser_bytes(self, size):
+        with self._lock:
+            self.browser_bytes += size
+
+    def page(self):
+        items = "".join(
+            f'<li role="tab" data-rid="{rid}" aria-label="{html.escape(name)}">{html.escape(name)}</li>'
+            for rid, (name, _) in self.rooms.items()
+        )
+        room_json = json.dumps({rid: name for rid, (name, _) in self.rooms.items()}, ensure_ascii=False)
+        return (PAGE_TEMPLATE
+                .replace("__ROOMS__", items)
+                .replace("__ROOM_JSON__", room_json)
+                .replace("__PAGE_SIZE__", str(PAGE_SIZE)))
+
+    def rate_limit(self):
+        """模擬APIのレート制限（戻り値: 残り回数, リセット時刻, 制限超過か）"""
+        with self._lock:
+            now = time.time()
+            if now - self._api_window_start >= self.api_rate_window:
+                self._api_window_start = now
+                self._api_window_count = 0
+            self._api_window_count += 1
+            self.api_requests += 1
+            remaining = max(0, self.api_rate_limit - self._api_window_count)
+            reset = int(self._api_window_start + self.api_rate_window)
+            return remaining, reset, self._api_window_count > self.api_rate_limit
+
+    def api(self, path, query):
+        """Chatwork API v2 の模擬レスポンス（メッセージは最新100件のみ）"""
+        parts = path.strip("/").split("/")[1:]
+        if parts == ["rooms"]:
+            return [{"room_id": int(rid), "name": name} for rid, (name, _) in self.rooms.items()]
+
+        rid = parts[1]
+        if rid not in self.rooms:
+            return None
+        name, total = self.rooms[rid]
+        latest = [make_message(rid, i) for i in range(max(0, total - API_PAGE_LIMIT), total)]
+
+        if len(parts) == 2:
+            return {"room_id": int(rid), "name": name}
+        if parts[2] == "messages":
+            return [{
+                "message_id": m["mid"],
+                "account": {"account_id": 1, "name": m["sender"]},
+                "body": html.unescape(m["body"]),
+                "send_time": m["tm"],
+                "update_time": 0
+            } for m in latest]
+        if parts[2] == "files" and len(parts) == 3:
+            return [{
+                "file_id": int(m["file"]["file_id"]),
+                "message_id": m["mid"],
+                "filename": m["file"]["name"],
+                "filesize": FILE_SIZE,
+                "upload_time": m["tm"]
+            } for m in latest if m["file"]]
+        if parts[2] == "files":
+            return {
+                "file_id": int(parts[3]),
+                "download_url": f"{self.url}gateway/download_file.php?file_id={parts[3]}"
+            }
+        if parts[2] == "tasks":
+            return []
+        return None
+
+    def messages(self, rid, before, limit):
+        _, total = self.rooms[rid]
+        end = total if not before else int(before) - MID_BASE
+        start = max(0, end - limit)
+        return {
+            "messages": [make_message(rid, i) for i in range(start, end)],
+            "has_more": start > 0
+        }
+
+    def _handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"   # Keep-Aliveを有効にしてコネクション再利用を計測できるようにする
+
+            def log_message(self, format, *args):
+                pass
+
+            def send_body(self, body, content_type):
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                parsed = urlparse(self.path)
+                query = parse_qs(parsed.query)
+
+                if parsed.path.startswith("/v2/"):
+                    self.do_api(parsed)
+                elif parsed.path in ("/", "/index.html"):
+                    self.send_body(server.page().encode("utf-8"), "text/html; charset=utf-8")
+                elif parsed.path.startswith("/api/rooms/"):
+                    rid = parsed.path.split("/")[3]
+                    time.sleep(server.latency)
+                    page = server.messages(rid, query.get("before", [""])[0], int(query.get("limit", [PAGE_SIZE])[0]))
+                    self.send_body(json.dumps(page, ensure_ascii=False).encode("utf-8"), "application/json")
+                elif parsed.path == "/gateway/download_file.php":
+                    time.sleep(server.latency)
+                    size = PREVIEW_SIZE if "preview" in query else FILE_SIZE
+                    file_id = query.get("file_id", ["0"])[0].encode()
+                    body = (file_id * (size // len(file_id) + 1))[:size]
+                    # ブラウザによるプレビュー画像の表示分は除き、requests からの取得のみ数える
+                    if self.headers.get("User-Agent", "").startswith("python-requests"):
+                        server.count_bytes(len(body))
+                    else:
+                        server.count_browser_bytes(len(body))
+                    self.send_body(body, "application/octet-stream")
+                else:
+                    self.send_error(404)
+
+            def do_api(self, parsed):
+                if not self.headers.get("X-ChatWorkToken"):
+                    self.send_error(401)
+                    return
+                time.sleep(server.latency)
+                remaining, reset, limited = server.rate_limit()
+                payload = None if limited else server.api(parsed.path, parse_qs(parsed.query))
+                body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+                self.send_response(429 if limited else (200 if payload is not None else 404))
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.send_header("X-RateLimit-Limit", str(server.api_rate_limit))
+                self.send_header("X-RateLimit-Remaining", str(remaining))
+                self.send_header("X-RateLimit-Reset", str(reset))
+                self.end_headers()
+                self.wfile.write(body)
+
+        return Handler
+
+def count_webdriver_calls(driver):
+    """driver.execute をラップしてWebDriverコマンドの呼び出し回数を数える"""
+    counter = Counter()
+    original_execute = driver.execute
+
+    def counting_execute(driver_command, params=None):
+        counter[driver_command] += 1
+        return original_execute(driver_command, params)
+
+    driver.execute = counting_execute
+    return counter
+
+class PeakRssSampler:
+    """Python本体（と psutil があればChromeを含む子プロセス）のピークRSSを計測"""
+
+    def __init__(self, interval=0.5):
+        self.interval = interval
+        self.peak_tree = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        if not psutil:
+            return
+        me = psutil.Process()
+        while not self._stop.is_set():
+            total = 0
+            for proc in [me] + me.children(recursive=True):
+                try:
+                    total += proc.memory_info().rss
+                except psutil.Error:
+                    continue
+            self.peak_tree = max(self.peak_tree, total)
+            self._stop.wait(self.interval)
+
+    @staticmethod
+    def peak_python():
+        # Linux の ru_maxrss はKB単位
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def create_driver(profile="full"):
+    """計測用のChrome（"full": 画像なども読み込む従来の設定 / "trimmed": app.create_export_driver の軽量設定）"""
+    if profile == "trimmed":
+        return app.create_export_driver()
+    options = webdriver.ChromeOptions()
+    options.add_argument("--headless=new")
+    options.add_argument("--window-size=1920,1080")
+    return webdriver.Chrome(options=options)
+
+def chrome_rss(driver):
+    """ChromeDriver配下のChromeプロセス全体のRSS（psutil が無ければ0）"""
+    if not psutil:
+        return 0
+    try:
+        root = psutil.Process(driver.service.process.pid)
+    except (AttributeError, psutil.Error):
+        return 0
+    total = 0
+    for proc in root.children(recursive=True):
+        try:
+            total += proc.memory_info().rss
+        except psutil.Error:
+            continue
+    return total
+
+def benchmark_profile(driver, server, rid, size, profile):
+    """1ルームを開いて全件読み込むまでの時間と、その時点のブラウザのメモリを計測"""
+    browser_bytes_before = server.browser_bytes
+    start = time.time()
+    driver.get(f"{server.url}#!rid{rid}")
+    WebDriverWait(driver, 30).until(lambda d: d.find_elements(By.CSS_SELECTOR, "[data-mid]"))
+    app.scroll_to_load_all_messages(driver)
+    elapsed = time.time() - start
+
+    memory = app.browser_memory(driver) or {"js_heap_mb": 0.0, "dom_nodes": 0}
+    return {
+        "profile": profile,
+        "messages": size,
+        "room_sec": elapsed,
+        "js_heap_mb": memory["js_heap_mb"],
+        "dom_nodes": memory["dom_nodes"],
+        "chrome_rss": chrome_rss(driver),
+        "browser_bytes": server.browser_bytes - browser_bytes_before
+    }
+
+def benchmark_room(driver, server, rid, size, work_dir, sample_size, max_downloads):
+    """1ルーム分の読み込み・解析・ダウンロードを計測"""
+    calls = count_webdriver_calls(driver)
+    result = {"messages": size}
+
+    driver.get(f"{server.url}#!rid{rid}")
+    time.sleep(1)
+
+    # 1. スクロール読み込み
+    calls.clear()
+    start = time.time()
+    app.scroll_to_load_all_messages(driver)
+    elapsed = time.time() - start
+    result["scroll_sec"] = elapsed
+    result["scroll_msgs_per_sec"] = size / elapsed if elapsed else 0.0
+    result["scroll_calls"] = sum(calls.values())
+
+    message_ids = driver.execute_script(
+        "return Array.from(document.querySelectorAll('[data-mid]')).map(n => n.getAttribute('data-mid'));"
+    )
+    result["loaded"] = len(message_ids)
+
+    # 2. 一括抽出（iter_message_records）
+    calls.clear()
+    start = time.time()
+    records = [record for _, record in app.iter_message_records(driver, message_ids)]
+    elapsed = time.time() - start
+    result["batch_msgs_per_sec"] = len(records) / elapsed if elapsed else 0.0
+    result["batch_calls_per_msg"] = sum(calls.values()) / max(len(records), 1)
+
+    # 3. 従来の1件ずつの抽出（extract_message_data_by_id）はサンプルのみ計測
+    # 添付ファイル付きのメッセージは除外（ダウンロード時間を混ぜない）
+    sample = [
+        mid for mid in message_ids
+        if (int(mid) - MID_BASE) % FILE_EVERY and (int(mid) - MID_BASE) % IMAGE_EVERY
+    ][:sample_size]
+    session = app.get_session_cookies(driver)
+    calls.clear()
+    start = time.time()
+    for mid in sample:
+        app.extract_message_data_by_id(driver, mid, session, work_dir / "per_message")
+    elapsed = time.time() - start
+    result["per_message_msgs_per_sec"] = len(sample) / elapsed if elapsed else 0.0
+    result["per_message_calls_per_msg"] = sum(calls.values()) / max(len(sample), 1)
+
+    # 4. 添付ファイルのダウンロード（download_file_from_chatwork を並列プール経由で実行）
+    attachments = []
+    for record in records:
+        if not record:
+            continue
+        for img in record["images"]:
+            attachments.append({"type": "image_preview", "file_id": img["file_id"],
+                                "filename": f"image_{img['file_id']}.jpg", "chatwork_url": img["src"]})
+        for link in record["files"]:
+            attachments.append({"type": "file", "file_id": link["href"].split("file_id=")[-1],
+                                "filename": link["text"], "chatwork_url": link["href"]})
+    attachments = attachments[:max_downloads]
+
+    bytes_before = server.bytes_served
+    start = time.time()
+    data = app.new_message_data("bench")
+    with app.AttachmentDownloader(session) as downloader:
+        for attachment in attachments:
+            app.download_attachment(data, attachment, session, work_dir / f"room_{rid}", downloader)
+    elapsed = time.time() - start
+    downloaded = server.bytes_served - bytes_before
+    result["downloads"] = len(attachments)
+    result["download_bytes_per_sec"] = downloaded / elapsed if elapsed else 0.0
+
+    return result
+
+def benchmark_api(server, rid, size, work_dir):
+    """API版エクスポート（export_room_messages_api）を計測"""
+    client = app.ChatworkApiClient("benchmark-token", base_url=f"{server.url}v2/")
+    output_dir = work_dir / "api"
+    output_dir.mkdir(parents=True, exist_ok=True)
+    if size > API_PAGE_LIMIT:
+        # 前回のエクスポートが無く100件を超えるルームはAPI版では書き出さないため、
+        # 模擬APIが返す最古のメッセージまでを前回分として置き、差分エクスポートを計測する
+        baseline = make_message(rid, size - API_PAGE_LIMIT)
+        with open(output_dir / f"{rid}_previous.jsonl", "w", encoding="utf-8") as f:
+            f.write(json.dumps({"message_id": baseline["mid"]}, ensure_ascii=False) + "\n")
+    requests_before = server.api_requests
+    bytes_before = server.bytes_served
+
+    start = time.time()
+    summary = app.export_room_messages_api(client, rid, output_dir)
+    elapsed = time.time() - start
+    exported = summary["new_messages"] if summary else None
+
+    return {
+        "messages": size,
+        "exported": exported,
+        "api_sec": elapsed,
+        "api_msgs_per_sec": exported / elapsed if exported and elapsed else 0.0,
+        "api_requests": server.api_requests - requests_before,
+        "api_download_bytes": server.bytes_served - bytes_before
+    }
+
+def output_size(path):
+    path = Path(path)
+    if path.is_dir():
+        return sum(p.stat().st_size for p in path.iterdir())
+    return path.stat().st_size
+
+def benchmark_output(rid, size, work_dir):
+    """出力形式ごとの書き出し速度とサイズ（JSONL / gzip・zstdのセグメント）"""
+    messages = []
+    for index in range(size):
+        m = make_message(rid, index)
+        data = app.new_message_data(m["mid"])
+        data.update(sender=m["sender"], company=m["company"], body=html.unescape(m["body"]),
+                    timestamp=f"unix:{m['tm']}")
+        messages.append(data)
+
+    codecs = [("jsonl", None), ("segments", "gzip")]
+    if app.zstandard is not None:
+        codecs.append(("segments", "zstd"))
+
+    results = []
+    original = (app.OUTPUT_FORMAT, app.SEGMENT_COMPRESSION)
+    try:
+        for output_format, codec in codecs:
+            app.OUTPUT_FORMAT, app.SEGMENT_COMPRESSION = output_format, codec or "auto"
+            path = app.message_output_path(work_dir / "output", f"{rid}_{output_format}_{codec}")
+            path.parent.mkdir(parents=True, exist_ok=True)
+            start = time.time()
+            output = app.open_message_output(path)
+            for data in messages:
+                output.write(data)
+            output.close()
+            elapsed = time.time() - start
+            results.append({
+                "messages": size,
+                "format": codec or output_format,
+                "bytes": output_size(path),
+                "write_msgs_per_sec": size / elapsed if elapsed else 0.0
+            })
+    finally:
+        app.OUTPUT_FORMAT, app.SEGMENT_COMPRESSION = original
+    return results
+
+def print_output_report(results):
+    print("\n" + "=" * 100)
+    print("出力形式の比較（書き出し速度・サイズ）")
+    print("=" * 100)
+    print(f"{'件数':>8} {'形式':<8} {'サイズ(KB)':>11} {'対JSONL':>8} {'書出/秒':>10}")
+    jsonl_bytes = {r["messages"]: r["bytes"] for r in results if r["format"] == "jsonl"}
+    for r in results:
+        ratio = r["bytes"] / jsonl_bytes[r["messages"]] if jsonl_bytes.get(r["messages"]) else 0.0
+        print(f"{r['messages']:>8} {r['format']:<8} {r['bytes'] / 1024:>11.0f} {ratio:>8.1%} {r['write_msgs_per_sec']:>10.0f}")
+
+def print_api_report(results):
+    print("\n" + "=" * 100)
+    print("API版エクスポート（最新100件まで）")
+    print("=" * 100)
+    print(f"{'件数':>8} {'取得件数':>8} {'時間(秒)':>9} {'件/秒':>9} {'APIリクエスト':>13} {'DL(KB)':>9}")
+    for r in results:
+        if r["exported"] is None:
+            print(f"{r['messages']:>8} {'スキップ':>8}（APIで取得できない範囲があるため書き出さず）")
+            continue
+        print(f"{r['messages']:>8} {r['exported']:>8} {r['api_sec']:>9.2f} {r['api_msgs_per_sec']:>9.0f} "
+              f"{r['api_requests']:>13} {r['api_download_bytes'] / 1024:>9.0f}")
+
+def print_profile_report(results):
+    print("\n" + "=" * 100)
+    print("ブラウザ設定の比較（full: 従来 / trimmed: ヘッドレス・画像等ブロック・アニメーション無効・eager）")
+    print("=" * 100)
+    print(f"{'設定':<8} {'件数':>8} {'時間(秒)':>9} {'JSヒープMB':>10} {'DOMノード':>10} {'ChromeRSS MB':>12} {'画像等KB':>9}")
+    for r in results:
+        rss = f"{r['chrome_rss'] / 1024 / 1024:>12.0f}" if r["chrome_rss"] else f"{'-':>12}"
+        print(f"{r['profile']:<8} {r['messages']:>8} {r['room_sec']:>9.1f} {r['js_heap_mb']:>10.1f} "
+              f"{r['dom_nodes']:>10} {rss} {r['browser_bytes'] / 1024:>9.0f}")
+
+def print_report(results, peak_python, peak_tree):
+    print("\n" + "=" * 100)
+    print("ベンチマーク結果")
+    print("=" * 100)
+    header = f"{'件数':>8} {'読込(秒)':>9} {'読込/秒':>9} {'一括/秒':>10} {'一括呼出/件':>11} {'従来/秒':>9} {'従来呼出/件':>11} {'DL MB/秒':>9}"
+    print(header)
+    for r in results:
+        print(f"{r['messages']:>8} {r['scroll_sec']:>9.1f} {r['scroll_msgs_per_sec']:>9.0f} "
+              f"{r['batch_msgs_per_sec']:>10.0f} {r['batch_calls_per_msg']:>11.3f} "
+              f"{r['per_message_msgs_per_sec']:>9.1f} {r['per_message_calls_per_msg']:>11.1f} "
+              f"{r['download_bytes_per_sec'] / 1024 / 1024:>9.1f}")
+    print("-" * 100)
+    print(f"ピークRSS (Python): {peak_python / 1024 / 1024:.0f} MB")
+    if peak_tree:
+        print(f"ピークRSS (Python + Chrome): {peak_tree / 1024 / 1024:.0f} MB")
+    else:
+        print("ピークRSS (Python + Chrome): psutil 未インストールのため計測なし")
+
+def main():
+    parser = argparse.ArgumentParser(description="模擬Chatworkサーバーを使ったオフラインベンチマーク")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000], help="ルームのメッセージ数")
+    parser.add_argument("--latency", type=float, default=0.1, help="模擬サーバーの応答遅延（秒）")
+    parser.add_argument("--sample", type=int, default=100, help="従来方式で計測するメッセージ数")
+    parser.add_argument("--max-downloads", type=int, default=200, help="1ルームでダウンロードする添付ファイル数の上限")
+    parser.add_argument("--api-rate-limit", type=int, default=300, help="模擬APIの5分あたりのリクエスト上限")
+    parser.add_argument("--api-only", action="store_true", help="API版のみ計測（Chrome不要）")
+    parser.add_argument("--compare-profiles", action="store_true", help="従来のChromeと軽量化したChromeを比較")
+    parser.add_argument("--output", help="結果をJSONで保存するパス")
+    args = parser.parse_args()
+
+    rooms = {str(100 + i): (f"森田_bench_{size}", size) for i, size in enumerate(args.sizes)}
+    results = []
+    api_results = []
+    profile_results = []
+    output_results = []
+
+    with StandInServer(rooms, latency=args.latency, api_rate_limit=args.api_rate_limit) as server, \
+            PeakRssSampler() as sampler, tempfile.TemporaryDirectory() as tmp:
+        app.CHATWORK_URL = server.url
+
+        for rid, (name, size) in rooms.items():
+            print(f"\n▶ API版 {name} ({size}件)")
+            api_results.append(benchmark_api(server, rid, size, Path(tmp)))
+
+        for rid, (name, size) in rooms.items():
+            print(f"\n▶ 出力形式 {name} ({size}件)")
+            output_results.extend(benchmark_output(rid, size, Path(tmp)))
+
+        if not args.api_only:
+            driver = create_driver()
+            try:
+                for rid, (name, size) in rooms.items():
+                    print(f"\n▶ {name} ({size}件)")
+                    results.append(benchmark_room(driver, server, rid, size, Path(tmp), args.sample, args.max_downloads))
+            finally:
+                driver.quit()
+
+        if args.compare_profiles and not args.api_only:
+            for profile in ("full", "trimmed"):
+                driver = create_driver(profile)
+                try:
+                    for rid, (name, size) in rooms.items():
+                        print(f"\n▶ [{profile}] {name} ({size}件)")
+                        profile_results.append(benchmark_profile(driver, server, rid, size, profile))
+                finally:
+                    driver.quit()
+
+    print_api_report(api_results)
+    print_output_report(output_results)
+    if results:
+        print_report(results, PeakRssSampler.peak_python(), sampler.peak_tree)
+    if profile_results:
+        print_profile_report(profile_results)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"results": results, "api_results": api_results, "profile_results": profile_results,
+                       "output_results": output_results,
+                       "peak_rss_python": PeakRssSampler.peak_python(),
+                       "peak_rss_tree": sampler.peak_tree}, f, ensure_ascii=False, indent=2)
+
+if __name__ == "__main__":
+    sys.exit(main())
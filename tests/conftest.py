@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# app.py はパッケージではなく単体のスクリプトなので、リポジトリ直下をimportパスに追加する
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
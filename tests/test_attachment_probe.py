@@ -0,0 +1,98 @@
+"""エクスポート中の添付ファイルを塊ごとにまとめてHEADで確認してからダウンロードすることを確認する"""
+import threading
+from collections import namedtuple
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import requests
+
+import app
+
+BODY = b"attachment-body" * 100
+
+
+class Handler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+    
+    def _headers(self):
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(BODY)))
+        self.send_header("Content-Type", "application/pdf")
+        self.send_header("ETag", f'"{self.path}"')
+        self.end_headers()
+    
+    def do_HEAD(self):
+        with self.server.lock:
+            self.server.requests.append(("HEAD", self.path))
+        self._headers()
+    
+    def do_GET(self):
+        with self.server.lock:
+            self.server.requests.append(("GET", self.path))
+        self._headers()
+        self.wfile.write(BODY)
+
+
+@pytest.fixture
+def server():
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    httpd.requests = []
+    httpd.lock = threading.Lock()
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    httpd.url = f"http://127.0.0.1:{httpd.server_address[1]}"
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+@pytest.fixture(autouse=True)
+def no_checkpoint(monkeypatch):
+    monkeypatch.setattr(app, "_checkpoint", None)
+
+
+def messages(server, download_dir, downloader, count):
+    for index in range(count):
+        data = app.new_message_data(str(1000 + index))
+        app.download_attachment(data, {
+            "type": "file",
+            "file_id": str(index),
+            "filename": f"file_{index}.pdf",
+            "chatwork_url": f"{server.url}/file/{index}"
+        }, None, download_dir, downloader)
+        yield data
+
+
+def test_chunk_is_probed_before_downloads_start(server, tmp_path):
+    download_dir = tmp_path / "1_room"
+    download_dir.mkdir()
+    
+    with app.AttachmentDownloader(requests.Session()) as downloader:
+        written = list(app.in_probe_batches(downloader, messages(server, download_dir, downloader, 6), size=3))
+        for data in written:
+            app.wait_futures(downloader.pop_futures(data["message_id"]))
+    
+    assert len(written) == 6
+    assert all(data["attachments"][0]["local_absolute_path"] for data in written)
+    assert all(data["attachments"][0]["size"] == len(BODY) for data in written)
+    
+    # 各塊のHEADはその塊のどのGETよりも先に送られる
+    methods = [method for method, _ in server.requests]
+    assert methods.count("HEAD") == 6 and methods.count("GET") == 6
+    first_chunk = {f"/file/{i}" for i in range(3)}
+    chunk_requests = [r for r in server.requests if r[1] in first_chunk]
+    assert [method for method, _ in chunk_requests[:3]] == ["HEAD"] * 3
+
+
+def test_chunk_is_skipped_when_disk_is_full(server, tmp_path, monkeypatch):
+    download_dir = tmp_path / "1_room"
+    download_dir.mkdir()
+    Usage = namedtuple("Usage", "total used free")
+    monkeypatch.setattr(app.shutil, "disk_usage", lambda path: Usage(0, 0, len(BODY)))
+    
+    with app.AttachmentDownloader(requests.Session()) as downloader:
+        written = list(app.in_probe_batches(downloader, messages(server, download_dir, downloader, 3)))
+    
+    assert [data["attachments"][0]["local_absolute_path"] for data in written] == [None] * 3
+    assert all(method == "HEAD" for method, _ in server.requests)
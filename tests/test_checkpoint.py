@@ -0,0 +1,91 @@
+"""Checkpoint.load のワーカーごとのチェックポイントの統合と、--resume 無しでの引き継ぎを確認する"""
+import json
+
+import app
+
+
+def write_checkpoint(base, suffix, rooms, attachments=None):
+    data = {
+        "started_at": "2024-01-01T00:00:00",
+        "master_file": str(base / "_all_rooms.json"),
+        "rooms": rooms,
+        "downloaded_attachments": attachments or {}
+    }
+    (base / f"_checkpoint{suffix}.json").write_text(json.dumps(data), encoding="utf-8")
+
+
+def test_load_merges_worker_checkpoints(tmp_path):
+    write_checkpoint(tmp_path, "", {
+        "1": {"status": "in_progress", "written": 10},
+        "2": {"status": "done", "summary": {"room_id": "2"}},
+        "3": {"status": "in_progress", "written": 5}
+    }, {"1_room": {"file:a": "/a"}})
+    write_checkpoint(tmp_path, "_worker1", {
+        "1": {"status": "done", "summary": {"room_id": "1"}},
+        "2": {"status": "in_progress", "written": 99},
+        "3": {"status": "in_progress", "written": 7},
+        "4": {"status": "in_progress", "written": 1}
+    }, {"1_room": {"file:b": "/b"}, "4_other": {"file:c": "/c"}})
+    
+    merged = app.Checkpoint.load(tmp_path)
+    
+    # 完了は途中より優先し、完了済みは後から読んだ途中の状態で上書きしない
+    assert merged["rooms"]["1"]["status"] == "done"
+    assert merged["rooms"]["2"]["status"] == "done"
+    # 途中同士は書き出し件数の多い方を採用する
+    assert merged["rooms"]["3"]["written"] == 7
+    assert merged["rooms"]["4"]["written"] == 1
+    assert merged["downloaded_attachments"] == {
+        "1_room": {"file:a": "/a", "file:b": "/b"},
+        "4_other": {"file:c": "/c"}
+    }
+
+
+def test_finishing_a_room_keeps_other_rooms_downloads(tmp_path):
+    checkpoint = app.Checkpoint(tmp_path)
+    checkpoint.start_room("1", "room", tmp_path / "1_room.jsonl", None)
+    checkpoint.start_room("2", "next", tmp_path / "2_next.jsonl", None)
+    for folder in ("1_room", "2_next"):
+        (tmp_path / folder).mkdir()
+        (tmp_path / folder / "a.pdf").write_bytes(b"a")
+        checkpoint.record_attachment(tmp_path / folder, "file:1", str(tmp_path / folder / "a.pdf"))
+    
+    # パイプラインでは次のルームのダウンロード中に前のルームが完了する
+    checkpoint.finish_room("1", {"room_id": "1"})
+    
+    assert checkpoint.downloaded_path(tmp_path / "1_room", "file:1") is None
+    assert checkpoint.downloaded_path(tmp_path / "2_next", "file:1") == str(tmp_path / "2_next" / "a.pdf")
+    assert app.Checkpoint.load(tmp_path)["downloaded_attachments"] == {"2_next": {"file:1": str(tmp_path / "2_next" / "a.pdf")}}
+
+
+def test_load_without_checkpoints_returns_none(tmp_path):
+    assert app.Checkpoint.load(tmp_path) is None
+
+
+def test_load_skips_broken_files(tmp_path):
+    write_checkpoint(tmp_path, "", {"1": {"status": "done", "summary": {}}})
+    (tmp_path / "_checkpoint_worker1.json").write_text("{broken", encoding="utf-8")
+    
+    merged = app.Checkpoint.load(tmp_path)
+    
+    assert merged["rooms"]["1"]["status"] == "done"
+
+
+def test_interrupted_room_keeps_baseline_without_resume(tmp_path, monkeypatch):
+    monkeypatch.setattr(app, "_checkpoint", None)
+    write_checkpoint(tmp_path, "", {
+        "1": {"status": "in_progress", "baseline_mid": "100", "written": 2},
+        "2": {"status": "done", "summary": {"room_id": "2"}}
+    })
+    messages_path = tmp_path / "1_room.jsonl"
+    messages_path.write_text(
+        "".join(json.dumps({"message_id": mid}) + "\n" for mid in ["900", "901"]), encoding="utf-8"
+    )
+    
+    checkpoint = app.start_checkpoint(tmp_path, tmp_path / "_all_rooms.json", resume=False)
+    
+    assert set(checkpoint.data["rooms"]) == {"1"}
+    # ファイル上の最大のmessage_id（901）ではなく、開始時点の基準から続ける
+    last_mid, written_ids = app.resume_room_output("1", "room", messages_path, "901")
+    assert last_mid == "100"
+    assert written_ids == {"900", "901"}
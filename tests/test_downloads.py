@@ -0,0 +1,199 @@
+"""stream_download / download_to_part の再開・再試行をローカルのHTTPサーバーで確認する"""
+import hashlib
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import requests
+
+import app
+
+DATA = bytes(range(256)) * 2000   # 512,000バイト
+DATA_SHA256 = hashlib.sha256(DATA).hexdigest()
+ETAG = '"v1"'
+
+
+class Handler(BaseHTTPRequestHandler):
+    """server.mode で挙動を切り替える模擬サーバー
+    
+    "range": Rangeに対応（206）/ "ignore_range": Rangeを無視して常に全体（200）
+    drop_first: 最初のGETだけContent-Lengthの半分で接続を切る
+    data / etag: 配信する内容とETag（If-Rangeが一致しなければRangeを無視して全体を返す）
+    """
+    
+    def log_message(self, *args):
+        pass
+    
+    def do_GET(self):
+        server = self.server
+        server.requests.append(self.headers.get("Range"))
+        server.if_ranges.append(self.headers.get("If-Range"))
+        data = server.data
+        
+        if self.path == "/missing":
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        
+        start = 0
+        range_header = self.headers.get("Range")
+        if_range = self.headers.get("If-Range")
+        if range_header and server.mode == "range" and if_range in (None, server.etag):
+            start = int(range_header.split("=")[1].rstrip("-"))
+            if start >= len(data):
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{len(data)}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{len(data) - 1}/{len(data)}")
+        else:
+            self.send_response(200)
+        
+        body = data[start:]
+        self.send_header("ETag", server.etag)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        
+        if server.drop_first and len(server.requests) == 1:
+            self.wfile.write(body[:len(body) // 2])
+            self.wfile.flush()
+            self.close_connection = True
+            return
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def server():
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    httpd.mode = "range"
+    httpd.drop_first = False
+    httpd.requests = []
+    httpd.if_ranges = []
+    httpd.data = DATA
+    httpd.etag = ETAG
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    httpd.url = f"http://127.0.0.1:{httpd.server_address[1]}"
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(app, "DOWNLOAD_BACKOFF_BASE", 0.0)
+    monkeypatch.setattr(app, "DOWNLOAD_BACKOFF_MAX", 0.0)
+
+
+def part_of(path):
+    return path.with_name(path.name + ".part")
+
+
+def write_part(path, content, validator=ETAG):
+    """前回の実行で途中まで受信した .part（と取得元の検証子）を用意する"""
+    part_of(path).write_bytes(content)
+    if validator:
+        app.part_validator_path(part_of(path)).write_text(validator, encoding="utf-8")
+
+
+def test_download_completes_and_removes_part(server, tmp_path):
+    save_path = tmp_path / "file.bin"
+    
+    sha256 = app.stream_download(requests.Session(), f"{server.url}/file", save_path)
+    
+    assert sha256 == DATA_SHA256
+    assert save_path.read_bytes() == DATA
+    assert not part_of(save_path).exists()
+    assert not app.part_validator_path(part_of(save_path)).exists()
+    assert server.requests == [None]
+
+
+def test_dropped_connection_resumes_with_range(server, tmp_path):
+    server.drop_first = True
+    save_path = tmp_path / "file.bin"
+    
+    sha256 = app.stream_download(requests.Session(), f"{server.url}/file", save_path)
+    
+    assert sha256 == DATA_SHA256
+    assert save_path.read_bytes() == DATA
+    assert server.requests[0] is None
+    # 書き込み済みの分（チャンク境界まで）から続きを要求する
+    resumed_from = int(server.requests[1].split("=")[1].rstrip("-"))
+    assert 0 < resumed_from <= len(DATA) // 2
+    assert server.if_ranges[1] == ETAG
+
+
+def test_server_ignoring_range_restarts_from_scratch(server, tmp_path):
+    server.mode = "ignore_range"
+    save_path = tmp_path / "file.bin"
+    write_part(save_path, b"stale bytes from another file")
+    
+    sha256 = app.stream_download(requests.Session(), f"{server.url}/file", save_path)
+    
+    assert sha256 == DATA_SHA256
+    assert save_path.read_bytes() == DATA
+    assert server.requests == ["bytes=29-"]
+
+
+def test_complete_part_with_416_is_accepted(server, tmp_path):
+    save_path = tmp_path / "file.bin"
+    write_part(save_path, DATA)
+    
+    sha256 = app.stream_download(requests.Session(), f"{server.url}/file", save_path)
+    
+    assert sha256 == DATA_SHA256
+    assert save_path.read_bytes() == DATA
+    assert server.requests == [f"bytes={len(DATA)}-"]
+
+
+def test_oversized_part_with_416_is_discarded_and_refetched(server, tmp_path):
+    save_path = tmp_path / "file.bin"
+    write_part(save_path, DATA + b"extra")
+    
+    sha256 = app.stream_download(requests.Session(), f"{server.url}/file", save_path)
+    
+    assert sha256 == DATA_SHA256
+    assert save_path.read_bytes() == DATA
+    assert server.requests == [f"bytes={len(DATA) + 5}-", None]
+
+
+def test_changed_remote_file_restarts_instead_of_splicing(server, tmp_path):
+    save_path = tmp_path / "file.bin"
+    write_part(save_path, DATA[:1000])
+    server.data = bytes(reversed(DATA))
+    server.etag = '"v2"'
+    
+    sha256 = app.stream_download(requests.Session(), f"{server.url}/file", save_path)
+    
+    # If-Range が一致しないためサーバーは全体を返し、古い先頭部分は使わない
+    assert save_path.read_bytes() == server.data
+    assert sha256 == hashlib.sha256(server.data).hexdigest()
+    assert server.requests == ["bytes=1000-"]
+    assert server.if_ranges == [ETAG]
+
+
+def test_part_without_validator_is_not_resumed(server, tmp_path):
+    save_path = tmp_path / "file.bin"
+    write_part(save_path, b"x" * 1000, validator=None)
+    
+    sha256 = app.stream_download(requests.Session(), f"{server.url}/file", save_path)
+    
+    assert sha256 == DATA_SHA256
+    assert save_path.read_bytes() == DATA
+    assert server.requests == [None]
+
+
+def test_non_retryable_error_removes_part(server, tmp_path):
+    save_path = tmp_path / "file.bin"
+    write_part(save_path, b"partial")
+    
+    with pytest.raises(requests.HTTPError):
+        app.stream_download(requests.Session(), f"{server.url}/missing", save_path)
+    
+    assert not part_of(save_path).exists()
+    assert not app.part_validator_path(part_of(save_path)).exists()
+    assert not save_path.exists()
+    assert len(server.requests) == 1
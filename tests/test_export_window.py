@@ -0,0 +1,31 @@
+"""期間指定の出力でも、添付ファイルの実体・記録・一覧はバックアップ先直下で共有することを確認する"""
+import app
+
+
+def test_window_output_shares_attachment_state(tmp_path, monkeypatch):
+    monkeypatch.setattr(app, "EXPORT_SINCE", 1_600_000_000)
+    window = app.export_output_dir(tmp_path)
+    window.mkdir()
+    room_dir = window / "1_room"
+    
+    assert window != tmp_path
+    assert app.backup_root(window) == tmp_path
+    assert app.blob_store_for(room_dir).root == (tmp_path / app.BLOB_DIR_NAME).resolve()
+    assert app.remote_index_for(room_dir).path == (tmp_path / app.REMOTE_INDEX_NAME).resolve()
+
+
+def test_window_manifest_entries_are_fetched_from_base(tmp_path, monkeypatch):
+    monkeypatch.setattr(app, "EXPORT_SINCE", 1_600_000_000)
+    window = app.export_output_dir(tmp_path)
+    window.mkdir()
+    messages_path = window / "1_room.jsonl"
+    
+    app.manifest_for(app.backup_root(window)).record("1", messages_path, {
+        "message_id": "5",
+        "attachments": [{"type": "file", "file_id": "9", "filename": "a.pdf"}]
+    })
+    
+    # fetch-attachments はバックアップ先直下の一覧だけを読む
+    entries = app.AttachmentManifest(tmp_path).entries()
+    assert len(entries) == 1
+    assert tmp_path / entries[0]["download_dir"] == window / "1_room"
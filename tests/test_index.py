@@ -0,0 +1,24 @@
+"""index_exports がルームの出力だけを取り込むことを確認する"""
+import json
+import sqlite3
+
+import app
+
+
+def test_index_ignores_management_files(tmp_path):
+    (tmp_path / "123_room.jsonl").write_text(
+        json.dumps({"message_id": "500", "sender": "A", "body": "hello world", "timestamp": "", "attachments": []}) + "\n",
+        encoding="utf-8"
+    )
+    (tmp_path / "_attachment_manifest.jsonl").write_text(
+        json.dumps({"room_id": "123", "message_id": "500", "type": "file"}) + "\n", encoding="utf-8"
+    )
+    (tmp_path / "_remote_files.jsonl").write_text(json.dumps({"path": "x", "size": 1}) + "\n", encoding="utf-8")
+    
+    app.index_exports(tmp_path)
+    
+    with sqlite3.connect(tmp_path / app.SQLITE_ARCHIVE_NAME) as conn:
+        rows = conn.execute("SELECT message_id, room_id, body FROM messages").fetchall()
+        rooms = conn.execute("SELECT room_id FROM rooms").fetchall()
+    assert rows == [("500", "123", "hello world")]
+    assert rooms == [("123",)]